@@ -0,0 +1,119 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class InferenceGate:
+    """Caps how many inference requests a worker process admits at once (running plus queued).
+
+    ``try_acquire`` never blocks: when the gate is full the caller sheds the request with a 503
+    instead of letting work pile up behind the model.
+    """
+
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.peak = 0
+        self.admitted = 0
+
+    def try_acquire(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            self.admitted += 1
+            self.peak = max(self.peak, self.pending)
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+
+class ThreadSlots:
+    """Caps the requests that hold a worker thread for a long time (downloads, live sessions), per kind
+    and in total, so the remaining threads stay free for short requests.
+
+    ``try_acquire`` never blocks, like InferenceGate's.
+    """
+
+    def __init__(self, total, **limits):
+        self.total = total
+        self.limits = limits
+        self._lock = threading.Lock()
+        self.in_use = dict.fromkeys(limits, 0)
+
+    def try_acquire(self, kind):
+        with self._lock:
+            if self.in_use[kind] >= self.limits[kind] or sum(self.in_use.values()) >= self.total:
+                return False
+            self.in_use[kind] += 1
+            return True
+
+    def release(self, kind):
+        with self._lock:
+            self.in_use[kind] -= 1
+
+
+class RateLimiter:
+    """Per-client token buckets: ``rate`` requests per second, bursts of up to ``burst``.
+
+    Only the ``max_clients`` most recently seen clients are tracked, so memory stays bounded.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client):
+        """Take one token for ``client``; return 0 if allowed, else seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1.0 - tokens) / self.rate
+
+
+class AdmissionStats:
+    """Counts of shed requests by reason."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.shed = {}
+
+    def record(self, reason):
+        with self._lock:
+            self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.shed)
+
+
+def retry_after(seconds):
+    """Retry-After header value: whole seconds, at least 1."""
+    return str(max(1, math.ceil(seconds)))
+
+
+def client_address(forwarded_for, remote_addr, trust_forwarded_for):
+    """Address to rate-limit a request by.
+
+    Behind a proxy, that is the last X-Forwarded-For entry: the one the proxy itself appended. Earlier
+    entries come from the client, which could send a new value per request and never be limited.
+    """
+    if trust_forwarded_for and forwarded_for:
+        last = forwarded_for.split(',')[-1].strip()
+        if last:
+            return last
+    return remote_addr
@@ -1,567 +1,687 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import (Flask, Response, abort, g, request, jsonify, make_response, render_template, send_file,
+                   stream_with_context)
+import hmac
+import io
+import json
+import math
+import mimetypes
 import os
-from recommend import load_model_info, preprocess_image, predict_emotion, get_recommendations, get_local_songs
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+import numpy as np
+from recommend import (preprocess_image, preprocess_pixels, predict_emotion, predict_emotions, get_catalog,
+                       get_recommendations, get_local_songs, LOCAL_SONGS_FOLDER)
+from admission import AdmissionStats, InferenceGate, RateLimiter, ThreadSlots, client_address, retry_after
+from assets import Asset, AssetBundle
+from batching import BatchScheduler
+from cache import PredictionCache
+from catalog import file_version, song_path, song_url
+from mp3_frames import FrameIndex
+from live import EmotionSmoother, LiveSession
+from metrics import Metrics, RequestTimer
+from profiling import KINDS as PROFILE_KINDS, Profiler, ProfileStore
+from service import PredictionFailed, load_model, model_ready, predict_upload, prediction_payload
+from similarity import SimilarityIndex
+import config
+
+try:
+    from flask_sock import Sock
+except ImportError:  # live camera mode is optional
+    Sock = None
 
 # Use absolute path based on this file's location
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-MODEL_PATH = os.path.join(BASE_DIR, 'model', 'model_v6_23.hdf5')
+MODEL_PATH = config.MODEL_PATH
 
 app = Flask(__name__, static_folder='static')
+# Hard cap for bodies without a Content-Length; per-endpoint limits are applied in admit_request
+app.config['MAX_CONTENT_LENGTH'] = max(config.MAX_UPLOAD_BYTES, config.MAX_BATCH_UPLOAD_BYTES)
+sock = Sock(app) if Sock is not None else None
 
-HOME_PAGE = '''
-<!DOCTYPE html>
-<html>
-<head>
-    <title>EmotiTunes - AI Music Recommender</title>
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@300;400;500;600;700&display=swap" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body { 
-            font-family: 'Poppins', sans-serif; 
-            min-height: 100vh;
-            background: linear-gradient(135deg, #0f0c29 0%, #302b63 50%, #24243e 100%);
-            color: #fff;
-            padding: 20px;
-        }
-        .container { max-width: 800px; margin: 0 auto; }
-        
-        header { text-align: center; padding: 40px 0; }
-        header h1 {
-            font-size: 2.5rem;
-            font-weight: 700;
-            background: linear-gradient(90deg, #00d4ff, #7b2cbf, #e040fb);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-            margin-bottom: 10px;
-        }
-        header p { color: #a0a0a0; font-size: 1.1rem; font-weight: 300; }
-        
-        .main-card {
-            background: rgba(255, 255, 255, 0.05);
-            backdrop-filter: blur(10px);
-            border-radius: 24px;
-            padding: 40px;
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            box-shadow: 0 25px 50px rgba(0, 0, 0, 0.3);
-        }
-        
-        .tabs {
-            display: flex; gap: 10px; margin-bottom: 30px;
-            background: rgba(0, 0, 0, 0.2); padding: 8px; border-radius: 16px;
-        }
-        .tab {
-            flex: 1; padding: 14px 20px; cursor: pointer;
-            background: transparent; border-radius: 12px; text-align: center;
-            font-weight: 500; transition: all 0.3s ease; color: #888;
-        }
-        .tab:hover { color: #fff; }
-        .tab.active {
-            background: linear-gradient(135deg, #7b2cbf, #e040fb);
-            color: #fff; box-shadow: 0 4px 15px rgba(123, 44, 191, 0.4);
-        }
-        .tab i { margin-right: 8px; }
-        
-        .tab-content { display: none; }
-        .tab-content.active { display: block; animation: fadeIn 0.4s ease; }
-        
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(10px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
-        
-        .camera-section { text-align: center; }
-        #video {
-            width: 100%; max-width: 480px; height: auto; aspect-ratio: 4/3;
-            border-radius: 16px; background: linear-gradient(135deg, #1a1a2e, #16213e);
-            display: none; margin: 0 auto 20px;
-            box-shadow: 0 10px 40px rgba(0, 0, 0, 0.3);
-        }
-        #canvas { display: none; }
-        
-        .camera-placeholder {
-            width: 100%; max-width: 480px; aspect-ratio: 4/3;
-            border-radius: 16px; background: linear-gradient(135deg, #1a1a2e, #16213e);
-            display: flex; align-items: center; justify-content: center; flex-direction: column;
-            margin: 0 auto 20px; border: 2px dashed rgba(255, 255, 255, 0.1);
-        }
-        .camera-placeholder i { font-size: 4rem; color: #444; margin-bottom: 15px; }
-        .camera-placeholder p { color: #666; font-size: 0.95rem; }
-        
-        .btn-group { display: flex; gap: 12px; justify-content: center; flex-wrap: wrap; }
-        
-        button {
-            padding: 14px 28px; border: none; border-radius: 12px;
-            font-family: 'Poppins', sans-serif; font-size: 0.95rem; font-weight: 500;
-            cursor: pointer; transition: all 0.3s ease;
-            display: inline-flex; align-items: center; gap: 8px;
-        }
-        
-        .btn-primary {
-            background: linear-gradient(135deg, #00d4ff, #0099cc);
-            color: #000; box-shadow: 0 4px 15px rgba(0, 212, 255, 0.3);
-        }
-        .btn-primary:hover { transform: translateY(-2px); box-shadow: 0 6px 20px rgba(0, 212, 255, 0.4); }
-        
-        .btn-secondary {
-            background: rgba(255, 255, 255, 0.1); color: #fff;
-            border: 1px solid rgba(255, 255, 255, 0.2);
-        }
-        .btn-secondary:hover { background: rgba(255, 255, 255, 0.15); transform: translateY(-2px); }
-        
-        .btn-danger {
-            background: rgba(255, 71, 87, 0.2); color: #ff4757;
-            border: 1px solid rgba(255, 71, 87, 0.3);
-        }
-        .btn-danger:hover { background: rgba(255, 71, 87, 0.3); }
-        
-        .upload-area {
-            border: 2px dashed rgba(255, 255, 255, 0.2); border-radius: 16px;
-            padding: 40px; text-align: center; transition: all 0.3s ease;
-            cursor: pointer; margin-bottom: 20px;
-        }
-        .upload-area:hover { border-color: #7b2cbf; background: rgba(123, 44, 191, 0.1); }
-        .upload-area i { font-size: 3rem; color: #7b2cbf; margin-bottom: 15px; display: block; }
-        .upload-area p { color: #888; margin-bottom: 5px; }
-        .upload-area span { color: #00d4ff; font-weight: 500; }
-        
-        #imageInput { display: none; }
-        
-        #preview {
-            max-width: 300px; max-height: 300px; border-radius: 16px;
-            margin: 20px auto; display: none; box-shadow: 0 10px 40px rgba(0, 0, 0, 0.3);
-        }
-        
-        #result {
-            margin-top: 30px; padding: 30px; background: rgba(0, 0, 0, 0.2);
-            border-radius: 20px; display: none; animation: fadeIn 0.5s ease;
-        }
-        
-        .result-header {
-            display: flex; align-items: center; gap: 20px; margin-bottom: 25px;
-            padding-bottom: 20px; border-bottom: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        .emotion-icon {
-            width: 70px; height: 70px; border-radius: 50%;
-            background: linear-gradient(135deg, #7b2cbf, #e040fb);
-            display: flex; align-items: center; justify-content: center; font-size: 2rem;
-        }
-        
-        .emotion-text h2 { font-size: 1.8rem; font-weight: 600; margin-bottom: 5px; }
-        .emotion-text p { color: #888; font-size: 0.9rem; }
-        
-        .playlists-title { font-size: 1.1rem; font-weight: 600; margin-bottom: 15px; color: #00d4ff; }
-        .playlists-title i { margin-right: 8px; }
-        
-        .section-divider { margin: 25px 0; border-top: 1px solid rgba(255, 255, 255, 0.1); }
-        
-        .playlist-item {
-            display: flex; align-items: center; gap: 15px; padding: 15px;
-            background: rgba(255, 255, 255, 0.05); border-radius: 12px;
-            margin-bottom: 10px; transition: all 0.3s ease;
-            text-decoration: none; color: #fff; cursor: pointer;
-        }
-        .playlist-item:hover { background: rgba(255, 255, 255, 0.1); transform: translateX(5px); }
-        .playlist-item .play-icon {
-            width: 45px; height: 45px; border-radius: 50%;
-            background: linear-gradient(135deg, #1db954, #1ed760);
-            display: flex; align-items: center; justify-content: center;
-            color: #fff; font-size: 1rem; flex-shrink: 0;
-        }
-        .playlist-item .play-icon.local {
-            background: linear-gradient(135deg, #e040fb, #7b2cbf);
-        }
-        .playlist-item .play-icon.playing {
-            animation: pulse 1s infinite;
-        }
-        @keyframes pulse {
-            0%, 100% { transform: scale(1); }
-            50% { transform: scale(1.1); }
-        }
-        .playlist-item .playlist-info { flex: 1; min-width: 0; }
-        .playlist-item .playlist-info h4 { font-weight: 500; margin-bottom: 3px; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
-        .playlist-item .playlist-info p { font-size: 0.8rem; color: #888; }
-        .playlist-item .arrow { margin-left: auto; color: #666; flex-shrink: 0; }
-        
-        .audio-player {
-            margin-top: 25px; padding: 20px;
-            background: linear-gradient(135deg, rgba(123, 44, 191, 0.2), rgba(224, 64, 251, 0.1));
-            border-radius: 16px; border: 1px solid rgba(123, 44, 191, 0.3);
-        }
-        .audio-player-header {
-            display: flex; align-items: center; gap: 15px; margin-bottom: 15px;
-        }
-        .audio-player-header .now-playing-icon {
-            width: 50px; height: 50px; border-radius: 12px;
-            background: linear-gradient(135deg, #e040fb, #7b2cbf);
-            display: flex; align-items: center; justify-content: center;
-            font-size: 1.2rem;
-        }
-        .audio-player-header .track-info h4 {
-            font-weight: 600; margin-bottom: 3px;
-            white-space: nowrap; overflow: hidden; text-overflow: ellipsis;
-            max-width: 300px;
-        }
-        .audio-player-header .track-info p { font-size: 0.85rem; color: #a0a0a0; }
-        
-        #audioElement {
-            width: 100%; height: 45px; border-radius: 8px; outline: none;
-        }
-        
-        .no-local-songs {
-            text-align: center; padding: 20px; color: #666;
-            background: rgba(255, 255, 255, 0.02); border-radius: 12px;
-            border: 1px dashed rgba(255, 255, 255, 0.1);
-        }
-        .no-local-songs i { font-size: 2rem; margin-bottom: 10px; display: block; }
-        .no-local-songs p { font-size: 0.9rem; }
-        .no-local-songs code { 
-            background: rgba(0, 212, 255, 0.1); padding: 2px 8px; 
-            border-radius: 4px; font-size: 0.85rem; color: #00d4ff;
-        }
-        
-        .loading { text-align: center; padding: 40px; }
-        .spinner {
-            width: 50px; height: 50px;
-            border: 3px solid rgba(255, 255, 255, 0.1); border-top-color: #00d4ff;
-            border-radius: 50%; animation: spin 1s linear infinite; margin: 0 auto 15px;
-        }
-        @keyframes spin { to { transform: rotate(360deg); } }
-        
-        footer { text-align: center; padding: 30px; color: #555; font-size: 0.85rem; }
-        footer a { color: #7b2cbf; text-decoration: none; }
-        
-        @media (max-width: 600px) {
-            header h1 { font-size: 1.8rem; }
-            .main-card { padding: 25px; }
-            .btn-group { flex-direction: column; }
-            button { width: 100%; justify-content: center; }
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <header>
-            <h1><i class="fas fa-music"></i> Song Recomendation using Facial Expression</h1>
-            <p>AI-powered music recommendations based on your emotions</p>
-        </header>
-        
-        <div class="main-card">
-            <div class="tabs">
-                <div class="tab active" onclick="switchTab('camera')">
-                    <i class="fas fa-camera"></i> Live Camera
-                </div>
-                <div class="tab" onclick="switchTab('upload')">
-                    <i class="fas fa-cloud-upload-alt"></i> Upload Photo
-                </div>
-            </div>
-            
-            <div id="camera-tab" class="tab-content active">
-                <div class="camera-section">
-                    <div class="camera-placeholder" id="cameraPlaceholder">
-                        <i class="fas fa-video"></i>
-                        <p>Click "Start Camera" to begin</p>
-                    </div>
-                    <video id="video" autoplay playsinline></video>
-                    <canvas id="canvas"></canvas>
-                    <div class="btn-group">
-                        <button class="btn-secondary" onclick="startCamera()">
-                            <i class="fas fa-video"></i> Start Camera
-                        </button>
-                        <button class="btn-primary" onclick="captureAndPredict()">
-                            <i class="fas fa-camera"></i> Capture & Analyze
-                        </button>
-                        <button class="btn-danger" onclick="stopCamera()">
-                            <i class="fas fa-stop"></i> Stop
-                        </button>
-                    </div>
-                </div>
-            </div>
-            
-            <div id="upload-tab" class="tab-content">
-                <div class="upload-area" onclick="document.getElementById('imageInput').click()">
-                    <i class="fas fa-cloud-upload-alt"></i>
-                    <p>Drag & drop your photo here or</p>
-                    <span>Browse Files</span>
-                </div>
-                <input type="file" id="imageInput" accept="image/*">
-                <img id="preview">
-                <div class="btn-group">
-                    <button class="btn-primary" onclick="predictFromFile()">
-                        <i class="fas fa-magic"></i> Analyze Emotion
-                    </button>
-                </div>
-            </div>
-            
-            <div id="result"></div>
-        </div>
-        
-        <footer>
-            Powered by AI • Built with <a href="#">TensorFlow</a> & <a href="#">Flask</a>
-        </footer>
-    </div>
-
-    <script>
-        let stream = null;
-        const video = document.getElementById('video');
-        const canvas = document.getElementById('canvas');
-        const placeholder = document.getElementById('cameraPlaceholder');
-        
-        const emotionEmojis = {
-            'Happy': '😊', 'Sad': '😢', 'Angry': '😠', 'Fear': '😨',
-            'Surprise': '😲', 'Disgust': '🤢', 'Neutral': '😐'
-        };
-        
-        function switchTab(tab) {
-            document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
-            document.querySelectorAll('.tab-content').forEach(t => t.classList.remove('active'));
-            if (tab === 'camera') {
-                document.querySelector('.tab:nth-child(1)').classList.add('active');
-                document.getElementById('camera-tab').classList.add('active');
-            } else {
-                document.querySelector('.tab:nth-child(2)').classList.add('active');
-                document.getElementById('upload-tab').classList.add('active');
-            }
-        }
-        
-        async function startCamera() {
-            try {
-                stream = await navigator.mediaDevices.getUserMedia({ 
-                    video: { facingMode: 'user', width: 640, height: 480 }, audio: false 
-                });
-                video.srcObject = stream;
-                video.style.display = 'block';
-                placeholder.style.display = 'none';
-            } catch (err) {
-                alert('Could not access camera: ' + err.message);
-            }
-        }
-        
-        function stopCamera() {
-            if (stream) {
-                stream.getTracks().forEach(track => track.stop());
-                stream = null;
-                video.style.display = 'none';
-                placeholder.style.display = 'flex';
-            }
-        }
-        
-        async function captureAndPredict() {
-            if (!stream) { alert('Please start the camera first'); return; }
-            canvas.width = video.videoWidth;
-            canvas.height = video.videoHeight;
-            canvas.getContext('2d').drawImage(video, 0, 0);
-            
-            canvas.toBlob(async (blob) => {
-                const formData = new FormData();
-                formData.append('image', blob, 'capture.jpg');
-                await sendPrediction(formData);
-            }, 'image/jpeg', 0.9);
-        }
+WARMUP_BATCH_SIZES = sorted({1, config.BATCH_MAX_SIZE})
+# With the inference sidecar, input_shape and channels stay None until it is reachable: see _model_available.
+model, input_shape, channels, model_status = load_model(WARMUP_BATCH_SIZES)
 
-        document.getElementById('imageInput').onchange = function(e) {
-            const preview = document.getElementById('preview');
-            if (e.target.files.length) {
-                preview.src = URL.createObjectURL(e.target.files[0]);
-                preview.style.display = 'block';
-            }
-        };
-
-        async function predictFromFile() {
-            const input = document.getElementById('imageInput');
-            if (!input.files.length) { alert('Please select an image first'); return; }
-            const formData = new FormData();
-            formData.append('image', input.files[0]);
-            await sendPrediction(formData);
-        }
-        
-        let currentAudio = null;
-        let currentPlayingItem = null;
-        
-        function playLocalSong(url, title, element) {
-            // Stop current audio if playing
-            if (currentAudio) {
-                currentAudio.pause();
-                if (currentPlayingItem) {
-                    currentPlayingItem.querySelector('.play-icon').classList.remove('playing');
-                    currentPlayingItem.querySelector('.play-icon i').className = 'fas fa-play';
-                }
-            }
-            
-            // Update audio player
-            const audioElement = document.getElementById('audioElement');
-            const trackTitle = document.getElementById('trackTitle');
-            const audioPlayer = document.getElementById('audioPlayer');
-            
-            audioElement.src = url;
-            trackTitle.textContent = title;
-            audioPlayer.style.display = 'block';
-            audioElement.play();
-            
-            currentAudio = audioElement;
-            currentPlayingItem = element;
-            
-            // Update play icon
-            element.querySelector('.play-icon').classList.add('playing');
-            element.querySelector('.play-icon i').className = 'fas fa-pause';
-            
-            // Handle audio end
-            audioElement.onended = function() {
-                element.querySelector('.play-icon').classList.remove('playing');
-                element.querySelector('.play-icon i').className = 'fas fa-play';
-                currentPlayingItem = null;
-            };
-            
-            audioElement.onpause = function() {
-                if (currentPlayingItem) {
-                    currentPlayingItem.querySelector('.play-icon').classList.remove('playing');
-                    currentPlayingItem.querySelector('.play-icon i').className = 'fas fa-play';
-                }
-            };
-            
-            audioElement.onplay = function() {
-                if (currentPlayingItem) {
-                    currentPlayingItem.querySelector('.play-icon').classList.add('playing');
-                    currentPlayingItem.querySelector('.play-icon i').className = 'fas fa-pause';
-                }
-            };
-        }
-        
-        async function sendPrediction(formData) {
-            const resultDiv = document.getElementById('result');
-            resultDiv.innerHTML = '<div class="loading"><div class="spinner"></div><p>Analyzing your emotion...</p></div>';
-            resultDiv.style.display = 'block';
-
-            try {
-                const res = await fetch('/predict', { method: 'POST', body: formData });
-                const data = await res.json();
-                if (data.error) {
-                    resultDiv.innerHTML = '<div class="loading"><i class="fas fa-exclamation-circle" style="font-size:2rem;color:#ff4757;"></i><p style="color:#ff4757;margin-top:10px;">' + data.error + '</p></div>';
-                    return;
-                }
-                
-                const emoji = emotionEmojis[data.emotion] || '🎵';
-                let html = `
-                    <div class="result-header">
-                        <div class="emotion-icon">${emoji}</div>
-                        <div class="emotion-text">
-                            <h2>${data.emotion}</h2>
-                            <p>Detected emotion from your photo</p>
-                        </div>
-                    </div>
-                `;
-                
-                // Local Songs Section
-                html += `<p class="playlists-title"><i class="fas fa-folder-open"></i> Your Local Songs</p>`;
-                
-                if (data.local_songs && data.local_songs.length > 0) {
-                    data.local_songs.forEach((song, idx) => {
-                        html += `
-                            <div class="playlist-item" onclick="playLocalSong('${song.url}', '${song.title.replace(/'/g, "\\'")}', this)" id="local-song-${idx}">
-                                <div class="play-icon local"><i class="fas fa-play"></i></div>
-                                <div class="playlist-info">
-                                    <h4>${song.title}</h4>
-                                    <p>Local Music</p>
-                                </div>
-                                <i class="fas fa-music arrow"></i>
-                            </div>
-                        `;
-                    });
-                    
-                    // Audio Player
-                    html += `
-                        <div class="audio-player" id="audioPlayer" style="display:none;">
-                            <div class="audio-player-header">
-                                <div class="now-playing-icon"><i class="fas fa-music"></i></div>
-                                <div class="track-info">
-                                    <h4 id="trackTitle">Select a song</h4>
-                                    <p>Now Playing</p>
-                                </div>
-                            </div>
-                            <audio id="audioElement" controls></audio>
-                        </div>
-                    `;
-                } else {
-                    html += `
-                        <div class="no-local-songs">
-                            <i class="fas fa-folder-plus"></i>
-                            <p>No local songs found. Add MP3 files to:</p>
-                            <p><code>static/songs/</code></p>
-                            <p style="margin-top:8px;font-size:0.8rem;">Tip: Create subfolders like <code>happy/</code>, <code>sad/</code> for emotion-specific songs</p>
-                        </div>
-                    `;
-                }
-                
-                // Spotify Section
-                html += `<div class="section-divider"></div>`;
-                html += `<p class="playlists-title"><i class="fas fa-headphones"></i> Spotify Playlists</p>`;
-                
-                data.recommendations.forEach(r => {
-                    html += `
-                        <a href="${r.url}" target="_blank" class="playlist-item">
-                            <div class="play-icon"><i class="fas fa-play"></i></div>
-                            <div class="playlist-info">
-                                <h4>${r.title}</h4>
-                                <p>Spotify Playlist</p>
-                            </div>
-                            <i class="fas fa-external-link-alt arrow"></i>
-                        </a>
-                    `;
-                });
-                
-                resultDiv.innerHTML = html;
-            } catch (err) {
-                resultDiv.innerHTML = '<div class="loading"><i class="fas fa-exclamation-circle" style="font-size:2rem;color:#ff4757;"></i><p style="color:#ff4757;margin-top:10px;">' + err.message + '</p></div>';
-            }
-        }
-    </script>
-</body>
-</html>
-'''
+# Scan static/songs once at startup; requests then only pay for a few directory stats.
+get_catalog()
 
-try:
-    model, input_shape, channels = load_model_info(MODEL_PATH)
-except Exception as e:
-    model = None
-    input_shape = None
-    channels = None
-    print('Warning: could not load model:', e)
+# "More like this": every worker memory-maps the same descriptor matrix, built by similarity.py.
+similarity_index = None
+if config.SIMILARITY_INDEX_DIR:
+    similarity_index = SimilarityIndex(config.SIMILARITY_INDEX_DIR, config.SIMILARITY_EXACT_MAX,
+                                       config.SIMILARITY_NPROBE, config.CATALOG_REFRESH_SECONDS)
 
+# Coalesce concurrent requests (e.g. gunicorn --threads) into batched forward passes.
+# The sidecar already batches across workers, so don't add a second queue in front of it.
+scheduler = None
+if model is not None and config.BATCH_MAX_SIZE > 1 and not config.INFERENCE_SOCKET:
+    scheduler = BatchScheduler(model, config.BATCH_MAX_SIZE, config.BATCH_MAX_WAIT_MS)
 
-@app.route('/')
-def home():
-    return render_template_string(HOME_PAGE)
+prediction_cache = None
+if config.PREDICTION_CACHE_SIZE > 0:
+    prediction_cache = PredictionCache(config.PREDICTION_CACHE_SIZE, config.PREDICTION_CACHE_TTL,
+                                       config.PREDICTION_CACHE_HAMMING)
 
+# Per-stage timings, counters and gauges, merged over all gunicorn workers at /metrics.
+metrics = Metrics(config.METRICS_DIR, config.METRICS_FLUSH_SECONDS)
+metrics.describe('stage_seconds', 'histogram', 'Time spent in each stage of a prediction request')
+metrics.describe('request_seconds', 'histogram', 'Request handling time by endpoint, excluding streamed bodies')
+metrics.describe('http_requests_total', 'counter', 'Requests by endpoint and status code')
+metrics.describe('predictions_total', 'counter', 'Predictions by emotion')
+metrics.describe('errors_total', 'counter', 'Failed or shed requests by error type')
+metrics.describe('model_loaded', 'gauge', 'Workers with a loaded model')
+metrics.describe('inference_pending', 'gauge', 'Admitted inference requests, running or queued')
+metrics.describe('batch_queue_depth', 'gauge', 'Images waiting for the micro-batching scheduler')
+metrics.describe('profiles_saved_total', 'counter', 'Request profiles saved, by reason (sampled or slow)')
+metrics.gauge('model_loaded', lambda: model is not None)
+metrics.gauge('inference_pending', lambda: inference_gate.pending)
+metrics.gauge('batch_queue_depth', lambda: scheduler.queued if scheduler is not None else None)
 
-@app.route('/predict', methods=['POST'])
-def predict():
+# Admission control: per-endpoint body limits, per-client rate limits and a bounded amount of inference work.
+UPLOAD_LIMITS = {
+    'predict': config.MAX_UPLOAD_BYTES,
+    'predict_raw': config.MAX_UPLOAD_BYTES,
+    'predict_batch': config.MAX_BATCH_UPLOAD_BYTES,
+}
+inference_gate = InferenceGate(config.MAX_PENDING_INFERENCES)
+rate_limiter = None
+if config.RATE_LIMIT_PER_SECOND > 0:
+    rate_limiter = RateLimiter(config.RATE_LIMIT_PER_SECOND, config.RATE_LIMIT_BURST)
+admission_stats = AdmissionStats()
+
+# PIL releases the GIL while decoding, so batch uploads are decoded on a small thread pool.
+decode_pool = ThreadPoolExecutor(max_workers=config.DECODE_THREADS, thread_name_prefix='decode')
+
+
+def _shed(reason, status, message, retry_seconds=None):
+    admission_stats.record(reason)
+    metrics.inc('errors_total', type=reason)
+    response = jsonify({'error': message})
+    response.status_code = status
+    if retry_seconds is not None:
+        response.headers['Retry-After'] = retry_after(retry_seconds)
+    return response
+
+
+@app.before_request
+def start_request_timer():
+    g.timer = RequestTimer(metrics)
+
+
+@app.after_request
+def record_request(response):
+    timer = g.get('timer')
+    if timer is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe('request_seconds', time.perf_counter() - timer.started, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+        response.headers['Server-Timing'] = timer.header()
+    return response
+
+
+@app.before_request
+def admit_request():
+    limit = UPLOAD_LIMITS.get(request.endpoint)
+    if limit is None:
+        return None
+    # Also caps bodies without a Content-Length (chunked) while they are read, not just the app-wide maximum
+    request.max_content_length = limit
+    if request.content_length is not None and request.content_length > limit:
+        return _shed('too_large', 413, 'Upload too large (max {} bytes)'.format(limit))
+    if rate_limiter is not None:
+        client = client_address(request.headers.get('X-Forwarded-For'), request.remote_addr, config.TRUST_FORWARDED_FOR)
+        wait = rate_limiter.check(client)
+        if wait:
+            return _shed('rate_limited', 429, 'Too many requests, slow down', wait)
+    if not inference_gate.try_acquire():
+        return _shed('queue_full', 503, 'Server busy, please retry', config.OVERLOAD_RETRY_AFTER)
+    g.inference_slot = True
+    return None
+
+
+@app.teardown_request
+def release_inference_slot(exc):
+    if g.pop('inference_slot', False):
+        inference_gate.release()
+
+
+# Opt-in profiles of sampled and slow prediction requests, listed and downloaded at /admin/profiles.
+profile_store = ProfileStore(config.PROFILE_DIR, config.PROFILE_KEEP) if config.PROFILE_DIR else None
+profiler = None
+if profile_store is not None:
+    profiler = Profiler(profile_store, config.PROFILE_SAMPLE_RATE, config.PROFILE_SLOW_MS / 1000.0,
+                        config.PROFILE_STACK_INTERVAL_MS / 1000.0)
+
+
+@app.before_request
+def start_profile():
+    # Only admitted prediction requests get here
+    if profiler is not None and request.endpoint in UPLOAD_LIMITS:
+        g.profile = profiler.start(request.endpoint)
+
+
+@app.after_request
+def save_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        saved = profiler.finish(profile, response.status_code, g.timer.stages)
+        if saved is not None:
+            profile_id, reason = saved
+            metrics.inc('profiles_saved_total', reason=reason)
+            response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+@app.teardown_request
+def stop_profile(exc):
+    # Requests that raised never reach save_profile
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.stop(profile)
+
+
+def _profile_tag(image=None, **tags):
+    profile = g.get('profile')
+    if profile is not None:
+        if image is not None:
+            profile.image = image
+        profile.tags.update(tags)
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    # Bodies without a Content-Length are cut off by MAX_CONTENT_LENGTH while being read
+    return _shed('too_large', 413, 'Upload too large')
+
+
+def _infer(img_arr):
+    if scheduler is not None:
+        return scheduler.predict(img_arr, timeout=config.INFERENCE_TIMEOUT)
+    return predict_emotion(model, img_arr)
+
+
+def _predict_response(data, decode):
+    """Cache lookup, decode and inference shared by /predict and /predict/raw."""
+    try:
+        emotion, probs, cache_status = predict_upload(data, decode, _infer, prediction_cache, g.timer.stage)
+    except PredictionFailed as e:
+        if e.kind == 'too_many_pixels':
+            admission_stats.record(e.kind)
+        metrics.inc('errors_total', type=e.kind)
+        return jsonify(e.payload), e.status
+
+    metrics.inc('predictions_total', emotion=emotion)
+    _profile_tag(image=data, emotion=emotion, prediction_cache=cache_status)
+    response = jsonify(prediction_payload(emotion, probs, g.timer.stage))
+    response.headers['X-Prediction-Cache'] = cache_status
+    return response
+
+
+def _model_available():
+    """True once the model can serve; until then each call retries reaching the inference sidecar."""
+    global input_shape, channels, home_page
+    if model is None:
+        return False
+    if input_shape is None:
+        shape, depth = model_ready(model, model_status, WARMUP_BATCH_SIZES)
+        if shape is None:
+            return False
+        # channels first: other threads take a non-None input_shape to mean both are set
+        channels = depth
+        input_shape = shape
+        home_page = _render_home_page()
+    return True
+
+
+def _model_unavailable():
+    """The error response while the model can't serve, else None."""
     if model is None:
         return jsonify({'error': 'Model not loaded on server'}), 500
+    if not _model_available():
+        return _shed('model_unavailable', 503, 'Model not ready yet, please retry', config.OVERLOAD_RETRY_AFTER)
+    return None
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    unavailable = _model_unavailable()
+    if unavailable is not None:
+        return unavailable
 
-    if 'image' not in request.files:
+    # Parsing the multipart body is where the upload is read off the socket
+    with g.timer.stage('upload'):
+        data = request.files['image'].read() if 'image' in request.files else None
+    if data is None:
         return jsonify({'error': 'No image file provided (field name: image)'}), 400
 
-    file = request.files['image']
+    return _predict_response(data, lambda data: preprocess_image(io.BytesIO(data), input_shape, channels))
+
+
+@app.route('/predict/raw', methods=['POST'])
+def predict_raw():
+    # Body: uint8 grayscale (or RGB) pixels already downscaled to the model input, see /model-info
+    unavailable = _model_unavailable()
+    if unavailable is not None:
+        return unavailable
+
+    if request.mimetype != 'application/octet-stream':
+        return jsonify({'error': 'Expected an application/octet-stream body of raw pixels'}), 415
+
+    with g.timer.stage('upload'):
+        data = request.get_data(cache=False)
+    if request.content_length is None and len(data) >= request.max_content_length:
+        # Werkzeug ends a chunked body at the limit instead of failing, so one that fills it was cut off
+        return _shed('too_large', 413, 'Upload too large (max {} bytes)'.format(request.max_content_length))
+    return _predict_response(data, lambda data: preprocess_pixels(data, input_shape, channels))
+
+
+def _model_input():
+    """[height, width, channels] a /predict/raw body must have, or None without a (reachable) model."""
+    if input_shape is None:
+        return None
+    return [int(input_shape[0]), int(input_shape[1]), int(channels)]
+
+
+@app.route('/model-info')
+def model_info():
+    _model_available()
+    return jsonify({'input_shape': _model_input()})
+
+
+def _render_home_page():
+    model_input = _model_input()
+    with app.app_context():
+        return Asset(render_template('index.html', asset_url=assets.url,
+                                     live_available=sock is not None and model_input is not None and config.LIVE_MAX_SESSIONS > 0,
+                                     app_config={'model_input': model_input, 'live_fps': config.LIVE_MAX_FPS}
+                                     ).encode(), 'text/html')
+
+
+# The page only depends on the model input, so it is rendered and compressed once (before gunicorn forks), and again
+# when a worker first reaches the inference sidecar.
+assets = AssetBundle(os.path.join(BASE_DIR, 'assets'))
+home_page = _render_home_page()
+
+
+def _asset_response(asset):
+    encoding, body = asset.select(request.accept_encodings)
+    response = Response(body, mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(asset.etag(encoding))
+    return response.make_conditional(request)
+
+
+@app.route('/')
+def home():
+    # The page embeds the model input shape, known once the inference sidecar is reachable
+    _model_available()
+    response = _asset_response(home_page)
+    # Not fingerprinted: revalidate every time, which is a 304 until the page changes
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/assets/<name>')
+def asset(name):
+    """Fingerprinted CSS, JS and icons: content never changes under a URL, so cache it for good."""
+    found = assets.get(name)
+    if found is None:
+        abort(404)
+    response = _asset_response(found)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/similar')
+def similar():
+    """Songs that sound like ``song`` (its URL or its path under static/songs)."""
+    if similarity_index is None:
+        return jsonify({'error': 'Similar-song search is not enabled'}), 404
+    path = song_path(request.args.get('song', ''))
+    k = min(max(request.args.get('k', 5, type=int), 1), 50)
+    matches = similarity_index.similar(path, k)
+    if matches is None:
+        return jsonify({'error': 'Song is not in the similarity index'}), 404
+    catalog = get_catalog()
+    songs = []
+    for match, score in matches:
+        song = catalog.song(match)
+        if song is None:
+            # Indexed songs outside the emotion folders, unless the file is gone since the last update
+            if not os.path.isfile(os.path.join(LOCAL_SONGS_FOLDER, match)):
+                continue
+            song = {'title': os.path.splitext(os.path.basename(match))[0], 'url': song_url(match), 'type': 'local'}
+        songs.append(dict(song, similarity=round(score, 4)))
+    return jsonify({'song': path, 'similar': songs})
+
+
+# Audio downloads can last minutes on a slow connection and live sessions as long as the camera is on; cap how many
+# threads of this worker they may hold, and always leave one for short requests such as /predict.
+thread_slots = ThreadSlots(max(1, config.GUNICORN_THREADS - 1), audio=config.AUDIO_MAX_STREAMS,
+                           live=config.LIVE_MAX_SESSIONS)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class _AudioFile(io.FileIO):
+    """Song file that frees its audio slot once the server has finished sending it and closes it.
+
+    Passthrough file responses bypass Response.call_on_close, but the server always closes the file.
+    """
+
+    def close(self):
+        if not self.closed:
+            thread_slots.release('audio')
+        super().close()
+
+
+@app.route('/audio/<path:filename>')
+def audio(filename):
+    """Local songs, with byte ranges for seeking, strong ETags and long-lived caching.
+
+    Full-file responses go through the server's file wrapper, so gunicorn sends them with sendfile().
+    Versioned URLs (``?v=``, see catalog.song_url) never change content and are cached as immutable.
+    With AUDIO_OFFLOAD the front proxy sends the body instead.
+    """
+    path = safe_join(LOCAL_SONGS_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if config.AUDIO_OFFLOAD:
+        st = os.stat(path)
+        response = Response(mimetype=mimetype)
+        if config.AUDIO_OFFLOAD == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = config.AUDIO_ACCEL_PREFIX + quote(filename)
+        else:
+            response.headers['X-Sendfile'] = path
+        response.set_etag(file_version(st.st_size, st.st_mtime_ns))
+        response.last_modified = st.st_mtime
+        response = response.make_conditional(request)
+    else:
+        if not thread_slots.try_acquire('audio'):
+            return _shed('audio_busy', 503, 'Too many audio downloads in progress', config.OVERLOAD_RETRY_AFTER)
+        try:
+            f = _AudioFile(path)
+        except BaseException:
+            thread_slots.release('audio')
+            raise
+        try:
+            st = os.fstat(f.fileno())
+            # What send_file does for a path, but with our file object: the server's wrapper uses sendfile()
+            response = Response(wrap_file(request.environ, f), mimetype=mimetype, direct_passthrough=True)
+            response.content_length = st.st_size
+            response.set_etag(file_version(st.st_size, st.st_mtime_ns))
+            response.last_modified = st.st_mtime
+            response = response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+        except BaseException:
+            # e.g. 416 for an unsatisfiable Range: the body is never sent, so close (and free the slot) now
+            f.close()
+            raise
+    return _cache_song(response)
+
+
+def _cache_song(response):
+    # Cache headers shared by /audio and /preview
+    response.cache_control.public = True
+    if request.args.get('v'):
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = config.AUDIO_CACHE_SECONDS
+    return response
+
+
+frame_index = FrameIndex(config.PREVIEW_CACHE_SIZE)
+
+
+@app.route('/preview/<path:filename>')
+def preview(filename):
+    """A clip of an MP3 song: ``seconds`` long (default PREVIEW_SECONDS) from ``start`` (seconds, or
+    ``middle``), cut on frame boundaries without decoding.
+
+    Frame offsets are computed once per file and cached, so a clip is one bounded read. The clip's
+    actual start and length are in the X-Preview-Start and X-Preview-Duration headers.
+    """
+    path = safe_join(LOCAL_SONGS_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    seconds = request.args.get('seconds', config.PREVIEW_SECONDS, type=float)
+    seconds = min(config.PREVIEW_MAX_SECONDS, max(1.0, seconds))  # in this order, NaN becomes 1
+    start = request.args.get('start', '0')
+    if start != 'middle':
+        try:
+            start = float(start)
+        except ValueError:
+            start = -1.0
+        if not 0 <= start < math.inf:
+            return jsonify({'error': "start must be a number of seconds or 'middle'"}), 400
+    # A clip still takes a while to send to a slow client, so it holds an audio slot like /audio does
+    if not thread_slots.try_acquire('audio'):
+        return _shed('audio_busy', 503, 'Too many audio downloads in progress', config.OVERLOAD_RETRY_AFTER)
     try:
-        img_arr = preprocess_image(file, input_shape, channels)
-    except Exception as e:
-        return jsonify({'error': 'Failed to preprocess image', 'detail': str(e)}), 400
+        response = _preview_response(path, start, seconds)
+    except BaseException:
+        thread_slots.release('audio')
+        raise
+    response.call_on_close(lambda: thread_slots.release('audio'))
+    return response
+
+
+def _preview_response(path, start, seconds):
+    with open(path, 'rb') as f:
+        table = frame_index.get(path, f)
+        if table is None:
+            return make_response(jsonify({'error': 'Previews are only available for MP3 files'}), 415)
+        if start == 'middle':
+            start = max(0.0, (table.duration - seconds) / 2)
+        clip = table.clip(start, seconds)
+        if clip is None:
+            return make_response(jsonify({'error': 'start is past the end of the song'}), 400)
+        first, end, clip_start, clip_seconds = clip
+        st = os.fstat(f.fileno())
+        body = os.pread(f.fileno(), end - first, first)
+    response = Response(body, mimetype='audio/mpeg')
+    response.set_etag('{}.{:x}-{:x}'.format(file_version(st.st_size, st.st_mtime_ns), first, end))
+    response.last_modified = st.st_mtime
+    response.headers['X-Preview-Start'] = '{:.3f}'.format(clip_start)
+    response.headers['X-Preview-Duration'] = '{:.3f}'.format(clip_seconds)
+    response = response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+    return _cache_song(response)
+
 
+def live(ws):
+    if not _model_available():
+        ws.send(json.dumps({'type': 'error', 'error': 'Model not ready, please try again later'}))
+        return
+    if not thread_slots.try_acquire('live'):
+        ws.send(json.dumps({'type': 'error', 'error': 'Too many live sessions, please try again later'}))
+        return
     try:
-        emotion, probs = predict_emotion(model, img_arr)
-    except Exception as e:
-        return jsonify({'error': 'Model prediction failed', 'detail': str(e)}), 500
+        session = LiveSession(
+            ws,
+            classify=lambda frame: _infer(preprocess_pixels(frame, input_shape, channels)),
+            on_change=lambda emotion, probs: {
+                'recommendations': get_recommendations(emotion),
+                'local_songs': get_local_songs(emotion, probs)
+            },
+            max_fps=config.LIVE_MAX_FPS,
+            smoother=EmotionSmoother(config.LIVE_SMOOTHING, config.LIVE_SWITCH_MARGIN))
+        session.run()
+    finally:
+        thread_slots.release('live')
+
+
+if sock is not None:
+    sock.route('/live')(live)
+
+
+def _batch_uploads():
+    """Yield (name, bytes) for every image in a /predict/batch request, or (name, error)."""
+    uploads = request.files.getlist('images') + request.files.getlist('image')
+    for file in uploads:
+        yield file.filename or 'image', file.read()
+    if 'archive' in request.files:
+        try:
+            archive = zipfile.ZipFile(request.files['archive'].stream)
+        except zipfile.BadZipFile as e:
+            yield request.files['archive'].filename or 'archive', e
+            return
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if info.file_size > config.BATCH_ENDPOINT_MAX_ENTRY_BYTES:
+                    yield info.filename, ValueError('Archive entry is too large')
+                    continue
+                yield info.filename, archive.read(info)
+
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    unavailable = _model_unavailable()
+    if unavailable is not None:
+        return unavailable
+
+    items = []
+    with g.timer.stage('upload'):
+        for name, data in _batch_uploads():
+            if len(items) >= config.BATCH_ENDPOINT_MAX_IMAGES:
+                return jsonify({'error': 'Too many images (max {})'.format(config.BATCH_ENDPOINT_MAX_IMAGES)}), 413
+            items.append((name, data))
+    if not items:
+        return jsonify({'error': 'No images provided (fields: images, archive)'}), 400
+    _profile_tag(images=len(items), image_bytes=sum(len(data) for _, data in items if isinstance(data, bytes)))
+
+    # Every image is decoded straight into its row of one preallocated batch tensor.
+    batch = np.empty((len(items), input_shape[0], input_shape[1], channels), dtype='float32')
+
+    def decode(i, data):
+        if isinstance(data, Exception):
+            raise data
+        preprocess_image(io.BytesIO(data), input_shape, channels, out=batch[i])
 
-    recs = get_recommendations(emotion)
-    local_songs = get_local_songs(emotion)
+    futures = [decode_pool.submit(decode, i, data) for i, (_, data) in enumerate(items)]
+    results = [None] * len(items)
+    decoded = []
+    with g.timer.stage('decode'):
+        for i, future in enumerate(futures):
+            try:
+                future.result()
+                decoded.append(i)
+            except Exception as e:
+                metrics.inc('errors_total', type='bad_image')
+                results[i] = {'error': 'Failed to preprocess image', 'detail': str(e)}
 
+    if decoded:
+        try:
+            with g.timer.stage('infer'):
+                predictions = predict_emotions(model, batch if len(decoded) == len(items) else batch[decoded])
+        except Exception as e:
+            predictions = [e] * len(decoded)
+        for i, prediction in zip(decoded, predictions):
+            if isinstance(prediction, Exception):
+                metrics.inc('errors_total', type='model_error')
+                results[i] = {'error': 'Model prediction failed', 'detail': str(prediction)}
+            else:
+                metrics.inc('predictions_total', emotion=prediction[0])
+                results[i] = prediction
+
+    def generate():
+        for i, ((name, _), result) in enumerate(zip(items, results)):
+            line = {'index': i, 'name': name}
+            if isinstance(result, dict):
+                line.update(result)
+            else:
+                emotion, probs = result
+                line.update({
+                    'emotion': emotion,
+                    'probabilities': probs,
+                    'recommendations': get_recommendations(emotion),
+                    'local_songs': get_local_songs(emotion, probs)
+                })
+            yield json.dumps(line) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/healthz')
+def healthz():
+    # Liveness: the process is up and serving, whatever the model state.
+    return jsonify(dict(model_status, status='ok', pid=os.getpid()))
+
+
+@app.route('/readyz')
+def readyz():
+    # Readiness: only route traffic here once the model is loaded and warm.
+    ready = _model_available() and model_status['warmed_up']
+    return jsonify(dict(model_status, ready=ready, pid=os.getpid())), 200 if ready else 503
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text format, totals over every worker of this server."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _check_admin():
+    """404 without an ADMIN_TOKEN, 401 unless the request carries it as a bearer token."""
+    if not config.ADMIN_TOKEN:
+        abort(404)
+    expected = 'Bearer {}'.format(config.ADMIN_TOKEN).encode()
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+        response = jsonify({'error': 'Admin token required'})
+        response.status_code = 401
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        abort(response)
+
+
+@app.route('/admin/profiles')
+def list_profiles():
+    """Saved request profiles of every worker, newest first."""
+    _check_admin()
     return jsonify({
-        'emotion': emotion, 
-        'probabilities': probs, 
-        'recommendations': recs,
-        'local_songs': local_songs
+        'enabled': profiler is not None,
+        'profiles': profile_store.list() if profile_store is not None else [],
+    })
+
+
+@app.route('/admin/profiles/<profile_id>.<kind>')
+def download_profile(profile_id, kind):
+    """One file of a saved profile: .json metadata, .folded stacks or .pstats (cProfile)."""
+    _check_admin()
+    path = profile_store.path(profile_id, kind) if profile_store is not None else None
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype=PROFILE_KINDS[kind], as_attachment=kind != 'json',
+                         download_name='{}.{}'.format(profile_id, kind))
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/stats')
+def stats():
+    merged = metrics.collect()
+    return jsonify({
+        'latency_ms': {
+            'stages': metrics.quantiles('stage_seconds', 'stage', merged),
+            'endpoints': metrics.quantiles('request_seconds', 'endpoint', merged),
+        },
+        'batching': scheduler.stats.snapshot() if scheduler is not None else None,
+        'cache': prediction_cache.stats() if prediction_cache is not None else None,
+        'admission': {
+            'pending': inference_gate.pending,
+            'peak_pending': inference_gate.peak,
+            'max_pending': inference_gate.max_pending,
+            'admitted': inference_gate.admitted,
+            'shed': admission_stats.snapshot()
+        }
     })
 
 
@@ -0,0 +1,362 @@
+"""ASGI entry point: the page, /predict and songs served from an event loop.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000 --workers 2
+
+Under gunicorn (app.py) a slow upload or a song download holds a worker thread for as long as the
+client takes. Here uploads are read and songs sent by the event loop, and only decoding, inference and
+song ranking (service.py, shared with app.py) run on a pool of ASGI_THREADS threads. One process then
+keeps thousands of slow or idle connections open while its threads stay busy on inference. At most
+MAX_PENDING_INFERENCES predictions are admitted at once; beyond that /predict sheds with 503.
+
+Served: /, /assets/, /model-info, /predict, /predict/raw, /audio/, /healthz and /readyz. Previews,
+similar songs, batches, live mode, metrics and profiles are only in app.py.
+"""
+import asyncio
+import io
+import json
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from werkzeug.http import http_date, parse_accept_header, parse_etags, parse_options_header, parse_range_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+from werkzeug.security import safe_join
+
+from recommend import preprocess_image, preprocess_pixels, predict_emotion, get_catalog, LOCAL_SONGS_FOLDER
+from admission import InferenceGate, RateLimiter, client_address, retry_after
+from assets import ASSETS_URL_PREFIX, Asset, AssetBundle
+from cache import PredictionCache
+from catalog import SONGS_URL_PREFIX, file_version
+from service import PredictionFailed, load_model, model_ready, predict_upload, prediction_payload
+import config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Song bodies are read from disk on the thread pool and sent in chunks of this size
+AUDIO_CHUNK_BYTES = 256 * 1024
+
+# With the inference sidecar, input_shape and channels stay None until it is reachable: see model_available.
+model, input_shape, channels, model_status = load_model()
+
+get_catalog()
+
+executor = ThreadPoolExecutor(max_workers=config.ASGI_THREADS, thread_name_prefix='asgi-work')
+inference_gate = InferenceGate(config.MAX_PENDING_INFERENCES)
+rate_limiter = None
+if config.RATE_LIMIT_PER_SECOND > 0:
+    rate_limiter = RateLimiter(config.RATE_LIMIT_PER_SECOND, config.RATE_LIMIT_BURST)
+prediction_cache = None
+if config.PREDICTION_CACHE_SIZE > 0:
+    prediction_cache = PredictionCache(config.PREDICTION_CACHE_SIZE, config.PREDICTION_CACHE_TTL,
+                                       config.PREDICTION_CACHE_HAMMING)
+
+
+def _model_input():
+    if input_shape is None:
+        return None
+    return [int(input_shape[0]), int(input_shape[1]), int(channels)]
+
+
+async def _model_available():
+    """True once the model can serve; until then each call retries reaching the inference sidecar."""
+    global input_shape, channels, home_page
+    if model is None:
+        return False
+    if input_shape is None:
+        # Connecting blocks, so it runs on the thread pool
+        shape, depth = await asyncio.get_running_loop().run_in_executor(executor, model_ready, model, model_status)
+        if shape is None:
+            return False
+        channels = depth
+        input_shape = shape
+        home_page = _render_home_page()
+    return True
+
+
+# Same page as app.py, without live mode (no WebSockets here).
+assets = AssetBundle(os.path.join(BASE_DIR, 'assets'))
+_templates = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, 'templates')),
+                         autoescape=select_autoescape(['html']))
+
+
+def _render_home_page():
+    return Asset(_templates.get_template('index.html').render(
+        asset_url=assets.url, live_available=False,
+        app_config={'model_input': _model_input(), 'live_fps': config.LIVE_MAX_FPS}).encode(), 'text/html; charset=utf-8')
+
+
+home_page = _render_home_page()
+
+
+class Request:
+    """The parts of an ASGI HTTP scope the handlers use."""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = self.headers[name] + ', ' + value if name in self.headers else value
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        client = scope.get('client')
+        self.client = client_address(self.headers.get('x-forwarded-for'), client[0] if client else None,
+                                     config.TRUST_FORWARDED_FOR)
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def read_body(request, limit):
+    """The whole request body, received without blocking; BodyTooLarge past ``limit`` bytes."""
+    if int(request.headers.get('content-length') or 0) > limit:
+        raise BodyTooLarge()
+    chunks = []
+    size = 0
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def multipart_file(body, content_type, field):
+    """Bytes of the file uploaded as ``field`` in a multipart/form-data body, or None."""
+    mimetype, options = parse_options_header(content_type)
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        return None
+    decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+    decoder.receive_data(body)
+    decoder.receive_data(None)
+    parts = None
+    current = False
+    while True:
+        try:
+            event = decoder.next_event()
+        except ValueError:
+            # Malformed body
+            return None
+        if isinstance(event, (NeedData, Epilogue)):
+            return b''.join(parts) if parts is not None else None
+        if isinstance(event, File):
+            current = event.name == field and parts is None
+            if current:
+                parts = []
+        elif isinstance(event, Data):
+            if current:
+                parts.append(event.data)
+        else:
+            current = False
+
+
+async def respond(request, send, status, body=b'', headers=None):
+    headers = dict(headers or {})
+    headers['Content-Length'] = str(len(body))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(k.encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]})
+    await send({'type': 'http.response.body', 'body': b'' if request.method == 'HEAD' else body})
+
+
+async def respond_json(request, send, payload, status=200, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    await respond(request, send, status, json.dumps(payload).encode(), headers)
+
+
+def _infer(img_arr):
+    return predict_emotion(model, img_arr)
+
+
+def _decode_image(data):
+    return preprocess_image(io.BytesIO(data), input_shape, channels)
+
+
+def _decode_pixels(data):
+    return preprocess_pixels(data, input_shape, channels)
+
+
+def _predict(data, decode):
+    """(status, payload, cache status) of one prediction; runs on the thread pool."""
+    try:
+        emotion, probs, cache_status = predict_upload(data, decode, _infer, prediction_cache)
+    except PredictionFailed as e:
+        return e.status, e.payload, None
+    return 200, prediction_payload(emotion, probs), cache_status
+
+
+async def predict(request, send, raw=False):
+    if request.method != 'POST':
+        return await respond_json(request, send, {'error': 'Method not allowed'}, 405, {'Allow': 'POST'})
+    if model is None:
+        return await respond_json(request, send, {'error': 'Model not loaded on server'}, 500)
+    if not await _model_available():
+        return await respond_json(request, send, {'error': 'Model not ready yet, please retry'}, 503,
+                                  {'Retry-After': retry_after(config.OVERLOAD_RETRY_AFTER)})
+    if raw and parse_options_header(request.headers.get('content-type', ''))[0] != 'application/octet-stream':
+        return await respond_json(request, send,
+                                  {'error': 'Expected an application/octet-stream body of raw pixels'}, 415)
+    if rate_limiter is not None:
+        wait = rate_limiter.check(request.client)
+        if wait:
+            return await respond_json(request, send, {'error': 'Too many requests, slow down'}, 429,
+                                      {'Retry-After': retry_after(wait)})
+
+    # Reading the body only waits on the client, so it happens before taking an inference slot
+    try:
+        body = await read_body(request, config.MAX_UPLOAD_BYTES)
+    except BodyTooLarge:
+        return await respond_json(request, send,
+                                  {'error': 'Upload too large (max {} bytes)'.format(config.MAX_UPLOAD_BYTES)}, 413)
+    if raw:
+        data = body
+        decode = _decode_pixels
+    else:
+        data = multipart_file(body, request.headers.get('content-type', ''), 'image')
+        if data is None:
+            return await respond_json(request, send, {'error': 'No image file provided (field name: image)'}, 400)
+        decode = _decode_image
+
+    if not inference_gate.try_acquire():
+        return await respond_json(request, send, {'error': 'Server busy, please retry'}, 503,
+                                  {'Retry-After': retry_after(config.OVERLOAD_RETRY_AFTER)})
+    try:
+        status, payload, cache_status = await asyncio.get_running_loop().run_in_executor(
+            executor, _predict, data, decode)
+    finally:
+        inference_gate.release()
+    headers = {'X-Prediction-Cache': cache_status} if cache_status else None
+    await respond_json(request, send, payload, status, headers)
+
+
+async def send_asset(request, send, asset, cache_control):
+    accept = parse_accept_header(request.headers.get('accept-encoding'))
+    encoding, body = asset.select(accept)
+    etag = '"{}"'.format(asset.etag(encoding))
+    headers = {'Content-Type': asset.mimetype, 'Vary': 'Accept-Encoding', 'ETag': etag,
+               'Cache-Control': cache_control}
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    if parse_etags(request.headers.get('if-none-match')).contains(asset.etag(encoding)):
+        headers.pop('Content-Type')
+        headers.pop('Content-Encoding', None)
+        return await respond(request, send, 304, b'', headers)
+    await respond(request, send, 200, body, headers)
+
+
+async def audio(request, send, filename):
+    """Local songs with byte ranges and ETags, like app.py's /audio; the body is sent in chunks."""
+    path = safe_join(LOCAL_SONGS_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        return await respond_json(request, send, {'error': 'Not found'}, 404)
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = file_version(size, st.st_mtime_ns)
+        headers = {
+            'Content-Type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'Accept-Ranges': 'bytes',
+            'ETag': '"{}"'.format(etag),
+            'Last-Modified': http_date(st.st_mtime),
+            'Cache-Control': ('public, max-age={}, immutable'.format(IMMUTABLE_MAX_AGE) if request.args.get('v')
+                              else 'public, max-age={}'.format(config.AUDIO_CACHE_SECONDS)),
+        }
+        if parse_etags(request.headers.get('if-none-match')).contains(etag):
+            headers.pop('Content-Type')
+            return await respond(request, send, 304, b'', headers)
+
+        start, stop, status = 0, size, 200
+        if_range = request.headers.get('if-range')
+        byte_range = parse_range_header(request.headers.get('range'))
+        if byte_range is not None and (if_range is None or parse_etags(if_range).contains(etag)):
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                headers['Content-Range'] = 'bytes */{}'.format(size)
+                return await respond(request, send, 416, b'', headers)
+            start, stop = bounds
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+
+        headers['Content-Length'] = str(stop - start)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]})
+        if request.method == 'HEAD':
+            return await send({'type': 'http.response.body', 'body': b''})
+        position = start
+        while position < stop:
+            chunk = await loop.run_in_executor(None, os.pread, f.fileno(),
+                                               min(AUDIO_CHUNK_BYTES, stop - position), position)
+            if not chunk:
+                break
+            position += len(chunk)
+            # Waits here while the client is slow to read; nothing else is held meanwhile
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': position < stop})
+        if position < stop:
+            # File shrank under us
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        # e.g. the live-mode WebSocket, which only app.py serves
+        return await send({'type': 'websocket.close', 'code': 1000})
+    request = Request(scope, receive)
+    path = request.path
+    try:
+        if path in ('/predict', '/predict/raw'):
+            return await predict(request, send, raw=path == '/predict/raw')
+        if request.method not in ('GET', 'HEAD'):
+            return await respond_json(request, send, {'error': 'Method not allowed'}, 405, {'Allow': 'GET, HEAD'})
+        if path == '/':
+            # The page embeds the model input shape, known once the inference sidecar is reachable
+            await _model_available()
+            # Not fingerprinted: revalidate every time
+            return await send_asset(request, send, home_page, 'no-cache')
+        if path.startswith(ASSETS_URL_PREFIX):
+            asset = assets.get(path[len(ASSETS_URL_PREFIX):])
+            if asset is not None:
+                return await send_asset(request, send, asset,
+                                        'public, max-age={}, immutable'.format(IMMUTABLE_MAX_AGE))
+        elif path.startswith(SONGS_URL_PREFIX):
+            return await audio(request, send, path[len(SONGS_URL_PREFIX):])
+        elif path == '/model-info':
+            await _model_available()
+            return await respond_json(request, send, {'input_shape': _model_input()})
+        elif path == '/healthz':
+            return await respond_json(request, send, dict(model_status, status='ok', pid=os.getpid()))
+        elif path == '/readyz':
+            ready = await _model_available() and model_status['warmed_up']
+            return await respond_json(request, send, dict(model_status, ready=ready, pid=os.getpid()),
+                                      200 if ready else 503)
+        await respond_json(request, send, {'error': 'Not found'}, 404)
+    except ClientDisconnected:
+        pass
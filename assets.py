@@ -0,0 +1,75 @@
+"""Front-end assets, fingerprinted and precompressed once at startup.
+
+Each file in assets/ is served under a name that includes a hash of its content
+(app.css -> app.1f3a9c0e52b7.css), so browsers can cache it as immutable. Every asset is
+compressed ahead of time with gzip and, when the brotli package is installed, brotli, so a
+request only picks one of the stored bodies.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:  # optional: assets are then served gzip-compressed only
+    brotli = None
+
+ASSETS_URL_PREFIX = '/assets/'
+
+# Preferred first; identity is always available.
+ENCODINGS = ('br', 'gzip')
+
+
+class Asset:
+    """One asset's bodies by content encoding, with a strong content hash for ETags."""
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.blake2b(body, digest_size=6).hexdigest()
+        self.bodies = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            # Tiny files can grow when compressed
+            if len(data) < len(body):
+                self.bodies[encoding] = data
+
+    def select(self, accept_encodings):
+        """(encoding, body) to send for a request's Accept-Encoding header values."""
+        for encoding in ENCODINGS:
+            if encoding in self.bodies and accept_encodings[encoding]:
+                return encoding, self.bodies[encoding]
+        return 'identity', self.bodies['identity']
+
+    def etag(self, encoding):
+        # Each representation gets its own strong ETag
+        return self.digest if encoding == 'identity' else '{}.{}'.format(self.digest, encoding)
+
+
+class AssetBundle:
+    """Every file in ``directory``, by fingerprinted name."""
+
+    def __init__(self, directory):
+        self._assets = {}
+        self._urls = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                body = f.read()
+            asset = Asset(body, mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            stem, ext = os.path.splitext(name)
+            fingerprinted = '{}.{}{}'.format(stem, asset.digest, ext)
+            self._assets[fingerprinted] = asset
+            self._urls[name] = ASSETS_URL_PREFIX + fingerprinted
+
+    def url(self, name):
+        """Public URL of the asset file ``name``, for templates."""
+        return self._urls[name]
+
+    def get(self, fingerprinted):
+        """The Asset served as ``fingerprinted``, or None."""
+        return self._assets.get(fingerprinted)
@@ -0,0 +1,361 @@
+// Server-side settings, rendered into the page (templates/index.html)
+const APP_CONFIG = JSON.parse(document.getElementById('app-config').textContent);
+
+let stream = null;
+const video = document.getElementById('video');
+const canvas = document.getElementById('canvas');
+const placeholder = document.getElementById('cameraPlaceholder');
+
+const emotionEmojis = {
+    'Happy': '😊', 'Sad': '😢', 'Angry': '😠', 'Fear': '😨',
+    'Surprise': '😲', 'Disgust': '🤢', 'Neutral': '😐'
+};
+
+function switchTab(tab) {
+    document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
+    document.querySelectorAll('.tab-content').forEach(t => t.classList.remove('active'));
+    if (tab === 'camera') {
+        document.querySelector('.tab:nth-child(1)').classList.add('active');
+        document.getElementById('camera-tab').classList.add('active');
+    } else {
+        document.querySelector('.tab:nth-child(2)').classList.add('active');
+        document.getElementById('upload-tab').classList.add('active');
+    }
+}
+
+async function startCamera() {
+    try {
+        stream = await navigator.mediaDevices.getUserMedia({ 
+            video: { facingMode: 'user', width: 640, height: 480 }, audio: false 
+        });
+        video.srcObject = stream;
+        video.style.display = 'block';
+        placeholder.style.display = 'none';
+    } catch (err) {
+        alert('Could not access camera: ' + err.message);
+    }
+}
+
+function stopCamera() {
+    stopLive();
+    if (stream) {
+        stream.getTracks().forEach(track => track.stop());
+        stream = null;
+        video.style.display = 'none';
+        placeholder.style.display = 'flex';
+    }
+}
+
+// [height, width, channels] of the model input, or null if the server has no model loaded
+const MODEL_INPUT = APP_CONFIG.model_input;
+
+function capturePixels() {
+    // Downscale on the canvas and send raw uint8 pixels: a few KB instead of a full-size JPEG
+    const [h, w, c] = MODEL_INPUT;
+    canvas.width = w;
+    canvas.height = h;
+    const ctx = canvas.getContext('2d', { willReadFrequently: true });
+    ctx.imageSmoothingQuality = 'high';
+    ctx.drawImage(video, 0, 0, w, h);
+    const rgba = ctx.getImageData(0, 0, w, h).data;
+    const pixels = new Uint8Array(w * h * c);
+    for (let i = 0, j = 0; i < rgba.length; i += 4) {
+        if (c === 1) {
+            // Same integer luma formula as PIL's convert('L')
+            pixels[j++] = (rgba[i] * 19595 + rgba[i + 1] * 38470 + rgba[i + 2] * 7471 + 0x8000) >> 16;
+        } else {
+            pixels[j++] = rgba[i]; pixels[j++] = rgba[i + 1]; pixels[j++] = rgba[i + 2];
+        }
+    }
+    return pixels;
+}
+
+async function captureAndPredict() {
+    if (!stream) { alert('Please start the camera first'); return; }
+    if (MODEL_INPUT) {
+        await sendPrediction(capturePixels(), '/predict/raw', { 'Content-Type': 'application/octet-stream' });
+        return;
+    }
+    canvas.width = video.videoWidth;
+    canvas.height = video.videoHeight;
+    canvas.getContext('2d').drawImage(video, 0, 0);
+
+    canvas.toBlob(async (blob) => {
+        const formData = new FormData();
+        formData.append('image', blob, 'capture.jpg');
+        await sendPrediction(formData);
+    }, 'image/jpeg', 0.9);
+}
+
+document.getElementById('imageInput').onchange = function(e) {
+    const preview = document.getElementById('preview');
+    if (e.target.files.length) {
+        preview.src = URL.createObjectURL(e.target.files[0]);
+        preview.style.display = 'block';
+    }
+};
+
+async function predictFromFile() {
+    const input = document.getElementById('imageInput');
+    if (!input.files.length) { alert('Please select an image first'); return; }
+    const formData = new FormData();
+    formData.append('image', input.files[0]);
+    await sendPrediction(formData);
+}
+
+let currentAudio = null;
+let currentPlayingItem = null;
+
+function playLocalSong(url, title, element) {
+    // Stop current audio if playing
+    if (currentAudio) {
+        currentAudio.pause();
+        if (currentPlayingItem) {
+            currentPlayingItem.querySelector('.play-icon').classList.remove('playing');
+            currentPlayingItem.querySelector('.play-icon i').className = 'fas fa-play';
+        }
+    }
+
+    // Update audio player
+    const audioElement = document.getElementById('audioElement');
+    const trackTitle = document.getElementById('trackTitle');
+    const audioPlayer = document.getElementById('audioPlayer');
+
+    // MP3s start from a short preview clip; the full file only loads if the clip plays to the end
+    const preview = previewUrl(url);
+    audioElement.src = preview || url;
+    audioElement.dataset.fullUrl = preview ? url : '';
+    audioElement.onerror = function() {
+        if (audioElement.dataset.fullUrl) continueFullTrack(audioElement, 0);
+    };
+    trackTitle.textContent = title;
+    audioPlayer.style.display = 'block';
+    audioElement.play();
+
+    currentAudio = audioElement;
+    currentPlayingItem = element;
+
+    // Update play icon
+    element.querySelector('.play-icon').classList.add('playing');
+    element.querySelector('.play-icon i').className = 'fas fa-pause';
+
+    // Handle audio end
+    audioElement.onended = function() {
+        if (audioElement.dataset.fullUrl) {
+            continueFullTrack(audioElement, audioElement.duration);
+            return;
+        }
+        element.querySelector('.play-icon').classList.remove('playing');
+        element.querySelector('.play-icon i').className = 'fas fa-play';
+        currentPlayingItem = null;
+    };
+
+    audioElement.onpause = function() {
+        if (currentPlayingItem) {
+            currentPlayingItem.querySelector('.play-icon').classList.remove('playing');
+            currentPlayingItem.querySelector('.play-icon i').className = 'fas fa-play';
+        }
+    };
+
+    audioElement.onplay = function() {
+        if (currentPlayingItem) {
+            currentPlayingItem.querySelector('.play-icon').classList.add('playing');
+            currentPlayingItem.querySelector('.play-icon i').className = 'fas fa-pause';
+        }
+    };
+
+    loadSimilar(url);
+}
+
+function previewUrl(url) {
+    const [path, query] = url.split('?');
+    if (!path.startsWith('/audio/') || !path.toLowerCase().endsWith('.mp3')) return null;
+    return '/preview/' + path.slice('/audio/'.length) + (query ? '?' + query : '');
+}
+
+function continueFullTrack(audioElement, position) {
+    const url = audioElement.dataset.fullUrl;
+    audioElement.dataset.fullUrl = '';
+    audioElement.src = url;
+    audioElement.addEventListener('loadedmetadata', () => { audioElement.currentTime = position || 0; }, { once: true });
+    audioElement.play();
+}
+
+// "More like this" under the player; silently absent when the server has no similarity index
+async function loadSimilar(url) {
+    const container = document.getElementById('similarSongs');
+    if (!container) return;
+    container.innerHTML = '';
+    let data;
+    try {
+        const response = await fetch('/similar?song=' + encodeURIComponent(url));
+        if (!response.ok) return;
+        data = await response.json();
+    } catch (err) {
+        return;
+    }
+    if (!data.similar || data.similar.length === 0) return;
+    const heading = document.createElement('p');
+    heading.className = 'playlists-title';
+    heading.innerHTML = '<i class="fas fa-wave-square"></i> More like this';
+    container.appendChild(heading);
+    data.similar.forEach(song => {
+        const item = document.createElement('div');
+        item.className = 'playlist-item';
+        item.innerHTML = '<div class="play-icon local"><i class="fas fa-play"></i></div>' +
+            '<div class="playlist-info"><h4></h4><p></p></div>';
+        // Titles come from file tags: set them as text, never as HTML
+        item.querySelector('h4').textContent = song.title;
+        item.querySelector('p').textContent = song.artist || 'Local Music';
+        item.onclick = () => playLocalSong(song.url, song.title, item);
+        container.appendChild(item);
+    });
+}
+
+function renderResult(data, subtitle) {
+    const resultDiv = document.getElementById('result');
+    resultDiv.style.display = 'block';
+    const emoji = emotionEmojis[data.emotion] || '🎵';
+    let html = `
+        <div class="result-header">
+            <div class="emotion-icon" id="emotionIcon">${emoji}</div>
+            <div class="emotion-text">
+                <h2 id="emotionLabel">${data.emotion}</h2>
+                <p>${subtitle}</p>
+            </div>
+        </div>
+    `;
+
+    // Local Songs Section
+    html += `<p class="playlists-title"><i class="fas fa-folder-open"></i> Your Local Songs</p>`;
+    resultDiv.innerHTML = html;
+
+    if (data.local_songs && data.local_songs.length > 0) {
+        data.local_songs.forEach((song, idx) => {
+            const item = document.createElement('div');
+            item.className = 'playlist-item';
+            item.id = `local-song-${idx}`;
+            item.innerHTML = '<div class="play-icon local"><i class="fas fa-play"></i></div>' +
+                '<div class="playlist-info"><h4></h4><p></p></div>' +
+                '<i class="fas fa-music arrow"></i>';
+            // Titles and artists come from file tags: set them as text, never as HTML
+            item.querySelector('h4').textContent = song.title;
+            item.querySelector('p').textContent = song.artist || 'Local Music';
+            item.onclick = () => playLocalSong(song.url, song.title, item);
+            resultDiv.appendChild(item);
+        });
+
+        // Audio Player
+        resultDiv.insertAdjacentHTML('beforeend', `
+            <div class="audio-player" id="audioPlayer" style="display:none;">
+                <div class="audio-player-header">
+                    <div class="now-playing-icon"><i class="fas fa-music"></i></div>
+                    <div class="track-info">
+                        <h4 id="trackTitle">Select a song</h4>
+                        <p>Now Playing</p>
+                    </div>
+                </div>
+                <audio id="audioElement" controls></audio>
+                <div class="similar-songs" id="similarSongs"></div>
+            </div>
+        `);
+    } else {
+        resultDiv.insertAdjacentHTML('beforeend', `
+            <div class="no-local-songs">
+                <i class="fas fa-folder-plus"></i>
+                <p>No local songs found. Add MP3 files to:</p>
+                <p><code>static/songs/</code></p>
+                <p style="margin-top:8px;font-size:0.8rem;">Tip: Create subfolders like <code>happy/</code>, <code>sad/</code> for emotion-specific songs</p>
+            </div>
+        `);
+    }
+
+    // Spotify Section
+    resultDiv.insertAdjacentHTML('beforeend', `
+        <div class="section-divider"></div>
+        <p class="playlists-title"><i class="fas fa-headphones"></i> Spotify Playlists</p>
+    `);
+
+    data.recommendations.forEach(r => {
+        const link = document.createElement('a');
+        link.href = r.url;
+        link.target = '_blank';
+        link.className = 'playlist-item';
+        link.innerHTML = '<div class="play-icon"><i class="fas fa-play"></i></div>' +
+            '<div class="playlist-info"><h4></h4><p>Spotify Playlist</p></div>' +
+            '<i class="fas fa-external-link-alt arrow"></i>';
+        link.querySelector('h4').textContent = r.title;
+        resultDiv.appendChild(link);
+    });
+}
+
+// Live mode: stream downscaled frames over a WebSocket and show the server's smoothed estimate
+const LIVE_FPS = APP_CONFIG.live_fps;
+let liveSocket = null;
+let liveTimer = null;
+
+function toggleLive() {
+    if (liveSocket) { stopLive(); return; }
+    if (!stream) { alert('Please start the camera first'); return; }
+    const proto = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    liveSocket = new WebSocket(`${proto}//${location.host}/live`);
+    liveSocket.onopen = () => {
+        liveSocket.send(JSON.stringify({ fps: LIVE_FPS }));
+        liveTimer = setInterval(() => {
+            // Skip a frame rather than queue it while the previous one is still uploading
+            if (liveSocket && liveSocket.readyState === WebSocket.OPEN && liveSocket.bufferedAmount === 0) {
+                liveSocket.send(capturePixels());
+            }
+        }, 1000 / LIVE_FPS);
+    };
+    liveSocket.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === 'error') {
+            showError(data.error);
+        } else if (data.changed || !document.getElementById('emotionLabel')) {
+            // Only rebuild the song lists when the smoothed emotion changes, so playback continues
+            renderResult(data, 'Live estimate from your camera');
+        } else {
+            document.getElementById('emotionLabel').textContent = data.emotion;
+            document.getElementById('emotionIcon').textContent = emotionEmojis[data.emotion] || '🎵';
+        }
+    };
+    liveSocket.onclose = () => stopLive();
+    document.querySelector('#liveButton span').textContent = 'Stop Live';
+}
+
+function stopLive() {
+    if (liveTimer) { clearInterval(liveTimer); liveTimer = null; }
+    if (liveSocket) {
+        const socket = liveSocket;
+        liveSocket = null;
+        socket.close();
+    }
+    const label = document.querySelector('#liveButton span');
+    if (label) label.textContent = 'Go Live';
+}
+
+function showError(message) {
+    const resultDiv = document.getElementById('result');
+    resultDiv.style.display = 'block';
+    resultDiv.innerHTML = '<div class="loading"><i class="fas fa-exclamation-circle" style="font-size:2rem;color:#ff4757;"></i><p style="color:#ff4757;margin-top:10px;">' + message + '</p></div>';
+}
+
+async function sendPrediction(body, url = '/predict', headers = {}) {
+    const resultDiv = document.getElementById('result');
+    resultDiv.innerHTML = '<div class="loading"><div class="spinner"></div><p>Analyzing your emotion...</p></div>';
+    resultDiv.style.display = 'block';
+
+    try {
+        const res = await fetch(url, { method: 'POST', body: body, headers: headers });
+        const data = await res.json();
+        if (data.error) {
+            showError(data.error);
+            return;
+        }
+
+        renderResult(data, 'Detected emotion from your photo');
+    } catch (err) {
+        showError(err.message);
+    }
+}
@@ -0,0 +1,402 @@
+"""Automatic emotion tags for local songs, computed from cheap audio features.
+
+Each track is decoded to mono PCM in streamed chunks: ffmpeg for compressed formats, the wave module
+for .wav. The chunks are reduced to RMS energy, spectral centroid, onset rate, tempo and a
+major/minor mode estimate. A small valence/arousal model maps those to the seven emotion labels.
+Results are cached in SQLite by content hash, so copied or renamed files are not decoded again.
+Files are analysed in parallel across CPU cores.
+
+    python audio_tagger.py                  # tag new or changed songs
+    python audio_tagger.py --show           # print every song's top emotion
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from song_index import walk_songs
+
+SAMPLE_RATE = 22050
+FRAME = 2048
+HOP = 512
+CHUNK_SECONDS = 10
+# Bumped when FeatureExtractor.result gains or changes fields; older cached entries are re-analysed.
+FEATURES_VERSION = 2
+# Log-spaced bands (Hz) for the coarse spectral envelope used as a timbre descriptor
+BAND_EDGES = np.geomspace(60, 8000, 17)
+
+# Valence/arousal of each label on the circumplex model of affect, both in [-1, 1].
+EMOTION_PROTOTYPES = {
+    'Angry': (-0.6, 0.8),
+    'Disgust': (-0.6, -0.1),
+    'Fear': (-0.7, 0.4),
+    'Happy': (0.8, 0.5),
+    'Sad': (-0.6, -0.7),
+    'Surprise': (0.4, 0.9),
+    'Neutral': (0.2, -0.6),
+}
+
+# Krumhansl-Kessler key profiles, tonic first.
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+CREATE TABLE IF NOT EXISTS tags (
+    digest TEXT PRIMARY KEY,
+    features TEXT NOT NULL,
+    probabilities TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+'''
+
+
+def content_digest(path):
+    """blake2b of the file contents, read in 1 MiB blocks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _pcm_to_float(data, width):
+    if width == 1:
+        return (np.frombuffer(data, np.uint8).astype(np.float32) - 128.0) / 128.0
+    if width == 3:
+        b = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        x = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        return (np.where(x >= 1 << 23, x - (1 << 24), x)).astype(np.float32) / float(1 << 23)
+    return np.frombuffer(data, '<i{}'.format(width)).astype(np.float32) / float(1 << (8 * width - 1))
+
+
+def _wav_chunks(wav, chunk_seconds):
+    with wav:
+        channels, width = wav.getnchannels(), wav.getsampwidth()
+        while True:
+            data = wav.readframes(wav.getframerate() * chunk_seconds)
+            if not data:
+                return
+            yield _pcm_to_float(data, width).reshape(-1, channels).mean(axis=1)
+
+
+def _ffmpeg_chunks(path, sample_rate, chunk_seconds):
+    proc = subprocess.Popen(
+        ['ffmpeg', '-nostdin', '-v', 'error', '-i', path, '-f', 'f32le', '-ac', '1', '-ar', str(sample_rate), '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(sample_rate * chunk_seconds * 4)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 4], '<f4')
+    finally:
+        # Also runs when the consumer stops early: don't leave ffmpeg decoding the rest of the file.
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        stderr = proc.stderr.read().decode('utf-8', 'replace').strip()
+        proc.stderr.close()
+        if proc.wait() not in (0, -9) and stderr:
+            raise RuntimeError('ffmpeg: ' + stderr.splitlines()[-1])
+
+
+def decode(path, sample_rate=SAMPLE_RATE, chunk_seconds=CHUNK_SECONDS):
+    """Return (sample rate, generator of mono float32 chunks in [-1, 1])."""
+    if os.path.splitext(path)[1].lower() == '.wav':
+        wav = wave.open(path, 'rb')
+        return wav.getframerate(), _wav_chunks(wav, chunk_seconds)
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError('ffmpeg is needed to decode ' + os.path.splitext(path)[1])
+    return sample_rate, _ffmpeg_chunks(path, sample_rate, chunk_seconds)
+
+
+class FeatureExtractor:
+    """Streaming short-time Fourier features. ``feed`` chunks of any length, then call ``result``.
+
+    Only the running sums, the 12-bin chroma and the onset envelope (one float per hop) are kept,
+    so memory doesn't grow with the length of the track beyond that envelope.
+    """
+
+    def __init__(self, sample_rate, frame=FRAME, hop=HOP):
+        self.sample_rate = sample_rate
+        self.frame = frame
+        self.hop = hop
+        self.window = np.hanning(frame).astype(np.float32)
+        freqs = np.fft.rfftfreq(frame, 1.0 / sample_rate)
+        self.freqs = freqs.astype(np.float32)
+        # Pitch class of every bin between A1 and ~C8; bins outside that range don't count towards the chroma
+        self.chroma_bins = np.flatnonzero((freqs > 55) & (freqs < 4200))
+        midi = 69 + 12 * np.log2(freqs[self.chroma_bins] / 440.0)
+        self.chroma_class = np.round(midi).astype(np.int64) % 12
+        self.chroma = np.zeros(12)
+        self.band_of_bin = np.searchsorted(BAND_EDGES, freqs) - 1
+        self.band_bins = np.flatnonzero((self.band_of_bin >= 0) & (self.band_of_bin < len(BAND_EDGES) - 1))
+        self.bands = np.zeros(len(BAND_EDGES) - 1)
+        self.samples = 0
+        self.frames = 0
+        self.power_sum = 0.0
+        self.centroid_sum = 0.0
+        self.rms_sum = 0.0
+        self.onset_envelope = []
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._last_spectrum = None
+
+    def feed(self, chunk):
+        self.samples += len(chunk)
+        buf = np.concatenate([self._buffer, np.asarray(chunk, dtype=np.float32)])
+        if len(buf) < self.frame:
+            self._buffer = buf
+            return
+        n = 1 + (len(buf) - self.frame) // self.hop
+        frames = sliding_window_view(buf, self.frame)[::self.hop][:n]
+        # Keep the overlap for the next chunk's first frame
+        self._buffer = buf[n * self.hop:]
+
+        rms = np.sqrt(np.mean(np.square(frames), axis=1))
+        mag = np.abs(np.fft.rfft(frames * self.window, axis=1)).astype(np.float32)
+        total = mag.sum(axis=1)
+        centroid = (mag @ self.freqs) / np.maximum(total, 1e-9)
+        # Weight by loudness, so silence and fades don't drag the centroid around
+        self.centroid_sum += float(centroid @ rms)
+        self.rms_sum += float(rms.sum())
+        self.power_sum += float(np.square(rms).sum())
+
+        # Spectral flux: summed increase in log magnitude from the previous frame
+        spectrum = np.log1p(mag)
+        previous = spectrum[:1] if self._last_spectrum is None else self._last_spectrum
+        flux = np.maximum(np.diff(np.vstack([previous, spectrum]), axis=0), 0).sum(axis=1)
+        self.onset_envelope.append(flux)
+        self._last_spectrum = spectrum[-1:]
+
+        self.chroma += np.bincount(self.chroma_class, weights=np.square(mag[:, self.chroma_bins]).sum(axis=0),
+                                   minlength=12)
+        power = np.square(mag[:, self.band_bins]).sum(axis=0)
+        self.bands += np.bincount(self.band_of_bin[self.band_bins], weights=power, minlength=len(self.bands))
+        self.frames += n
+
+    def result(self):
+        if self.frames == 0:
+            raise ValueError('Track is too short to analyse')
+        envelope = np.concatenate(self.onset_envelope)
+        envelope_rate = self.sample_rate / self.hop
+        duration = self.samples / self.sample_rate
+        threshold = envelope.mean() + envelope.std()
+        middle = envelope[1:-1]
+        peaks = (middle > envelope[:-2]) & (middle >= envelope[2:]) & (middle > threshold)
+        # Band energies relative to their mean: the spectral shape, independent of loudness
+        bands_db = 10.0 * np.log10(self.bands / self.frames + 1e-12)
+        return {
+            'duration': duration,
+            'rms_db': 20.0 * np.log10(max(np.sqrt(self.power_sum / self.frames), 1e-9)),
+            'centroid_hz': self.centroid_sum / self.rms_sum if self.rms_sum > 0 else 0.0,
+            'onset_rate': float(peaks.sum()) / duration,
+            'tempo_bpm': estimate_tempo(envelope, envelope_rate),
+            'mode': estimate_mode(self.chroma),
+            'chroma': (self.chroma / max(self.chroma.sum(), 1e-12)).tolist(),
+            'bands_db': (bands_db - bands_db.mean()).tolist(),
+            'version': FEATURES_VERSION,
+        }
+
+
+def estimate_tempo(envelope, envelope_rate, min_bpm=60.0, max_bpm=180.0):
+    """Beats per minute from the strongest autocorrelation lag of the onset envelope; 0 if unknown."""
+    x = envelope - envelope.mean()
+    min_lag = int(envelope_rate * 60.0 / max_bpm)
+    max_lag = int(envelope_rate * 60.0 / min_bpm)
+    if len(x) <= max_lag or not x.any():
+        return 0.0
+    spectrum = np.fft.rfft(x, 2 * len(x))
+    autocorr = np.fft.irfft(spectrum * np.conj(spectrum))[:max_lag + 1]
+    lag = min_lag + int(np.argmax(autocorr[min_lag:]))
+    return 60.0 * envelope_rate / lag
+
+
+def estimate_mode(chroma):
+    """Best major-key correlation minus best minor-key correlation, in [-2, 2]; positive means major."""
+    if not chroma.any():
+        return 0.0
+    best = []
+    for profile in (MAJOR_PROFILE, MINOR_PROFILE):
+        best.append(max(np.corrcoef(chroma, np.roll(profile, tonic))[0, 1] for tonic in range(12)))
+    return float(best[0] - best[1])
+
+
+def _scale(value, low, high):
+    return float(np.clip((value - low) / (high - low), 0.0, 1.0)) * 2.0 - 1.0
+
+
+def emotion_probabilities(features, temperature=0.2):
+    """Map audio features to {label: probability} through valence (mode, brightness) and arousal
+    (tempo, loudness, onset rate)."""
+    arousal = (0.35 * _scale(features['tempo_bpm'], 70, 160)
+               + 0.35 * _scale(features['rms_db'], -35, -10)
+               + 0.30 * _scale(features['onset_rate'], 0.5, 5.0))
+    valence = 0.7 * float(np.clip(features['mode'] * 2.0, -1.0, 1.0)) + 0.3 * _scale(features['centroid_hz'], 800, 3000)
+    labels = list(EMOTION_PROTOTYPES)
+    prototypes = np.array([EMOTION_PROTOTYPES[label] for label in labels])
+    logits = -np.square(prototypes - (valence, arousal)).sum(axis=1) / temperature
+    probs = np.exp(logits - logits.max())
+    probs /= probs.sum()
+    return {label: float(p) for label, p in zip(labels, probs)}
+
+
+def analyse(path, max_seconds=None):
+    """Return (features, {label: probability}) for one audio file."""
+    sample_rate, chunks = decode(path)
+    extractor = FeatureExtractor(sample_rate)
+    try:
+        for chunk in chunks:
+            extractor.feed(chunk)
+            if max_seconds and extractor.samples >= max_seconds * sample_rate:
+                break
+    finally:
+        chunks.close()
+    features = extractor.result()
+    return features, emotion_probabilities(features)
+
+
+def _analyse_safely(args):
+    path, max_seconds = args
+    try:
+        return analyse(path, max_seconds) + (None,)
+    except Exception as e:
+        return None, None, '{}: {}'.format(type(e).__name__, e)
+
+
+class AudioTagStore:
+    """SQLite cache of audio features and emotion probabilities, keyed by content hash.
+
+    ``update`` hashes only files whose (size, mtime) changed, and decodes only content it has never
+    seen. Like song_index.SongIndex, every call opens its own connection.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def create(self):
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def generation(self):
+        """Bumped by every update that changed something; 0 if the store was never built."""
+        if not os.path.exists(self.db_path):
+            return 0
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def update(self, root, extensions, workers=None, max_seconds=None, log=print):
+        """Tag every new or changed song under ``root``; return counts of files, analysed and failed."""
+        self.create()
+        found = walk_songs(root, extensions)
+        conn = self._connect()
+        try:
+            # Entries from an older FeatureExtractor are dropped, so their files count as changed
+            stale = [(digest,) for digest, features in conn.execute('SELECT digest, features FROM tags')
+                     if json.loads(features).get('version') != FEATURES_VERSION]
+            with conn:
+                conn.executemany('DELETE FROM tags WHERE digest = ?', stale)
+                conn.executemany('DELETE FROM files WHERE digest = ?', stale)
+            known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                     conn.execute('SELECT path, size, mtime_ns FROM files')}
+            changed = sorted(path for path, stat in found.items() if known.get(path) != stat)
+            removed = sorted(known.keys() - found.keys())
+            analysed, failed = 0, 0
+            digests = []
+            if changed:
+                with ProcessPoolExecutor(workers) as pool:
+                    paths = [os.path.join(root, relpath) for relpath in changed]
+                    digests = list(pool.map(content_digest, paths, chunksize=4))
+                    tagged = {row[0] for row in conn.execute('SELECT digest FROM tags')}
+                    todo = {}
+                    for path, digest in zip(paths, digests):
+                        if digest not in tagged:
+                            todo.setdefault(digest, path)
+                    results = pool.map(_analyse_safely, [(path, max_seconds) for path in todo.values()])
+                    for (digest, path), (features, probs, error) in zip(todo.items(), results):
+                        if error:
+                            failed += 1
+                            log('skipped {}: {}'.format(os.path.relpath(path, root), error))
+                            continue
+                        analysed += 1
+                        # Commit as we go, so an interrupted run keeps what it already paid for
+                        with conn:
+                            conn.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?)',
+                                         (digest, json.dumps(features), json.dumps(probs)))
+                        tagged.add(digest)
+            # Files that failed to decode stay out of ``files``, so the next run retries them
+            stored = [(relpath,) + found[relpath] + (digest,)
+                      for relpath, digest in zip(changed, digests) if digest in tagged]
+            with conn:
+                conn.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', stored)
+                if stored or removed:
+                    conn.execute("INSERT INTO meta VALUES ('generation', 1) "
+                                 "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+        finally:
+            conn.close()
+        return {'files': len(found), 'analysed': analysed, 'failed': failed}
+
+    def load(self, column='probabilities'):
+        """{song path relative to the songs folder, with '/' separators: {label: probability}}, or the
+        features dicts with ``column='features'``."""
+        if column not in ('probabilities', 'features'):
+            raise ValueError(column)
+        if not os.path.exists(self.db_path):
+            return {}
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT f.path, t.' + column + ' FROM files f JOIN tags t ON t.digest = f.digest')
+            return {path: json.loads(value) for path, value in rows}
+        except sqlite3.OperationalError:
+            return {}
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    import config
+    from recommend import AUDIO_EXTENSIONS, LOCAL_SONGS_FOLDER
+
+    parser = argparse.ArgumentParser(description='Tag local songs with emotions estimated from audio features.')
+    parser.add_argument('--db', default=config.AUDIO_TAGS_PATH or config.DEFAULT_AUDIO_TAGS_PATH)
+    parser.add_argument('--root', default=LOCAL_SONGS_FOLDER)
+    parser.add_argument('--workers', type=int, default=None, help='analysis processes (default: CPU count)')
+    parser.add_argument('--max-seconds', type=float, default=None, help='only analyse the start of each track')
+    parser.add_argument('--show', action='store_true', help='print the stored tags instead of updating them')
+    args = parser.parse_args()
+    store = AudioTagStore(args.db)
+    if args.show:
+        for path, probs in sorted(store.load().items()):
+            label = max(probs, key=probs.get)
+            print('{:<10} {:.2f}  {}'.format(label, probs[label], path))
+    else:
+        counts = store.update(args.root, AUDIO_EXTENSIONS, args.workers, args.max_seconds)
+        print('{files} files, {analysed} analysed, {failed} failed -> {db}'.format(db=args.db, **counts))
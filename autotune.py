@@ -0,0 +1,289 @@
+"""Pick gunicorn workers, model threads and batch size for this machine by measuring them.
+
+More workers and more threads per forward pass compete for the same cores: TensorFlow (and BLAS)
+default to one thread per core in every worker, so N workers oversubscribe N-fold. This measures
+the candidates that fit the usable cores (cgroup CPU quota and CPU affinity, not the host's core
+count) and keeps the one with the most predictions per second whose p95 latency stays under a target.
+
+    python autotune.py                   # calibrate now and write AUTOTUNE_PATH
+    python autotune.py --show            # print the saved result
+
+gunicorn.conf.py calls ``load_or_calibrate`` at startup when AUTOTUNE is on, before the port is bound, so
+each candidate gets AUTOTUNE_LOAD_TIMEOUT seconds on top of its measuring time and the whole calibration at
+most AUTOTUNE_MAX_SECONDS. A saved result is reused as long as its fingerprint (usable CPUs, backend, model
+file, threads per worker) still matches.
+
+Only the standard library is imported here, so gunicorn.conf.py can use this before numpy is loaded.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import select
+import subprocess
+import sys
+import time
+
+import config
+
+# Environment variables that size BLAS/OpenMP thread pools; read once, when numpy (or TensorFlow) loads.
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+BATCH_SIZES = (1, 2, 4, 8, 16)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def cgroup_cpu_quota():
+    """CPUs granted by the cgroup CPU quota (cgroup v2 cpu.max or v1 CFS), or None without a quota."""
+    paths = ['/sys/fs/cgroup/cpu.max']
+    try:
+        for line in _read('/proc/self/cgroup').splitlines():
+            if line.startswith('0::'):
+                # cgroup v2 without a cgroup namespace: our own group, not the root one
+                paths.insert(0, '/sys/fs/cgroup{}/cpu.max'.format(line[3:].rstrip('/')))
+    except OSError:
+        pass
+    for path in paths:
+        try:
+            quota, period = _read(path).split()[:2]
+        except (OSError, ValueError):
+            continue
+        return None if quota == 'max' else int(quota) / int(period)
+    try:
+        quota = int(_read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'))
+        period = int(_read('/sys/fs/cgroup/cpu/cpu.cfs_period_us'))
+    except (OSError, ValueError):
+        return None
+    return quota / period if quota > 0 and period > 0 else None
+
+
+def usable_cpus():
+    """{'affinity', 'quota', 'cpus'}: CPUs this process may run on, CPUs its quota pays for, and the
+    whole number of cores to plan for (a fractional quota is rounded down, so it is never throttled)."""
+    if hasattr(os, 'sched_getaffinity'):
+        affinity = len(os.sched_getaffinity(0))
+    else:
+        affinity = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    cpus = affinity if quota is None else max(1, min(affinity, math.floor(quota)))
+    return {'affinity': affinity, 'quota': quota, 'cpus': cpus}
+
+
+def candidates(cpus, max_batch):
+    """(workers, threads, batch size) combinations using all ``cpus``: power-of-two thread counts plus
+    all cores in one worker, and batches no larger than the concurrent requests a worker can have."""
+    thread_counts = sorted({2 ** i for i in range(int(math.log2(cpus)) + 1)} | {cpus})
+    batches = [b for b in BATCH_SIZES if b <= max(1, max_batch)]
+    return [(max(1, cpus // threads), threads, batch) for threads in thread_counts for batch in batches]
+
+
+def fingerprint(cpus):
+    """What a saved result depends on; any change means calibrating again."""
+    try:
+        st = os.stat(config.MODEL_PATH)
+        model = [config.MODEL_PATH, st.st_size, st.st_mtime_ns]
+    except OSError:
+        model = [config.MODEL_PATH, None, None]
+    return {
+        'cpus': cpus,
+        'backend': config.MODEL_BACKEND,
+        'model': model,
+        'threads_per_worker': config.GUNICORN_THREADS,
+        'target_ms': config.AUTOTUNE_TARGET_MS,
+        'machine': platform.machine(),
+    }
+
+
+def thread_env(threads):
+    env = dict(os.environ, MODEL_THREADS=str(threads))
+    env.update({name: str(threads) for name in THREAD_ENV_VARS})
+    return env
+
+
+def _readline(process, deadline):
+    """The next line ``process`` prints, or None at EOF or once ``deadline`` (time.monotonic) passes."""
+    line = b''
+    while not line.endswith(b'\n'):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([process.stdout], [], [], remaining)[0]:
+            return None
+        # Unbuffered pipe: read only what select saw, so nothing waits in a buffer select can't see
+        chunk = os.read(process.stdout.fileno(), 4096)
+        if not chunk:
+            return None
+        line += chunk
+    return line.decode()
+
+
+def measure(workers, threads, batch, seconds, deadline=None):
+    """Run ``workers`` processes at once, each predicting batches of ``batch`` with ``threads`` threads
+    for ``seconds``: {'images_per_second', 'p50_ms', 'p95_ms'} of the batch calls, or None on failure
+    or when they haven't all reported by ``deadline`` (time.monotonic, default: AUTOTUNE_LOAD_TIMEOUT
+    plus ``seconds`` from now)."""
+    if deadline is None:
+        deadline = time.monotonic() + config.AUTOTUNE_LOAD_TIMEOUT + seconds
+    command = [sys.executable, os.path.abspath(__file__), '--worker', str(threads), str(batch), str(seconds)]
+    processes = [subprocess.Popen(command, env=thread_env(threads), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  bufsize=0) for _ in range(workers)]
+    try:
+        # Start timing together, once every worker has loaded and warmed up its model
+        if not all((_readline(p, deadline) or '').strip() == 'ready' for p in processes):
+            return None
+        for p in processes:
+            p.stdin.write(b'go\n')
+        results = []
+        for p in processes:
+            line = _readline(p, deadline)
+            if line is None:
+                return None
+            results.append(json.loads(line))
+    except (OSError, ValueError):
+        return None
+    finally:
+        for p in processes:
+            p.kill()
+            p.wait()
+    return {
+        'images_per_second': round(sum(r['images'] for r in results) / seconds, 1),
+        'p50_ms': round(max(r['p50_ms'] for r in results), 3),
+        'p95_ms': round(max(r['p95_ms'] for r in results), 3),
+    }
+
+
+def _worker(threads, batch, seconds):
+    """One calibration process: load the model, say 'ready', wait for 'go', then report timings."""
+    import numpy as np
+    from recommend import load_model_info, predict_emotion, predict_emotions, warm_up_model
+    model, input_shape, channels = load_model_info(config.MODEL_PATH, config.MODEL_BACKEND, threads)
+    warm_up_model(model, input_shape, channels, [batch])
+    images = np.random.default_rng(0).random((batch, input_shape[0], input_shape[1], channels), dtype=np.float32)
+    print('ready', flush=True)
+    sys.stdin.readline()
+    timings = []
+    stop = time.perf_counter() + seconds
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        if batch == 1:
+            predict_emotion(model, images[0])
+        else:
+            predict_emotions(model, images)
+        timings.append((time.perf_counter() - start) * 1000.0)
+    print(json.dumps({'images': len(timings) * batch, 'p50_ms': float(np.percentile(timings, 50)),
+                      'p95_ms': float(np.percentile(timings, 95))}), flush=True)
+
+
+def calibrate(cpus, target_ms, seconds, log=print, max_seconds=None):
+    """Measure the candidates and return the result to save, or None if the model can't run.
+
+    Candidates still left after ``max_seconds`` (default AUTOTUNE_MAX_SECONDS) are skipped; the choice
+    is then made among the ones measured so far.
+    """
+    stop = time.monotonic() + (config.AUTOTUNE_MAX_SECONDS if max_seconds is None else max_seconds)
+    measured = []
+    for workers, threads, batch in candidates(cpus, config.GUNICORN_THREADS):
+        if time.monotonic() + seconds > stop:
+            log('autotune: out of time (AUTOTUNE_MAX_SECONDS), skipping the remaining candidates')
+            break
+        deadline = min(time.monotonic() + config.AUTOTUNE_LOAD_TIMEOUT + seconds, stop)
+        result = measure(workers, threads, batch, seconds, deadline)
+        if result is None:
+            log('autotune: {} workers x {} threads x batch {} failed or timed out'.format(workers, threads, batch))
+            continue
+        # A request may wait up to BATCH_MAX_WAIT_MS for its batch to fill
+        result['latency_ms'] = round(result['p95_ms'] + (config.BATCH_MAX_WAIT_MS if batch > 1 else 0.0), 3)
+        result.update(workers=workers, threads=threads, batch_max_size=batch)
+        measured.append(result)
+        log('autotune: {workers} workers x {threads} threads x batch {batch_max_size}: {images_per_second} '
+            'images/s, p95 {latency_ms} ms'.format(**result))
+    if not measured:
+        return None
+    within = [r for r in measured if r['latency_ms'] <= target_ms]
+    # Nothing meets the target: take the fastest responses instead
+    best = (max(within, key=lambda r: r['images_per_second']) if within
+            else min(measured, key=lambda r: r['latency_ms']))
+    return {
+        'settings': {key: best[key] for key in ('workers', 'threads', 'batch_max_size')},
+        'met_target': bool(within),
+        'candidates': measured,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def load(path, cpus):
+    """The saved result at ``path`` if it was calibrated for this machine and model, else None."""
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return saved if saved.get('fingerprint') == fingerprint(cpus) else None
+
+
+def save(path, result):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(result, f, indent=2)
+    os.replace(tmp, path)
+
+
+def load_or_calibrate(path=None, log=print):
+    """Settings for this machine: saved ones when still valid, otherwise freshly calibrated and saved.
+    None when calibration isn't possible (e.g. the model doesn't load); the defaults then apply."""
+    path = path or config.AUTOTUNE_PATH
+    cpu_info = usable_cpus()
+    result = load(path, cpu_info['cpus'])
+    if result is None:
+        log('autotune: calibrating for {cpus} usable CPUs (affinity {affinity}, quota {quota})'.format(**cpu_info))
+        result = calibrate(cpu_info['cpus'], config.AUTOTUNE_TARGET_MS, config.AUTOTUNE_SECONDS, log)
+        if result is None:
+            log('autotune: calibration failed, keeping the default settings')
+            return None
+        result.update(fingerprint=fingerprint(cpu_info['cpus']), cpus=cpu_info)
+        try:
+            save(path, result)
+        except OSError as e:
+            log('autotune: could not save {}: {}'.format(path, e))
+    return result['settings']
+
+
+def apply(settings):
+    """Use MODEL_THREADS and BATCH_MAX_SIZE from ``settings`` in this process and the ones it starts,
+    unless set in the environment. Call before the app (and numpy) is imported."""
+    threads = settings['threads']
+    if 'MODEL_THREADS' not in os.environ:
+        config.MODEL_THREADS = threads
+        for name, value in thread_env(threads).items():
+            os.environ.setdefault(name, value)
+    if 'BATCH_MAX_SIZE' not in os.environ:
+        config.BATCH_MAX_SIZE = settings['batch_max_size']
+        os.environ['BATCH_MAX_SIZE'] = str(settings['batch_max_size'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--worker':
+        _worker(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='Calibrate workers, model threads and batch size for this machine.')
+    parser.add_argument('--path', default=config.AUTOTUNE_PATH, help='where to save the result')
+    parser.add_argument('--cpus', type=int, help='plan for this many CPUs instead of the detected ones')
+    parser.add_argument('--show', action='store_true', help='print the saved result and exit')
+    args = parser.parse_args()
+    if args.show:
+        with open(args.path) as f:
+            print(f.read())
+        sys.exit(0)
+    cpu_info = usable_cpus()
+    if args.cpus:
+        cpu_info['cpus'] = args.cpus
+    print('usable CPUs: {cpus} (affinity {affinity}, quota {quota})'.format(**cpu_info))
+    result = calibrate(cpu_info['cpus'], config.AUTOTUNE_TARGET_MS, config.AUTOTUNE_SECONDS)
+    if result is None:
+        sys.exit('calibration failed: is MODEL_PATH/MODEL_BACKEND loadable?')
+    result.update(fingerprint=fingerprint(cpu_info['cpus']), cpus=cpu_info)
+    save(args.path, result)
+    print('{workers} workers x {threads} threads x batch {batch_max_size} -> {path}'.format(
+        path=args.path, **result['settings']))
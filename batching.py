@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from recommend import predict_emotions
+
+
+class _PendingRequest:
+    __slots__ = ('img_arr', 'enqueued', 'done', 'result', 'error')
+
+    def __init__(self, img_arr):
+        self.img_arr = img_arr
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchStats:
+    """Running counters for batch sizes and time spent waiting in the queue."""
+
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes = {}
+        self.max_wait_ms = 0.0
+        self.total_wait_ms = 0.0
+        self._recent_waits = deque(maxlen=window)
+
+    def record(self, batch_size, waits_ms):
+        with self._lock:
+            self.batches += 1
+            self.items += batch_size
+            self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+            self.total_wait_ms += sum(waits_ms)
+            self.max_wait_ms = max(self.max_wait_ms, max(waits_ms))
+            self._recent_waits.extend(waits_ms)
+
+    def snapshot(self):
+        with self._lock:
+            recent = np.array(self._recent_waits) if self._recent_waits else np.zeros(1)
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                'queue_wait_ms': {
+                    'mean': self.total_wait_ms / self.items if self.items else 0.0,
+                    'p50': float(np.percentile(recent, 50)),
+                    'p99': float(np.percentile(recent, 99)),
+                    'max': self.max_wait_ms,
+                },
+            }
+
+
+class BatchScheduler:
+    """Collects concurrent predict_emotion calls into one batched forward pass.
+
+    A batch is dispatched as soon as it holds max_batch_size images or its oldest
+    request has waited max_wait_ms. The worker thread is started lazily so the
+    scheduler can be created before gunicorn forks its workers.
+    """
+
+    # Serializes the post-fork reset: the first requests of a worker may arrive on several threads at once
+    _fork_lock = threading.Lock()
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=5.0):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._reset()
+
+    def _reset(self):
+        self.stats = BatchStats()
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._thread = None
+        self._pid = os.getpid()
+
+    @property
+    def queued(self):
+        """Images waiting for a batch."""
+        return len(self._pending)
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+            self._thread.start()
+
+    def predict(self, img_arr, timeout=None):
+        """Queue one preprocessed image and block until its (label, prob_map) is ready."""
+        request = _PendingRequest(img_arr)
+        # Threads do not survive fork(), so a forked worker starts its own.
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        with self._cond:
+            self._ensure_worker()
+            self._pending.append(request)
+            self._cond.notify()
+        if not request.done.wait(timeout):
+            raise TimeoutError('Timed out waiting for batched prediction')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0].enqueued + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(len(self._pending), self.max_batch_size)
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+            self.stats.record(len(batch), [(started - r.enqueued) * 1000.0 for r in batch])
+            try:
+                results = predict_emotions(self.model, np.stack([r.img_arr for r in batch]))
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+                    r.done.set()
+                continue
+            for r, result in zip(batch, results):
+                r.result = result
+                r.done.set()
@@ -0,0 +1,67 @@
+"""Compare preprocess_image's reduced-resolution JPEG decode with a full-resolution decode.
+
+    python benchmarks/bench_decode.py [--runs 20]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recommend import preprocess_image  # noqa: E402
+
+SIZES = [(640, 480), (1920, 1080), (4000, 3000)]
+
+
+def synthetic_photo(width, height, fmt, seed=0):
+    """Smooth gradients plus noise, so JPEG sizes look like a real photo's."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width, y / height, (x + y) / (width + height)], axis=-1) * 200
+    pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, fmt, **({'quality': 90} if fmt == 'JPEG' else {}))
+    return buf.getvalue()
+
+
+def time_ms(fn, runs):
+    fn()
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(timings))
+
+
+def run(runs=20, input_shape=(48, 48), channels=1):
+    results = []
+    out = np.empty((input_shape[0], input_shape[1], channels), dtype=np.float32)
+    for width, height in SIZES:
+        for fmt in ('JPEG', 'PNG'):
+            data = synthetic_photo(width, height, fmt)
+            full = time_ms(lambda: preprocess_image(io.BytesIO(data), input_shape, channels, draft=False), runs)
+            fast = time_ms(lambda: preprocess_image(io.BytesIO(data), input_shape, channels, out=out), runs)
+            results.append({
+                'image': '{}x{} {}'.format(width, height, fmt),
+                'bytes': len(data),
+                'full_decode_ms': full,
+                'draft_decode_ms': fast,
+                'speedup': full / fast,
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--channels', type=int, default=1, choices=[1, 3])
+    args = parser.parse_args()
+    print('{:<18} {:>10} {:>10} {:>10} {:>8}'.format('image', 'bytes', 'full ms', 'draft ms', 'speedup'))
+    for r in run(args.runs, channels=args.channels):
+        print('{image:<18} {bytes:>10} {full_decode_ms:>10.2f} {draft_decode_ms:>10.2f} {speedup:>7.1f}x'.format(**r))
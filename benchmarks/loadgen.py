@@ -0,0 +1,399 @@
+"""Load generator for a running server: how many captures per second does a deployment sustain?
+
+    python benchmarks/loadgen.py http://127.0.0.1:8000 --concurrency 16 --duration 30
+    python benchmarks/loadgen.py http://127.0.0.1:8000 --rate 200 --mix predict=8,home=1,song=1 --json out.json
+
+Closed loop (--concurrency N): N users, each sending its next request as soon as the previous one
+is answered; the result is the server's capacity. Open loop (--rate R): R requests per second start
+on a fixed schedule whether or not earlier ones have finished, over at most --connections keep-alive
+connections; the result is the latency users see at that load.
+
+Latencies are measured from when each request was due, not when it could be sent, so time spent
+waiting for a free connection counts (coordinated-omission correction). In closed-loop mode,
+--expected-interval-ms adds the requests a stalled user would have sent (as HdrHistogram does).
+
+For a repeatable capacity number, run the server without a model, rate limit or prediction cache:
+
+    MODEL_BACKEND=stub RATE_LIMIT_PER_SECOND=0 PREDICTION_CACHE_SIZE=0 gunicorn -c gunicorn.conf.py app:app
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import ssl
+import sys
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlsplit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_decode import synthetic_photo  # noqa: E402
+
+# Histogram bucket upper bounds in milliseconds: 0.5 ms to ~65 s, doubling
+HISTOGRAM_MS = [0.5 * 2 ** i for i in range(18)]
+PERCENTILES = (50, 90, 99, 99.9)
+# The song target fetches this much of a file, like a player starting playback
+SONG_RANGE_BYTES = 256 * 1024
+
+
+class Connection:
+    """One HTTP/1.1 keep-alive connection. Requests on it are sent one at a time."""
+
+    def __init__(self, host, port, use_ssl):
+        self.host = host
+        self.port = port
+        self.ssl = ssl.create_default_context() if use_ssl else None
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, headers=(), body=b''):
+        """(status, headers, body) of one request; reconnects once if an idle connection was closed."""
+        reused = self.writer is not None
+        try:
+            return await self._request(method, path, headers, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            if not reused:
+                raise
+            return await self._request(method, path, headers, body)
+
+    async def _request(self, method, path, headers, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}:{}'.format(self.host, self.port),
+                 'Content-Length: {}'.format(len(body))]
+        lines += ['{}: {}'.format(k, v) for k, v in headers]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Server closed the connection')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif 'content-length' in response_headers:
+            data = await self.reader.readexactly(int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = await self._read_chunked()
+        else:
+            data = await self.reader.read()
+            response_headers['connection'] = 'close'
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, response_headers, data
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Trailers, up to the blank line
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def multipart(field, filename, data, content_type):
+    boundary = uuid.uuid4().hex
+    body = ('--{b}\r\nContent-Disposition: form-data; name="{f}"; filename="{n}"\r\nContent-Type: {t}\r\n\r\n'
+            .format(b=boundary, f=field, n=filename, t=content_type).encode() + data
+            + '\r\n--{}--\r\n'.format(boundary).encode())
+    return body, 'multipart/form-data; boundary=' + boundary
+
+
+def load_corpus(directory, count):
+    """(file name, bytes, content type) of every JPEG/PNG in ``directory``, or synthetic photos."""
+    if directory:
+        paths = sorted(p for p in glob.glob(os.path.join(directory, '*'))
+                       if os.path.splitext(p)[1].lower() in ('.jpg', '.jpeg', '.png'))
+        if not paths:
+            raise SystemExit('No .jpg or .png images in {}'.format(directory))
+        corpus = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                png = path.lower().endswith('.png')
+                corpus.append((os.path.basename(path), f.read(), 'image/png' if png else 'image/jpeg'))
+        return corpus
+    return [('synthetic-{}.jpg'.format(i), synthetic_photo(640, 480, 'JPEG', seed=i), 'image/jpeg')
+            for i in range(count)]
+
+
+class Targets:
+    """Builds the requests of the mix: /predict uploads, the home page and song files."""
+
+    def __init__(self, mix, corpus, songs, seed):
+        self.uploads = [multipart('image', name, data, content_type) for name, data, content_type in corpus]
+        self.songs = songs
+        self.names = [name for name, weight in mix.items() if weight > 0 and (name != 'song' or songs)]
+        self.weights = [mix[name] for name in self.names]
+        self.random = random.Random(seed)
+        self._next_upload = 0
+
+    def next(self):
+        """(target name, method, path, headers, body) of the next request."""
+        name = self.random.choices(self.names, self.weights)[0]
+        if name == 'predict':
+            body, content_type = self.uploads[self._next_upload % len(self.uploads)]
+            self._next_upload += 1
+            return name, 'POST', '/predict', [('Content-Type', content_type)], body
+        if name == 'home':
+            return name, 'GET', '/', [('Accept-Encoding', 'gzip')], b''
+        path = self.random.choice(self.songs)
+        return name, 'GET', path, [('Range', 'bytes=0-{}'.format(SONG_RANGE_BYTES - 1))], b''
+
+
+class Recorder:
+    """Latencies and outcomes of the requests due after the warm-up."""
+
+    def __init__(self, measure_from, expected_interval=None):
+        self.measure_from = measure_from
+        self.expected_interval = expected_interval
+        self.latency = []
+        self.service = []
+        self.by_target = {}
+        self.status = Counter()
+        self.errors = Counter()
+        self.cache = Counter()
+        self.completed = 0
+        self.last_done = measure_from
+
+    def record(self, target, due, sent, done, status=None, headers=None, error=None):
+        if due < self.measure_from:
+            return
+        latency = (done - due) * 1000.0
+        self.completed += 1
+        self.last_done = max(self.last_done, done)
+        self.latency.append(latency)
+        self.service.append((done - sent) * 1000.0)
+        self.by_target.setdefault(target, []).append((latency, error is not None or status >= 400))
+        if error is not None:
+            self.errors[error] += 1
+        else:
+            self.status[status] += 1
+            if headers and 'x-prediction-cache' in headers:
+                self.cache[headers['x-prediction-cache']] += 1
+        if self.expected_interval:
+            # A user stuck on this request would have sent more in the meantime; they'd have waited too
+            interval = self.expected_interval * 1000.0
+            missed = latency - interval
+            while missed > 0:
+                self.latency.append(missed)
+                missed -= interval
+
+
+async def send(connection, targets, recorder, due):
+    target, method, path, headers, body = targets.next()
+    sent = time.perf_counter()
+    try:
+        status, response_headers, _ = await connection.request(method, path, headers, body)
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        connection.close()
+        recorder.record(target, due, sent, time.perf_counter(), error=type(e).__name__)
+        return
+    recorder.record(target, due, sent, time.perf_counter(), status, response_headers)
+
+
+async def closed_loop(address, targets, recorder, concurrency, stop):
+    async def user():
+        connection = Connection(*address)
+        try:
+            while time.perf_counter() < stop:
+                await send(connection, targets, recorder, time.perf_counter())
+        finally:
+            connection.close()
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+
+
+async def open_loop(address, targets, recorder, rate, connections, start, stop):
+    pool = asyncio.Queue()
+    for _ in range(connections):
+        pool.put_nowait(Connection(*address))
+
+    async def one(due):
+        connection = await pool.get()
+        try:
+            await send(connection, targets, recorder, due)
+        finally:
+            pool.put_nowait(connection)
+
+    tasks = set()
+    i = 0
+    while True:
+        due = start + i / rate
+        if due >= stop:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.ensure_future(one(due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        i += 1
+    if tasks:
+        await asyncio.gather(*tasks)
+    while not pool.empty():
+        pool.get_nowait().close()
+
+
+async def discover_songs(address, upload):
+    """Song URLs from one /predict response, for the song target."""
+    connection = Connection(*address)
+    try:
+        body, content_type = upload
+        status, _, data = await connection.request('POST', '/predict', [('Content-Type', content_type)], body)
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        return []
+    finally:
+        connection.close()
+    if status != 200:
+        return []
+    return [song['url'] for song in json.loads(data).get('local_songs', [])]
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    summary = {'p{:g}'.format(p): round(float(np.percentile(values, p)), 3) for p in PERCENTILES}
+    summary.update(mean=round(float(values.mean()), 3), max=round(float(values.max()), 3))
+    return summary
+
+
+def histogram(values):
+    counts = np.bincount(np.searchsorted(HISTOGRAM_MS, values), minlength=len(HISTOGRAM_MS) + 1)
+    return [[bound, int(count)] for bound, count in zip(HISTOGRAM_MS + [None], counts)]
+
+
+def report(recorder, elapsed, args):
+    errors = sum(recorder.errors.values()) + sum(n for status, n in recorder.status.items() if status >= 400)
+    result = {
+        'url': args.url,
+        'mode': 'open' if args.rate else 'closed',
+        'concurrency': args.concurrency if not args.rate else None,
+        'rate': args.rate,
+        'connections': args.connections if args.rate else args.concurrency,
+        'duration_s': round(elapsed, 3),
+        'requests': recorder.completed,
+        'throughput_rps': round(recorder.completed / elapsed, 2) if elapsed > 0 else 0.0,
+        'error_rate': round(errors / recorder.completed, 5) if recorder.completed else 0.0,
+        'status': {str(k): v for k, v in sorted(recorder.status.items())},
+        'errors': dict(recorder.errors),
+        'prediction_cache': dict(recorder.cache),
+        'latency_ms': summarize(recorder.latency),
+        'service_ms': summarize(recorder.service),
+        'histogram_ms': histogram(recorder.latency) if recorder.latency else [],
+        'targets': {},
+    }
+    for target, samples in sorted(recorder.by_target.items()):
+        latencies = [latency for latency, _ in samples]
+        result['targets'][target] = dict(
+            requests=len(samples), throughput_rps=round(len(samples) / elapsed, 2) if elapsed > 0 else 0.0,
+            error_rate=round(sum(failed for _, failed in samples) / len(samples), 5), latency_ms=summarize(latencies))
+    return result
+
+
+def print_report(result):
+    print('{mode}-loop against {url}: {requests} requests in {duration_s:.1f}s = {throughput_rps:.1f}/s, '
+          '{error_rate:.2%} errors'.format(**result))
+    if result['errors']:
+        print('  connection errors: {}'.format(result['errors']))
+    print('  status: {}'.format(result['status']))
+    if result['prediction_cache']:
+        print('  prediction cache: {}'.format(result['prediction_cache']))
+    header = '{:<10} {:>8} {:>9} {:>7}' + ' {:>9}' * (len(PERCENTILES) + 1)
+    print(header.format('target', 'requests', 'req/s', 'errors', *['p{:g} ms'.format(p) for p in PERCENTILES], 'max ms'))
+    rows = list(result['targets'].items()) + [('all', dict(requests=result['requests'],
+                                                         throughput_rps=result['throughput_rps'],
+                                                         error_rate=result['error_rate'],
+                                                         latency_ms=result['latency_ms']))]
+    for name, row in rows:
+        latency = row['latency_ms'] or {}
+        print('{:<10} {:>8} {:>9.1f} {:>6.2%}'.format(name, row['requests'], row['throughput_rps'], row['error_rate'])
+              + ''.join(' {:>9.2f}'.format(latency.get('p{:g}'.format(p), 0.0)) for p in PERCENTILES)
+              + ' {:>9.2f}'.format(latency.get('max', 0.0)))
+    if result['service_ms']:
+        print('  service time only (excludes waiting for a connection): p50 {p50} ms, p99 {p99} ms'.format(
+            **result['service_ms']))
+    total = sum(count for _, count in result['histogram_ms']) or 1
+    print('latency histogram:')
+    lower = 0.0
+    for bound, count in result['histogram_ms']:
+        if count:
+            label = '{:g}-{:g} ms'.format(lower, bound) if bound is not None else '>{:g} ms'.format(lower)
+            print('  {:>16} {:>8} {}'.format(label, count, '#' * max(1, round(50 * count / total))))
+        lower = bound
+
+
+async def main(args):
+    parts = urlsplit(args.url)
+    use_ssl = parts.scheme == 'https'
+    address = (parts.hostname, parts.port or (443 if use_ssl else 80), use_ssl)
+    mix = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+    unknown = set(mix) - {'predict', 'home', 'song'}
+    if unknown:
+        raise SystemExit('Unknown targets in --mix: {}'.format(', '.join(sorted(unknown))))
+    corpus = load_corpus(args.images, args.synthetic_images)
+    songs = []
+    if mix.get('song'):
+        songs = await discover_songs(address, multipart('image', *corpus[0]))
+        if not songs:
+            print('no local songs in the /predict response: skipping the song target', file=sys.stderr)
+    targets = Targets(mix, corpus, songs, args.seed)
+    if not targets.names:
+        raise SystemExit('Nothing to send: the --mix is empty')
+
+    start = time.perf_counter()
+    measure_from = start + args.warmup
+    stop = measure_from + args.duration
+    recorder = Recorder(measure_from, args.expected_interval_ms / 1000.0 if args.expected_interval_ms else None)
+    if args.rate:
+        await open_loop(address, targets, recorder, args.rate, args.connections, start, stop)
+    else:
+        await closed_loop(address, targets, recorder, args.concurrency, stop)
+    return report(recorder, max(recorder.last_done, stop) - measure_from, args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', help='base URL of the server, e.g. http://127.0.0.1:8000')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--concurrency', type=int, default=8, help='closed loop: concurrent users (default)')
+    mode.add_argument('--rate', type=float, help='open loop: requests per second')
+    parser.add_argument('--connections', type=int, default=64, help='open loop: keep-alive connections')
+    parser.add_argument('--duration', type=float, default=20.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds of load before measuring')
+    parser.add_argument('--mix', default='predict=1', help='target weights, e.g. predict=8,home=1,song=1')
+    parser.add_argument('--images', help='directory of sample face images (default: synthetic photos)')
+    parser.add_argument('--synthetic-images', type=int, default=16, help='synthetic photos without --images')
+    parser.add_argument('--expected-interval-ms', type=float, help='closed loop: back-fill latencies of stalled users')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the target mix')
+    parser.add_argument('--json', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,247 @@
+"""Benchmark suite for the recommend.py hot paths, with JSON output and baseline comparison.
+
+    python benchmarks/run.py --output results.json                  # run everything
+    python benchmarks/run.py --suite songs --quick                  # one suite, smaller inputs
+    python benchmarks/run.py --baseline baseline.json               # exit 1 on regressions
+
+Suites: preprocess (preprocess_image), predict (predict_emotion/predict_emotions with a stub and the
+real model), songs (get_local_songs over synthetic libraries) and flask (POST /predict through the
+test client). Each case repeats until it has run at least --min-runs times and --min-seconds long,
+and reports the median, p90 and minimum in milliseconds.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The flask suite must see every upload: no rate limit and no prediction cache.
+os.environ['RATE_LIMIT_PER_SECOND'] = '0'
+os.environ['PREDICTION_CACHE_SIZE'] = '0'
+
+import config  # noqa: E402
+import recommend  # noqa: E402
+from bench_decode import synthetic_photo  # noqa: E402
+from catalog import SongCatalog  # noqa: E402
+from scoring import SongScorer  # noqa: E402
+from stub_model import StubModel  # noqa: E402
+
+SUITES = ('preprocess', 'predict', 'songs', 'flask')
+IMAGE_SIZES = [(320, 240), (1920, 1080)]
+BATCH_SIZES = [1, 8, 32]
+LIBRARY_SIZES = [100, 1000, 10000, 100000]
+QUICK_LIBRARY_SIZES = [100, 1000, 10000]
+# Regressions smaller than this are timer noise, whatever the ratio
+NOISE_FLOOR_MS = 0.05
+
+
+def measure(fn, min_runs=5, min_seconds=0.2, max_runs=1000):
+    """Timing summary of ``fn()`` after one warm-up call."""
+    fn()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_runs and (len(timings) < min_runs or time.perf_counter() - started < min_seconds):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return {
+        'median_ms': float(np.median(timings)),
+        'p90_ms': float(np.percentile(timings, 90)),
+        'min_ms': float(min(timings)),
+        'runs': len(timings),
+    }
+
+
+def load_real_model():
+    """(model, input_shape, channels) from MODEL_PATH, or None when it can't be loaded."""
+    try:
+        return recommend.load_model_info(config.MODEL_PATH, config.MODEL_BACKEND)
+    except Exception as e:
+        print('real model unavailable ({}): skipping its cases'.format(e), file=sys.stderr)
+        return None
+
+
+def grayscale_photo(width, height, fmt):
+    img = Image.open(io.BytesIO(synthetic_photo(width, height, fmt))).convert('L')
+    buf = io.BytesIO()
+    img.save(buf, fmt, **({'quality': 90} if fmt == 'JPEG' else {}))
+    return buf.getvalue()
+
+
+def bench_preprocess(args):
+    input_shape, channels = (48, 48), 1
+    out = np.empty((input_shape[0], input_shape[1], channels), dtype=np.float32)
+    for width, height in IMAGE_SIZES:
+        for fmt in ('JPEG', 'PNG'):
+            for mode, make in (('rgb', synthetic_photo), ('gray', grayscale_photo)):
+                data = make(width, height, fmt)
+                yield ('preprocess/{}-{}x{}-{}'.format(fmt.lower(), width, height, mode),
+                       {'bytes': len(data)},
+                       lambda data=data: recommend.preprocess_image(io.BytesIO(data), input_shape, channels, out=out))
+
+
+def bench_predict(args):
+    models = [('stub', StubModel(), (48, 48), 1)]
+    real = load_real_model() if not args.stub_only else None
+    if real is not None:
+        models.append(('real-' + config.MODEL_BACKEND,) + tuple(real))
+    rng = np.random.default_rng(0)
+    for name, model, input_shape, channels in models:
+        for batch_size in BATCH_SIZES:
+            batch = rng.random((batch_size, input_shape[0], input_shape[1], channels), dtype=np.float32)
+            if batch_size == 1:
+                yield ('predict/{}-emotion'.format(name), {'batch': 1},
+                       lambda model=model, img=batch[0]: recommend.predict_emotion(model, img))
+            yield ('predict/{}-batch{}'.format(name, batch_size), {'batch': batch_size},
+                   lambda model=model, batch=batch: recommend.predict_emotions(model, batch))
+
+
+def make_library(root, size, layout):
+    """``size`` empty song files under ``root``: all in the root folder with an emotion tag in most
+    names ('flat'), or spread over the emotion subfolders ('folders')."""
+    emotions = sorted(recommend.EMOTION_SONG_TAGS)
+    tags = [tag for emotion in emotions for tag in recommend.EMOTION_SONG_TAGS[emotion]] + ['untagged']
+    for emotion in emotions:
+        os.makedirs(os.path.join(root, emotion.lower()), exist_ok=True)
+    for i in range(size):
+        if layout == 'flat':
+            path = os.path.join(root, 'track {:06d} {}.mp3'.format(i, tags[i % len(tags)]))
+        else:
+            path = os.path.join(root, emotions[i % len(emotions)].lower(), 'track {:06d}.mp3'.format(i))
+        open(path, 'wb').close()
+
+
+def use_library(root):
+    """Point get_local_songs at the library in ``root``."""
+    catalog = SongCatalog(root, recommend.EMOTION_SONG_TAGS, recommend.AUDIO_EXTENSIONS, refresh_interval=3600)
+    catalog.refresh(force=True)
+    recommend._catalog = catalog
+    recommend._scorer = SongScorer(catalog, recommend.EMOTION_LABELS, seed=0)
+
+
+def bench_songs(args):
+    blend = {'Happy': 0.6, 'Sad': 0.3, 'Neutral': 0.1}
+    saved = recommend._catalog, recommend._scorer
+    try:
+        yield from _bench_libraries(args, blend)
+    finally:
+        recommend._catalog, recommend._scorer = saved
+
+
+def _bench_libraries(args, blend):
+    for size in QUICK_LIBRARY_SIZES if args.quick else LIBRARY_SIZES:
+        for layout in ('flat', 'folders'):
+            root = tempfile.mkdtemp(prefix='bench-songs-')
+            try:
+                make_library(root, size, layout)
+                label = 'songs/{}-{}'.format(layout, size)
+                # Startup cost: scanning the folder and building the affinity matrix
+                yield (label + '-build', {'files': size},
+                       lambda root=root: (use_library(root), recommend.get_local_songs('Happy')))
+                use_library(root)
+                yield label + '-emotion', {'files': size}, lambda: recommend.get_local_songs('Happy')
+                yield label + '-blend', {'files': size}, lambda: recommend.get_local_songs('Happy', blend)
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_flask(args):
+    import app as app_module
+    client = app_module.app.test_client()
+    models = []
+    if app_module.model is not None and not args.stub_only:
+        models.append(('real-' + app_module.model_status['backend'], app_module.model,
+                       app_module.input_shape, app_module.channels))
+    models.append(('stub', StubModel(), (48, 48), 1))
+    for name, model, input_shape, channels in models:
+        for width, height in IMAGE_SIZES:
+            data = synthetic_photo(width, height, 'JPEG')
+
+            def post(model=model, input_shape=input_shape, channels=channels, data=data):
+                app_module.model, app_module.input_shape, app_module.channels = model, input_shape, channels
+                response = client.post('/predict', data={'image': (io.BytesIO(data), 'face.jpg')},
+                                       content_type='multipart/form-data')
+                if response.status_code != 200:
+                    raise RuntimeError('/predict answered {}: {}'.format(response.status_code, response.get_data(True)))
+            yield 'flask/predict-{}-jpeg-{}x{}'.format(name, width, height), {'bytes': len(data)}, post
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': Image.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'model_backend': config.MODEL_BACKEND,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def run(args):
+    benches = {'preprocess': bench_preprocess, 'predict': bench_predict, 'songs': bench_songs, 'flask': bench_flask}
+    results = {}
+    for suite in args.suite or SUITES:
+        for name, info, fn in benches[suite](args):
+            results[name] = dict(info, **measure(fn, args.min_runs, args.min_seconds))
+            print('{:<44} {median_ms:>10.3f} ms  (p90 {p90_ms:.3f}, {runs} runs)'.format(name, **results[name]),
+                  flush=True)
+    return {'environment': environment(), 'results': results}
+
+
+def compare(report, baseline, threshold):
+    """Names of the cases whose median got slower than ``baseline`` by more than ``threshold``."""
+    regressions = []
+    print('\n{:<44} {:>10} {:>10} {:>8}'.format('case', 'base ms', 'now ms', 'change'))
+    for name, result in report['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = result['median_ms'] / base['median_ms'] if base['median_ms'] else float('inf')
+        slower = ratio > 1 + threshold and result['median_ms'] - base['median_ms'] > NOISE_FLOOR_MS
+        if slower:
+            regressions.append(name)
+        print('{:<44} {:>10.3f} {:>10.3f} {:>+7.1f}%{}'.format(
+            name, base['median_ms'], result['median_ms'], (ratio - 1) * 100, '  REGRESSION' if slower else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--suite', action='append', choices=SUITES, help='run only this suite (repeatable)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='allowed slowdown vs. the baseline (0.15 = 15%%)')
+    parser.add_argument('--min-runs', type=int, default=5)
+    parser.add_argument('--min-seconds', type=float, default=0.2)
+    parser.add_argument('--quick', action='store_true', help='libraries up to 10k songs instead of 100k')
+    parser.add_argument('--stub-only', action='store_true', help='skip the real model')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print('\n{} regression(s) over {:.0%}'.format(len(regressions), args.threshold))
+            sys.exit(1)
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+def content_digest(data):
+    """Key for exact hits: a hash of the uploaded bytes."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def perceptual_hash(img_arr):
+    """64-bit difference hash of the preprocessed face, stable under small pixel noise."""
+    gray = img_arr if img_arr.ndim == 2 else img_arr.mean(axis=-1)
+    small = np.asarray(Image.fromarray(gray.astype('float32'), mode='F').resize((9, 8), Image.BOX))
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class PredictionCache:
+    """Bounded LRU cache with TTL for (label, prob_map) results.
+
+    Exact hits are keyed on content_digest() of the upload. Near-duplicate hits are keyed on
+    perceptual_hash() and match any entry within hamming_threshold bits (a negative threshold
+    disables them).
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=300.0, hamming_threshold=3):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.hamming_threshold = hamming_threshold
+        self._exact = OrderedDict()
+        self._near = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'exact_hits': 0, 'near_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def _live(self, entries, key, now):
+        expires, result = entries[key]
+        if expires < now:
+            del entries[key]
+            self.counters['expirations'] += 1
+            return None
+        entries.move_to_end(key)
+        return result
+
+    def get_exact(self, digest):
+        with self._lock:
+            result = self._live(self._exact, digest, time.monotonic()) if digest in self._exact else None
+            if result is not None:
+                self.counters['exact_hits'] += 1
+            return result
+
+    def get_near(self, phash):
+        """Look up a near-duplicate. A miss here counts as a cache miss."""
+        with self._lock:
+            now = time.monotonic()
+            result = None
+            if self.hamming_threshold >= 0:
+                best = None
+                for key in list(self._near):
+                    distance = (key ^ phash).bit_count()
+                    if distance <= self.hamming_threshold and (best is None or distance < best[0]):
+                        best = (distance, key)
+                if best is not None:
+                    result = self._live(self._near, best[1], now)
+            self.counters['near_hits' if result is not None else 'misses'] += 1
+            return result
+
+    def put(self, digest, phash, result):
+        with self._lock:
+            expires = time.monotonic() + self.ttl
+            for entries, key in ((self._exact, digest), (self._near, phash)):
+                entries[key] = (expires, result)
+                entries.move_to_end(key)
+                while len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+                    if entries is self._exact:
+                        self.counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._exact))
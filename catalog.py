@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from urllib.parse import quote, unquote, urlsplit
+
+
+SONGS_URL_PREFIX = '/audio/'
+# Songs used to be served straight from the static folder; song_path still accepts those URLs.
+LEGACY_SONGS_URL_PREFIX = '/static/songs/'
+
+
+def file_version(size, mtime_ns):
+    """Short token that changes whenever a file is replaced, for cache-busting URLs."""
+    return '{:x}-{:x}'.format(mtime_ns, size)
+
+
+def song_url(relpath, version=None):
+    """Public URL of a song, given its path relative to the songs folder.
+
+    With a ``version`` (see ``file_version``) the URL changes whenever the file does, so the
+    response can be cached as immutable.
+    """
+    url = SONGS_URL_PREFIX + quote(relpath.replace(os.sep, '/'))
+    return url + '?v=' + version if version else url
+
+
+def song_path(url):
+    """Inverse of ``song_url``: the song's path relative to the songs folder, with '/' separators."""
+    path = unquote(urlsplit(url).path)
+    for prefix in (SONGS_URL_PREFIX, LEGACY_SONGS_URL_PREFIX):
+        if path.startswith(prefix):
+            return path[len(prefix):]
+    return path.lstrip('/')
+
+
+# Affinity of a song for an emotion (see scoring.SongScorer): FOLDER_WEIGHT for its emotion folder, TAG_WEIGHT
+# for each emotion whose tags appear in the name of a file in the root folder
+FOLDER_WEIGHT = 1.0
+TAG_WEIGHT = 0.5
+
+
+class SongCatalog:
+    """In-memory index of the songs in the local songs folder and its emotion subfolders (``happy/``).
+
+    Matching songs to emotions is scoring.SongScorer's job. Lookups by path are O(1); the folder is only
+    rescanned when a directory mtime changes, and then only the directories that changed. ``refresh`` runs at most
+    once per ``refresh_interval`` seconds; ``invalidate`` forces the next one (e.g. from a
+    filesystem watch).
+
+    With a ``SongIndex`` (song_index.py) the catalog is loaded from the index instead, and reloaded
+    whenever a scan bumps its generation; the folder is only scanned while the index is still empty.
+    """
+
+    def __init__(self, root, emotion_tags, extensions, refresh_interval=2.0, index=None):
+        self.root = root
+        self.emotion_tags = emotion_tags
+        self.extensions = extensions
+        self.refresh_interval = refresh_interval
+        self.index = index
+        self._generation = 0
+        self.version = 0
+        self._lock = threading.Lock()
+        self._checked = 0.0
+        # directory relative to root ('' for root) -> (mtime_ns, sorted [(file name, file version)])
+        self._dirs = {}
+        # directory relative to root -> [(song relpath, song), ...]
+        self._folder_songs = {}
+        self._entries = []
+        self._by_path = {}
+
+    def invalidate(self):
+        self._checked = 0.0
+
+    def _scan(self, relpath):
+        path = os.path.join(self.root, relpath)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            files = []
+            with os.scandir(path) as entries:
+                for e in entries:
+                    if os.path.splitext(e.name)[1].lower() in self.extensions and e.is_file():
+                        st = e.stat()
+                        files.append((e.name, file_version(st.st_size, st.st_mtime_ns)))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return mtime, sorted(files)
+
+    def _mtime(self, relpath):
+        try:
+            return os.stat(os.path.join(self.root, relpath)).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def refresh(self, force=False):
+        """Rescan directories whose mtime changed (or reload a newer index); return True if the catalog changed."""
+        now = time.monotonic()
+        if not force and now - self._checked < self.refresh_interval:
+            return False
+        with self._lock:
+            if not force and now - self._checked < self.refresh_interval:
+                return False
+            self._checked = now
+            generation = self.index.generation() if self.index is not None else 0
+            if generation:
+                return self._load_index(generation)
+            folders = [''] + [emotion.lower() for emotion in self.emotion_tags]
+            changed = []
+            for relpath in folders:
+                known = self._dirs.get(relpath)
+                if self._mtime(relpath) != (known[0] if known else None):
+                    scanned = self._scan(relpath)
+                    if scanned is None:
+                        self._dirs.pop(relpath, None)
+                    else:
+                        self._dirs[relpath] = scanned
+                    changed.append(relpath)
+            if not changed:
+                return False
+            self._rebuild(changed)
+            self.version += 1
+            return True
+
+    def _load_index(self, generation):
+        if generation == self._generation:
+            return False
+        self._generation, self._entries = self.index.load(self.emotion_tags)
+        self._by_path = dict(self._entries)
+        self.version += 1
+        return True
+
+    def _rebuild(self, changed):
+        folder_songs = dict(self._folder_songs)
+        for folder in changed:
+            folder_songs[folder] = [(os.path.join(folder, name), self._song(name, os.path.join(folder, name), version))
+                                    for name, version in self._dirs.get(folder, (None, []))[1]]
+        # Swap in whole lists so readers never see a half-built index
+        self._folder_songs = folder_songs
+        self._entries = [entry for entries in folder_songs.values() for entry in entries]
+        self._by_path = {relpath.replace(os.sep, '/'): song for relpath, song in self._entries}
+
+    @staticmethod
+    def _song(name, relpath, version=None):
+        return {
+            'title': os.path.splitext(name)[0],
+            'url': song_url(relpath, version),
+            'type': 'local'
+        }
+
+    def song(self, path):
+        """The song at ``path`` (relative to the songs folder, '/' separators), or None if not in the catalog."""
+        self.refresh()
+        return self._by_path.get(path)
+
+    def entries(self):
+        """Every song in the root and emotion folders, as (path relative to the songs folder, song)."""
+        self.refresh()
+        return self._entries
@@ -0,0 +1,153 @@
+import os
+import tempfile
+
+# Runtime settings, read from environment variables so Render/gunicorn can tune them without code changes.
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+MODEL_PATH = os.environ.get('MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model', 'model_v6_23.hdf5'))
+
+# Inference backend: 'keras' (TensorFlow), 'numpy' (reads the HDF5 weights directly, no TensorFlow import),
+# 'tflite' (a converted .tflite file from convert_model.py, set MODEL_PATH to it) or 'stub' (no model, for load tests).
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'keras')
+
+# Run a synthetic inference at startup so readiness means "first request is fast".
+MODEL_WARMUP = env_bool('MODEL_WARMUP', True)
+
+# Threads per forward pass in each process holding the model; 0 keeps the backend's default (every core).
+MODEL_THREADS = env_int('MODEL_THREADS', 0)
+
+# Load the model in the gunicorn master before forking, so workers share its pages copy-on-write.
+# Off by default for the keras backend: TensorFlow's runtime threads don't survive fork().
+PRELOAD_APP = env_bool('PRELOAD_APP', MODEL_BACKEND != 'keras')
+
+# /predict/batch: max images per request, max uncompressed size of one zip entry, and decode threads.
+BATCH_ENDPOINT_MAX_IMAGES = env_int('BATCH_ENDPOINT_MAX_IMAGES', 256)
+BATCH_ENDPOINT_MAX_ENTRY_BYTES = env_int('BATCH_ENDPOINT_MAX_ENTRY_BYTES', 20 * 1024 * 1024)
+DECODE_THREADS = env_int('DECODE_THREADS', min(8, os.cpu_count() or 1))
+
+# Per-worker LRU cache of predictions. Size 0 disables it; a negative Hamming threshold disables near-duplicate hits.
+PREDICTION_CACHE_SIZE = env_int('PREDICTION_CACHE_SIZE', 1024)
+PREDICTION_CACHE_TTL = env_float('PREDICTION_CACHE_TTL', 300.0)
+PREDICTION_CACHE_HAMMING = env_int('PREDICTION_CACHE_HAMMING', 3)
+
+# Shared inference sidecar (inference_server.py). With INFERENCE_SIDECAR gunicorn starts and supervises it;
+# with INFERENCE_SOCKET set, workers send tensors to it instead of loading the model themselves.
+DEFAULT_INFERENCE_SOCKET = '/tmp/emotitunes-inference.sock'
+INFERENCE_SIDECAR = env_bool('INFERENCE_SIDECAR', False)
+INFERENCE_SOCKET = os.environ.get('INFERENCE_SOCKET') or (DEFAULT_INFERENCE_SOCKET if INFERENCE_SIDECAR else '')
+INFERENCE_TIMEOUT = env_float('INFERENCE_TIMEOUT', 10.0)
+SIDECAR_BATCH_MAX_SIZE = env_int('SIDECAR_BATCH_MAX_SIZE', 32)
+
+# Live camera WebSocket (/live, needs flask-sock): per-viewer frame budget, EMA weight of each new frame and the
+# probability lead another emotion needs before the label switches. Sessions per worker: see LIVE_MAX_SESSIONS.
+LIVE_MAX_FPS = env_float('LIVE_MAX_FPS', 5.0)
+LIVE_SMOOTHING = env_float('LIVE_SMOOTHING', 0.3)
+LIVE_SWITCH_MARGIN = env_float('LIVE_SWITCH_MARGIN', 0.1)
+
+# Admission control for the inference endpoints. Body limits are checked against Content-Length before
+# the upload is read; the pixel limit is checked from the image header before decoding.
+MAX_UPLOAD_BYTES = env_int('MAX_UPLOAD_BYTES', 10 * 1024 * 1024)
+MAX_BATCH_UPLOAD_BYTES = env_int('MAX_BATCH_UPLOAD_BYTES', 100 * 1024 * 1024)
+MAX_IMAGE_PIXELS = env_int('MAX_IMAGE_PIXELS', 40_000_000)
+# Inference requests admitted per worker process (running + queued); beyond that /predict sheds with 503.
+MAX_PENDING_INFERENCES = env_int('MAX_PENDING_INFERENCES', 32)
+OVERLOAD_RETRY_AFTER = env_float('OVERLOAD_RETRY_AFTER', 1.0)
+# Per-client token bucket (requests/second and burst). A rate of 0 disables rate limiting.
+RATE_LIMIT_PER_SECOND = env_float('RATE_LIMIT_PER_SECOND', 10.0)
+RATE_LIMIT_BURST = env_float('RATE_LIMIT_BURST', 30.0)
+# Identify clients by the X-Forwarded-For address a reverse proxy appends (the last one) rather than the socket address.
+# Only safe when every request comes through such a proxy (render.yaml turns it on): otherwise clients pick their key.
+TRUST_FORWARDED_FOR = env_bool('TRUST_FORWARDED_FOR', False)
+
+# How often (seconds) the local song catalog checks static/songs for changed directory mtimes.
+CATALOG_REFRESH_SECONDS = env_float('CATALOG_REFRESH_SECONDS', 2.0)
+
+# SQLite song index (song_index.py) with tags, duration and bitrate. When SONG_INDEX_PATH is set, workers read
+# the catalog from it and gunicorn runs a background scanner every SONG_INDEX_SCAN_SECONDS (0: scan offline only).
+DEFAULT_SONG_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'song_index.sqlite3')
+SONG_INDEX_PATH = os.environ.get('SONG_INDEX_PATH', '')
+SONG_INDEX_SCAN_SECONDS = env_float('SONG_INDEX_SCAN_SECONDS', 60.0)
+
+# Emotion tags estimated from the audio (audio_tagger.py) for songs without a folder or file-name tag.
+# Build them offline; when AUDIO_TAGS_PATH is set, song picks use them.
+DEFAULT_AUDIO_TAGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audio_tags.sqlite3')
+AUDIO_TAGS_PATH = os.environ.get('AUDIO_TAGS_PATH', '')
+
+# "More like this" index (similarity.py) over the audio_tagger descriptors. When SIMILARITY_INDEX_DIR is set,
+# /similar is enabled and gunicorn runs one updater every SIMILARITY_SCAN_SECONDS (0: update offline only).
+# Libraries above SIMILARITY_EXACT_MAX songs use an approximate IVF index scanning SIMILARITY_NPROBE lists.
+DEFAULT_SIMILARITY_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'similarity_index')
+SIMILARITY_INDEX_DIR = os.environ.get('SIMILARITY_INDEX_DIR', '')
+SIMILARITY_SCAN_SECONDS = env_float('SIMILARITY_SCAN_SECONDS', 300.0)
+SIMILARITY_EXACT_MAX = env_int('SIMILARITY_EXACT_MAX', 20000)
+SIMILARITY_NPROBE = env_int('SIMILARITY_NPROBE', 8)
+
+# Gunicorn threads per worker (gthread when > 1). Audio downloads (/audio, /preview) and live sessions hold a thread
+# for as long as the client takes: at most AUDIO_MAX_STREAMS and LIVE_MAX_SESSIONS of them per worker, and together
+# never all of its threads, so /predict always has one. Unversioned audio URLs are cached for AUDIO_CACHE_SECONDS.
+GUNICORN_THREADS = env_int('GUNICORN_THREADS', 4)
+AUDIO_MAX_STREAMS = env_int('AUDIO_MAX_STREAMS', max(1, GUNICORN_THREADS // 2))
+LIVE_MAX_SESSIONS = env_int('LIVE_MAX_SESSIONS', max(0, (GUNICORN_THREADS - 1) // 2))
+AUDIO_CACHE_SECONDS = env_int('AUDIO_CACHE_SECONDS', 24 * 3600)
+# Hand audio bodies to the front proxy instead: 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx, with
+# an internal location at AUDIO_ACCEL_PREFIX aliased to static/songs/). Empty serves them from the app via sendfile().
+AUDIO_OFFLOAD = os.environ.get('AUDIO_OFFLOAD', '').lower()
+AUDIO_ACCEL_PREFIX = os.environ.get('AUDIO_ACCEL_PREFIX', '/_audio/')
+
+# MP3 previews (/preview): clip length by default and at most, and how many songs' frame tables each worker caches.
+PREVIEW_SECONDS = env_float('PREVIEW_SECONDS', 30.0)
+PREVIEW_MAX_SECONDS = env_float('PREVIEW_MAX_SECONDS', 60.0)
+PREVIEW_CACHE_SIZE = env_int('PREVIEW_CACHE_SIZE', 256)
+
+# Metrics (/metrics, Server-Timing). Each worker writes its counters to METRICS_DIR every METRICS_FLUSH_SECONDS so
+# any worker can serve totals for all of them; empty keeps metrics per process.
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'emotitunes-metrics'))
+METRICS_FLUSH_SECONDS = env_float('METRICS_FLUSH_SECONDS', 2.0)
+
+# Profiling of prediction requests, off unless PROFILE_DIR is set: cProfile PROFILE_SAMPLE_RATE of them, and keep the
+# stack samples (every PROFILE_STACK_INTERVAL_MS) of any taking PROFILE_SLOW_MS or more. The newest PROFILE_KEEP are kept.
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+PROFILE_SAMPLE_RATE = env_float('PROFILE_SAMPLE_RATE', 0.0)
+PROFILE_SLOW_MS = env_float('PROFILE_SLOW_MS', 1000.0)
+PROFILE_STACK_INTERVAL_MS = env_float('PROFILE_STACK_INTERVAL_MS', 5.0)
+PROFILE_KEEP = env_int('PROFILE_KEEP', 50)
+# Bearer token for the /admin endpoints (saved profiles); empty disables them.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Threads running decoding, inference and song ranking in the ASGI entry point (asgi_app.py).
+ASGI_THREADS = env_int('ASGI_THREADS', min(4, os.cpu_count() or 1))
+
+# Startup autotuning (AUTOTUNE=1, applied by gunicorn.conf.py): measure predict_emotion on the cores this container may
+# use and pick workers x MODEL_THREADS x BATCH_MAX_SIZE for the most predictions per second with a p95 latency under
+# AUTOTUNE_TARGET_MS, spending AUTOTUNE_SECONDS per candidate. This delays binding the port, so a candidate whose
+# processes haven't loaded the model within AUTOTUNE_LOAD_TIMEOUT is dropped, and calibration stops after
+# AUTOTUNE_MAX_SECONDS. The result is saved to AUTOTUNE_PATH and reused until the CPUs, model or backend change; the app
+# directory is replaced on every deploy, so point it at a persistent disk to calibrate only once. Settings given
+# explicitly in the environment always win.
+AUTOTUNE = env_bool('AUTOTUNE', False)
+AUTOTUNE_PATH = os.environ.get('AUTOTUNE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autotune.json'))
+AUTOTUNE_TARGET_MS = env_float('AUTOTUNE_TARGET_MS', 100.0)
+AUTOTUNE_SECONDS = env_float('AUTOTUNE_SECONDS', 2.0)
+AUTOTUNE_LOAD_TIMEOUT = env_float('AUTOTUNE_LOAD_TIMEOUT', 60.0)
+AUTOTUNE_MAX_SECONDS = env_float('AUTOTUNE_MAX_SECONDS', 120.0)
+
+# Micro-batching of concurrent /predict calls. A max batch size of 1 disables the scheduler.
+BATCH_MAX_SIZE = env_int('BATCH_MAX_SIZE', 1)
+BATCH_MAX_WAIT_MS = env_float('BATCH_MAX_WAIT_MS', 5.0)
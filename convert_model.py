@@ -0,0 +1,117 @@
+"""Offline converter from the Keras HDF5 model to a quantized .tflite model.
+
+Example:
+    python convert_model.py model/model_v6_23.hdf5 --quantize int8 --calibration-dir faces/
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from recommend import load_model_info, preprocess_image
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+
+def load_faces(folder, input_shape, channels, limit=None):
+    """Preprocess every image in ``folder`` the same way /predict does."""
+    faces = []
+    for name in sorted(os.listdir(folder)):
+        if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+            continue
+        with open(os.path.join(folder, name), 'rb') as f:
+            faces.append(preprocess_image(f, input_shape, channels))
+        if limit and len(faces) >= limit:
+            break
+    if not faces:
+        raise ValueError('No images found in {}'.format(folder))
+    return np.stack(faces)
+
+
+def convert(keras_model, quantize, calibration=None):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantize == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        if calibration is None:
+            raise ValueError('int8 quantization needs calibration faces (--calibration-dir)')
+
+        def representative_dataset():
+            for face in calibration:
+                yield [face[np.newaxis].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantize == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantize != 'none':
+        raise ValueError('Unknown quantization mode: {}'.format(quantize))
+    return converter.convert()
+
+
+def _median_latency_ms(model, x, runs):
+    model.predict(x[:1], verbose=0)
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        model.predict(x[i % len(x):i % len(x) + 1], verbose=0)
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(timings))
+
+
+def evaluate(keras_model, tflite_path, faces, runs=100):
+    """Report size, single-image latency and top-1 agreement of the converted model."""
+    from tflite_model import TFLiteModel
+
+    tflite = TFLiteModel(tflite_path)
+    expected = keras_model.predict(faces, verbose=0)
+    actual = tflite.predict(faces)
+    return {
+        'tflite_path': tflite_path,
+        'tflite_bytes': os.path.getsize(tflite_path),
+        'samples': len(faces),
+        'top1_agreement': float((expected.argmax(-1) == actual.argmax(-1)).mean()),
+        'max_abs_diff': float(np.abs(expected - actual).max()),
+        'keras_latency_ms': _median_latency_ms(keras_model, faces, runs),
+        'tflite_latency_ms': _median_latency_ms(tflite, faces, runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the emotion model to a quantized .tflite file.')
+    parser.add_argument('model_path')
+    parser.add_argument('--quantize', choices=['none', 'dynamic', 'float16', 'int8'], default='int8')
+    parser.add_argument('--calibration-dir', help='folder of sample face images for int8 calibration')
+    parser.add_argument('--calibration-limit', type=int, default=200)
+    parser.add_argument('--eval-dir', help='folder of face images for the agreement check (default: calibration dir)')
+    parser.add_argument('--output', help='output .tflite path')
+    args = parser.parse_args()
+
+    keras_model, input_shape, channels = load_model_info(args.model_path, 'keras')
+    calibration = None
+    if args.calibration_dir:
+        calibration = load_faces(args.calibration_dir, input_shape, channels, args.calibration_limit)
+
+    output = args.output or '{}_{}.tflite'.format(os.path.splitext(args.model_path)[0], args.quantize)
+    with open(output, 'wb') as f:
+        f.write(convert(keras_model, args.quantize, calibration))
+
+    eval_dir = args.eval_dir or args.calibration_dir
+    if eval_dir:
+        faces = load_faces(eval_dir, input_shape, channels)
+    else:
+        faces = np.random.default_rng(0).random((32,) + tuple(keras_model.input_shape[1:]), dtype=np.float32)
+    report = evaluate(keras_model, output, faces)
+    report['source_bytes'] = os.path.getsize(args.model_path)
+    report['quantize'] = args.quantize
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
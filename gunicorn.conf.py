@@ -0,0 +1,66 @@
+import glob
+import os
+import subprocess
+import sys
+
+import autotune
+from config import (AUTOTUNE, GUNICORN_THREADS, INFERENCE_SIDECAR, INFERENCE_SOCKET, METRICS_DIR, PRELOAD_APP,
+                    SIMILARITY_INDEX_DIR, SIMILARITY_SCAN_SECONDS, SONG_INDEX_PATH, SONG_INDEX_SCAN_SECONDS)
+from metrics import mark_process_dead
+
+# Workers, model threads and batch size measured for this machine (saved in AUTOTUNE_PATH, reused on later boots).
+# This runs before the app is loaded, so its model threads and batch size are the ones the app sees.
+if AUTOTUNE:
+    _tuned = autotune.load_or_calibrate()
+    if _tuned is not None:
+        autotune.apply(_tuned)
+        if 'WEB_CONCURRENCY' not in os.environ:
+            workers = _tuned['workers']
+
+# With preload_app the model is loaded and warmed once in the master, then shared copy-on-write by the workers.
+# In sidecar mode there is no model in the workers to share, and the sidecar only starts after preloading.
+preload_app = PRELOAD_APP and not INFERENCE_SIDECAR
+
+# More than one thread switches gunicorn to gthread workers: a song download or a live WebSocket then holds one
+# thread instead of the whole worker. Full-file audio responses go out through sendfile() either way.
+threads = GUNICORN_THREADS
+
+_sidecar = None
+_song_scanner = None
+_similarity_updater = None
+
+
+def on_starting(server):
+    # One supervised inference process owns the model; workers connect to it over INFERENCE_SOCKET.
+    global _sidecar, _song_scanner, _similarity_updater
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Worker metric snapshots of an earlier server run would otherwise linger in METRICS_DIR.
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            os.remove(path)
+    if INFERENCE_SIDECAR:
+        script = os.path.join(here, 'inference_server.py')
+        _sidecar = subprocess.Popen([sys.executable, script, '--supervise', '--socket', INFERENCE_SOCKET])
+    # One scanner for all workers keeps the song index fresh; workers only read it.
+    if SONG_INDEX_PATH and SONG_INDEX_SCAN_SECONDS > 0:
+        script = os.path.join(here, 'song_index.py')
+        _song_scanner = subprocess.Popen([sys.executable, script, '--db', SONG_INDEX_PATH,
+                                          '--watch', str(SONG_INDEX_SCAN_SECONDS)])
+    # Likewise one process tags new songs and appends them to the similarity index.
+    if SIMILARITY_INDEX_DIR and SIMILARITY_SCAN_SECONDS > 0:
+        script = os.path.join(here, 'similarity.py')
+        _similarity_updater = subprocess.Popen([sys.executable, script, '--dir', SIMILARITY_INDEX_DIR,
+                                                '--watch', str(SIMILARITY_SCAN_SECONDS)])
+
+
+def child_exit(server, worker):
+    # A dead worker's counters still count towards the totals at /metrics, its gauges no longer do.
+    if METRICS_DIR:
+        mark_process_dead(METRICS_DIR, worker.pid)
+
+
+def on_exit(server):
+    for process in (_sidecar, _song_scanner, _similarity_updater):
+        if process is not None:
+            process.terminate()
+            process.wait(10)
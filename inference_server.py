@@ -0,0 +1,275 @@
+"""Shared inference sidecar: one process owns the model, gunicorn workers talk to it over a Unix socket.
+
+Tensors travel through a shared-memory segment owned by each client connection; only a small JSON
+header goes over the socket. Requests from all workers are coalesced by one BatchScheduler.
+
+    python inference_server.py --supervise     # restart the server whenever it exits
+"""
+import argparse
+import atexit
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import config
+from batching import BatchScheduler
+from recommend import load_model_info, predict_emotions, warm_up_model
+
+_HEADER = struct.Struct('!I')
+
+
+def _send_msg(sock, obj):
+    payload = json.dumps(obj).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('Inference connection closed')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv_msg(sock):
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, size))
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # The client owns the segment; stop our resource tracker from unlinking it when we exit.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        segments = {}
+        try:
+            _send_msg(self.request, {'input_shape': list(server.model.input_shape[1:])})
+            while True:
+                try:
+                    msg = _recv_msg(self.request)
+                except ConnectionError:
+                    return
+                try:
+                    if msg['shm'] not in segments:
+                        segments[msg['shm']] = _attach(msg['shm'])
+                    shape = tuple(msg['shape'])
+                    batch = np.ndarray(shape, dtype=np.float32, buffer=segments[msg['shm']].buf)
+                    if shape[0] == 1:
+                        # Copy out of the segment: the scheduler may hold on to its input after replying.
+                        results = [server.scheduler.predict(batch[0].copy())]
+                    else:
+                        results = predict_emotions(server.model, batch)
+                    del batch
+                    _send_msg(self.request, {'probs': [list(probs.values()) for _, probs in results]})
+                except Exception as e:
+                    _send_msg(self.request, {'error': str(e)})
+        finally:
+            for shm in segments.values():
+                shm.close()
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, model, scheduler):
+        self.model = model
+        self.scheduler = scheduler
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _Handler)
+
+
+def serve(socket_path):
+    model, input_shape, channels = load_model_info(config.MODEL_PATH, config.MODEL_BACKEND, config.MODEL_THREADS)
+    warm_up_model(model, input_shape, channels, sorted({1, config.SIDECAR_BATCH_MAX_SIZE}))
+    scheduler = BatchScheduler(model, config.SIDECAR_BATCH_MAX_SIZE, config.BATCH_MAX_WAIT_MS)
+    server = InferenceServer(socket_path, model, scheduler)
+    print('Inference server listening on', socket_path, flush=True)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def supervise(socket_path, max_backoff=30.0):
+    """Run the server in a child process and restart it whenever it exits."""
+    child = None
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        if child is not None and child.poll() is None:
+            child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    backoff = 1.0
+    while not stopping:
+        started = time.monotonic()
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--socket', socket_path])
+        code = child.wait()
+        if stopping:
+            break
+        # A server that stayed up for a while gets restarted straight away.
+        backoff = 1.0 if time.monotonic() - started > 60 else min(backoff * 2, max_backoff)
+        print('Inference server exited with code {}, restarting in {:.0f}s'.format(code, backoff), flush=True)
+        time.sleep(backoff)
+
+
+class InferenceClient:
+    """Model stand-in for Flask workers: ``predict`` forwards batches to the sidecar.
+
+    Each thread keeps its own connection and shared-memory segment. Any socket error or timeout
+    drops the connection, so the next call reconnects (e.g. after the sidecar restarted).
+
+    Nothing connects up front: the sidecar may still be loading its model when the workers start.
+    ``input_shape`` is None until ``connect`` (or the first ``predict``) has reached it.
+    """
+
+    def __init__(self, socket_path, timeout=10.0, max_backoff=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.input_shape = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._local = threading.local()
+        self._segments = set()
+        self._segments_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def connect(self):
+        """Learn the model input shape from the sidecar unless already known; True once it is.
+
+        A failed attempt is only retried after a backoff that doubles up to ``max_backoff`` seconds;
+        calls before then return False straight away.
+        """
+        if self.input_shape is not None:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            sock, _ = self._connect()
+        except OSError:
+            self._backoff = min(max(self._backoff * 2, 0.5), self.max_backoff)
+            self._retry_at = time.monotonic() + self._backoff
+            return False
+        sock.close()
+        return True
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            hello = _recv_msg(sock)
+        except BaseException:
+            sock.close()
+            raise
+        self.input_shape = (None,) + tuple(hello['input_shape'])
+        return sock, hello
+
+    def _connection(self, nbytes):
+        """Return (sock, shm, reused) for this thread, connecting if needed."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # Inherited across fork(): the parent still owns these, start fresh.
+            local.sock = local.shm = None
+            local.pid = os.getpid()
+            with self._segments_lock:
+                self._segments = set()
+        reused = local.sock is not None
+        if not reused:
+            local.sock, _ = self._connect()
+        if local.shm is None or local.shm.size < nbytes:
+            self._release_shm()
+            local.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1 << 16))
+            with self._segments_lock:
+                self._segments.add(local.shm)
+        return local.sock, local.shm, reused
+
+    def _release_shm(self):
+        shm = getattr(self._local, 'shm', None)
+        if shm is not None:
+            with self._segments_lock:
+                self._segments.discard(shm)
+            shm.close()
+            shm.unlink()
+        self._local.shm = None
+
+    def _disconnect(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+        self._local.sock = None
+        # The server may still be reading the old segment, so never reuse it.
+        self._release_shm()
+
+    def close(self):
+        """Unlink every segment this process created (registered with atexit)."""
+        with self._segments_lock:
+            segments, self._segments = self._segments, set()
+        for shm in segments:
+            try:
+                shm.close()
+                shm.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+
+    def predict(self, x, verbose=0, batch_size=None):
+        if not self.connect():
+            raise ConnectionError('Inference server unavailable, retry later')
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        while True:
+            reused = False
+            try:
+                # Connecting fails too while the sidecar restarts (its socket is gone or not listening yet)
+                sock, shm, reused = self._connection(x.nbytes)
+                np.ndarray(x.shape, dtype=np.float32, buffer=shm.buf)[...] = x
+                _send_msg(sock, {'shm': shm.name, 'shape': list(x.shape)})
+                reply = _recv_msg(sock)
+                break
+            except socket.timeout:
+                self._disconnect()
+                raise TimeoutError('Inference server did not answer within {}s'.format(self.timeout))
+            except OSError as e:
+                self._disconnect()
+                # A kept-alive connection may predate a sidecar restart: retry once on a fresh one.
+                if not reused:
+                    # ConnectionError is what callers treat as "unavailable, retry later" (a 503)
+                    raise ConnectionError('Inference server unavailable: {}'.format(e)) from e
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return np.array(reply['probs'], dtype=np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared inference sidecar for the gunicorn workers.')
+    parser.add_argument('--socket', default=config.INFERENCE_SOCKET or config.DEFAULT_INFERENCE_SOCKET)
+    parser.add_argument('--supervise', action='store_true', help='restart the server whenever it exits')
+    args = parser.parse_args()
+    if args.supervise:
+        supervise(args.socket)
+    else:
+        serve(args.socket)
@@ -0,0 +1,114 @@
+import json
+import time
+
+import numpy as np
+
+
+class EmotionSmoother:
+    """Exponential moving average over probability maps, with hysteresis on the reported label.
+
+    The label only switches when another emotion's smoothed probability beats the current one
+    by at least ``margin``, so the UI doesn't flicker between two close emotions.
+    """
+
+    def __init__(self, alpha=0.3, margin=0.1):
+        self.alpha = alpha
+        self.margin = margin
+        self.labels = None
+        self.probs = None
+        self.label = None
+
+    def update(self, prob_map):
+        """Fold in one frame's probabilities; return (label, smoothed prob_map, changed)."""
+        if self.labels is None:
+            self.labels = list(prob_map)
+            self.probs = np.array([prob_map[k] for k in self.labels], dtype=np.float64)
+        else:
+            frame = np.array([prob_map[k] for k in self.labels], dtype=np.float64)
+            self.probs += self.alpha * (frame - self.probs)
+        best = self.labels[int(np.argmax(self.probs))]
+        changed = False
+        if self.label is None:
+            self.label, changed = best, True
+        elif best != self.label:
+            current = self.probs[self.labels.index(self.label)]
+            if self.probs[self.labels.index(best)] - current >= self.margin:
+                self.label, changed = best, True
+        return self.label, {k: float(p) for k, p in zip(self.labels, self.probs)}, changed
+
+
+class LiveSession:
+    """Drives one live-camera connection: newest frame in, rolling estimate out.
+
+    ``ws`` needs ``receive(timeout=None)`` and ``send(data)``, as provided by flask-sock. Binary
+    messages are frames (raw pixels for ``classify``), text messages are JSON settings such as
+    ``{"fps": 2}``. Frames that arrive while one is being classified are not queued: only the newest
+    is kept and the rest are counted as dropped. ``on_change(label, smoothed probabilities)`` returns
+    extra fields for the estimate sent whenever the smoothed label changes.
+    """
+
+    def __init__(self, ws, classify, on_change, max_fps=5.0, smoother=None):
+        self.ws = ws
+        self.classify = classify
+        self.on_change = on_change
+        self.max_fps = max_fps
+        self.fps = max_fps
+        self.smoother = smoother or EmotionSmoother()
+        self.processed = 0
+        self.dropped = 0
+
+    def _handle_text(self, message):
+        try:
+            settings = json.loads(message)
+            self.fps = min(max(float(settings.get('fps', self.fps)), 0.1), self.max_fps)
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+    def _latest_frame(self, frame=None):
+        """Drain everything already buffered and return the newest frame, blocking only if there is none."""
+        while True:
+            message = self.ws.receive(timeout=0 if frame is not None else None)
+            if message is None:
+                if frame is not None:
+                    return frame
+            elif isinstance(message, str):
+                self._handle_text(message)
+            else:
+                if frame is not None:
+                    self.dropped += 1
+                frame = message
+
+    def run(self):
+        frame = None
+        next_allowed = 0.0
+        while True:
+            frame = self._latest_frame(frame)
+            wait = next_allowed - time.monotonic()
+            if wait > 0:
+                # Over the frame budget: sleep, then prefer whatever newer frame arrived meanwhile.
+                time.sleep(wait)
+                continue
+            frame, pending = None, frame
+            next_allowed = time.monotonic() + 1.0 / self.fps
+            started = time.perf_counter()
+            try:
+                frame_label, prob_map = self.classify(pending)
+            except Exception as e:
+                self.ws.send(json.dumps({'type': 'error', 'error': str(e)}))
+                continue
+            self.processed += 1
+            label, smoothed, changed = self.smoother.update(prob_map)
+            message = {
+                'type': 'estimate',
+                'emotion': label,
+                'probabilities': smoothed,
+                'frame_emotion': frame_label,
+                'changed': changed,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'latency_ms': round((time.perf_counter() - started) * 1000.0, 2),
+            }
+            if changed:
+                # Recommendations only refresh when the smoothed emotion actually changes.
+                message.update(self.on_change(label, smoothed))
+            self.ws.send(json.dumps(message))
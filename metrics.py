@@ -0,0 +1,284 @@
+"""Request metrics: per-stage timings for the Server-Timing header, latency histograms, counters
+and gauges, merged across gunicorn workers and rendered in the Prometheus text format.
+
+Each worker keeps its metrics in memory; a background thread writes them to
+``<directory>/<master pid>-<pid>.json`` every ``flush_interval`` seconds. ``collect`` merges the
+files of all workers of one master: counters and histograms are summed, gauges only over live workers.
+When a worker exits, gunicorn's child_exit calls ``mark_process_dead``, which folds its counters and
+histograms into ``<master pid>-archive.json`` and deletes its file, so recycled workers still count
+without their files piling up.
+"""
+import bisect
+import glob
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = 'emotitunes_'
+# Upper bounds in seconds of the latency histogram buckets; the last bucket is +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.9, 0.99)
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in sorted(labels.items()))
+
+
+def _series(name, labels, extra=''):
+    labels = ','.join(part for part in (labels, extra) if part)
+    return PREFIX + name + ('{' + labels + '}' if labels else '')
+
+
+def _format(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def quantile(buckets, q):
+    """Estimate of the ``q`` quantile from histogram bucket counts, interpolating within the bucket
+    (like Prometheus' histogram_quantile); None when empty."""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            if i == len(BUCKETS):
+                return BUCKETS[-1]
+            lower = BUCKETS[i - 1] if i else 0.0
+            return lower + (BUCKETS[i] - lower) * (rank - seen) / count
+        seen += count
+    return BUCKETS[-1]
+
+
+def _merge(snapshots):
+    """Sum snapshots: {'counters', 'histograms', 'gauges'}, each {(name, labels): value}."""
+    merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            for name, labels, value in snapshot[kind]:
+                merged[kind][name, labels] = merged[kind].get((name, labels), 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            total = merged['histograms'].get((name, labels))
+            merged['histograms'][name, labels] = (histogram if total is None
+                                                  else [a + b for a, b in zip(total, histogram)])
+    return merged
+
+
+def mark_process_dead(directory, pid):
+    """Fold an exited worker's counters and histograms into its master's archive and delete its file;
+    its gauges are dropped. Only the master calls this, one worker at a time."""
+    suffix = '-{}.json'.format(pid)
+    for path in glob.glob(os.path.join(directory, '*' + suffix)):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        archive_path = path[:-len(suffix)] + '-archive.json'
+        snapshots = [{'counters': snapshot['counters'], 'histograms': snapshot['histograms'], 'gauges': []}]
+        try:
+            with open(archive_path) as f:
+                snapshots.append(json.load(f))
+        except FileNotFoundError:
+            pass
+        merged = _merge(snapshots)
+        _write(archive_path, {
+            'counters': [[name, labels, value] for (name, labels), value in merged['counters'].items()],
+            'histograms': [[name, labels, h] for (name, labels), h in merged['histograms'].items()],
+            'gauges': [],
+        })
+        os.remove(path)
+
+
+def _write(path, snapshot):
+    tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+class Metrics:
+    """Counters, histograms and gauges of this process, plus the merged view of all workers.
+
+    Series are a name plus keyword labels. Recording takes one lock acquisition, no I/O. Like
+    batching.BatchScheduler, state recorded before a fork (gunicorn preload) is dropped in the child,
+    and the flush thread is started lazily in each worker.
+    """
+
+    _fork_lock = threading.Lock()
+
+    def __init__(self, directory='', flush_interval=2.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._help = {}
+        # (name, labels) -> callable, evaluated at flush/collect time; survive fork
+        self._gauges = {}
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        if self.directory and self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                    self._thread.start()
+
+    def describe(self, name, kind, text):
+        """Register the Prometheus TYPE ('counter', 'gauge' or 'histogram') and HELP of ``name``."""
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        self._check_fork()
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        self._check_fork()
+        key = (name, _labels(labels))
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, then the sum of the observations
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+    def gauge(self, name, fn, **labels):
+        """Report ``fn()`` as a gauge whenever metrics are flushed or collected."""
+        self._gauges[(name, _labels(labels))] = fn
+
+    def snapshot(self):
+        """This process' metrics, in the on-disk JSON layout."""
+        self._check_fork()
+        with self._lock:
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, list(h)] for (name, labels), h in self._histograms.items()]
+        gauges = []
+        for (name, labels), fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is not None:
+                gauges.append([name, labels, float(value)])
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def _path(self):
+        return os.path.join(self.directory, '{}-{}.json'.format(os.getppid(), os.getpid()))
+
+    def flush(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        _write(self._path(), self.snapshot())
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        """Metrics merged over every worker of this server (just this process without a directory)."""
+        snapshots = [self.snapshot()]
+        if self.directory:
+            self.flush()
+            own = self._path()
+            for path in glob.glob(os.path.join(self.directory, '{}-*.json'.format(os.getppid()))):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    # Being replaced right now; it is picked up on the next scrape
+                    continue
+        return _merge(snapshots)
+
+    def quantiles(self, name, label, merged=None):
+        """{value of ``label``: {'count', 'p50', 'p90', 'p99'}} of histogram ``name``, in milliseconds."""
+        merged = merged or self.collect()
+        result = {}
+        for (series, labels), histogram in sorted(merged['histograms'].items()):
+            if series != name:
+                continue
+            buckets = histogram[:-1]
+            entry = {'count': sum(buckets)}
+            for q in QUANTILES:
+                value = quantile(buckets, q)
+                entry['p{:g}'.format(q * 100)] = round(value * 1000, 3) if value is not None else None
+            result[dict(_LABEL.findall(labels)).get(label, '')] = entry
+        return result
+
+    def render(self, merged=None):
+        """The merged metrics in the Prometheus text exposition format."""
+        merged = merged or self.collect()
+        families = {}
+        for kind in ('counters', 'gauges', 'histograms'):
+            for (name, labels), value in merged[kind].items():
+                families.setdefault(name, (kind, []))[1].append((labels, value))
+        lines = []
+        for name in sorted(families):
+            kind, series = families[name]
+            default_type = {'counters': 'counter', 'gauges': 'gauge', 'histograms': 'histogram'}[kind]
+            metric_type, text = self._help.get(name, (default_type, name.replace('_', ' ')))
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, text))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+            for labels, value in sorted(series):
+                if kind != 'histograms':
+                    lines.append('{} {}'.format(_series(name, labels), _format(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    le = 'le="{}"'.format(bound if bound == '+Inf' else repr(bound))
+                    lines.append('{} {}'.format(_series(name + '_bucket', labels, le), cumulative))
+                lines.append('{} {}'.format(_series(name + '_sum', labels), repr(float(value[-1]))))
+                lines.append('{} {}'.format(_series(name + '_count', labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimer:
+    """Stage timings of one request: observed into ``metrics`` and reported as Server-Timing."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.stages.append((name, seconds))
+        self.metrics.observe('stage_seconds', seconds, stage=name)
+
+    def header(self):
+        """Server-Timing header value, ending with the total time so far."""
+        entries = self.stages + [('total', time.perf_counter() - self.started)]
+        return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in entries)
@@ -0,0 +1,180 @@
+"""MPEG audio frame tables, for cutting MP3 previews on frame boundaries without decoding.
+
+Every MP3 frame starts with a 4-byte header giving its length, so one pass over the headers gives the
+byte offset of every frame. Frames are self-contained enough that any run of them is a playable
+file; only the first few milliseconds after a cut may be silent (bit reservoir).
+"""
+import math
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Bitrates in kbit/s by (MPEG-1?, layer); index 0 is "free format", which we don't support.
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by version bits: 0 = MPEG-2.5, 2 = MPEG-2, 3 = MPEG-1 (1 is reserved)
+_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+
+def parse_header(header):
+    """(frame length in bytes, samples per frame, sample rate, stream key) of a 4-byte frame header,
+    or None if it isn't one. Frames of one stream share the same stream key."""
+    b0, b1, b2, b3 = header
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3 or b3 & 3 == 2:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[mpeg1, layer][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    samples = 384 if layer == 1 else 1152 if layer == 2 or mpeg1 else 576
+    padding = (b2 >> 1) & 1
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, (version, layer, rate_index)
+
+
+def id3v2_size(data):
+    """Bytes taken by an ID3v2 tag at the start of ``data`` (0 if there is none)."""
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _is_info_frame(data, pos, header):
+    """Whether the frame at ``pos`` is a Xing/Info/VBRI header frame: metadata for the whole file,
+    which would give a clip the wrong duration."""
+    mpeg1 = (header[1] >> 3) & 3 == 3
+    mono = header[3] >> 6 == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    return (data[pos + 4 + side_info:pos + 8 + side_info] in (b'Xing', b'Info')
+            or data[pos + 36:pos + 40] == b'VBRI')
+
+
+class FrameTable:
+    """Byte offsets of the audio frames of one MP3 file.
+
+    ``offsets`` has one entry per frame plus the end of the last one, so frames i..j-1 are bytes
+    ``offsets[i]:offsets[j]``.
+    """
+
+    def __init__(self, offsets, frame_seconds):
+        self.offsets = offsets
+        self.frame_seconds = frame_seconds
+
+    @property
+    def frames(self):
+        return len(self.offsets) - 1
+
+    @property
+    def duration(self):
+        return self.frames * self.frame_seconds
+
+    def clip(self, start, seconds):
+        """(first byte, end byte, start seconds, duration seconds) of the frames covering ``seconds``
+        from ``start``, rounded out to whole frames; None if ``start`` is past the end."""
+        first = int(start / self.frame_seconds)
+        if first >= self.frames:
+            return None
+        last = min(self.frames, first + max(1, math.ceil(seconds / self.frame_seconds)))
+        return (int(self.offsets[first]), int(self.offsets[last]),
+                first * self.frame_seconds, (last - first) * self.frame_seconds)
+
+
+def _next_frame(data, pos, end, stream=None):
+    """Offset and parsed header of the next frame at or after ``pos``. While resyncing after junk, a
+    candidate only counts if another frame of the same stream follows it (or it ends the data)."""
+    while pos + 4 <= end:
+        pos = data.find(b'\xff', pos, end - 3)
+        if pos < 0:
+            return None, None
+        parsed = parse_header(data[pos:pos + 4])
+        if parsed is not None and (stream is None or parsed[3] == stream):
+            after = pos + parsed[0]
+            if after == end:
+                return pos, parsed
+            if after + 4 <= end:
+                following = parse_header(data[after:after + 4])
+                if following is not None and following[3] == parsed[3]:
+                    return pos, parsed
+        pos += 1
+    return None, None
+
+
+def scan_frames(f):
+    """FrameTable of the MP3 data in the open binary file ``f``, or None if it has no MPEG audio frames."""
+    size = os.fstat(f.fileno()).st_size
+    if size < 4:
+        return None
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos, parsed = _next_frame(data, id3v2_size(data[:10] if size >= 10 else b''), size)
+        if pos is None:
+            return None
+        if _is_info_frame(data, pos, data[pos:pos + 4]):
+            pos, parsed = _next_frame(data, pos + parsed[0], size, parsed[3])
+            if pos is None:
+                return None
+        _, samples, sample_rate, stream = parsed
+        offsets = []
+        end = pos
+        while pos is not None:
+            end = pos + parsed[0]
+            if end > size:
+                # Truncated last frame
+                end = pos
+                break
+            offsets.append(pos)
+            pos = end
+            parsed = parse_header(data[pos:pos + 4]) if pos + 4 <= size else None
+            if parsed is None or parsed[3] != stream:
+                # Junk between frames, or the ID3v1/APE tag at the end
+                pos, parsed = _next_frame(data, pos, size, stream)
+        if not offsets:
+            return None
+        offsets.append(end)
+    return FrameTable(np.array(offsets, dtype=np.int64), samples / sample_rate)
+
+
+class FrameIndex:
+    """Bounded LRU cache of FrameTables keyed by (path, size, mtime), so each file is scanned once
+    and a replaced file is scanned again."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, f):
+        """FrameTable of ``f``, the open file at ``path``; None if it isn't MPEG audio."""
+        st = os.fstat(f.fileno())
+        key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                return self._tables[key]
+        # Scan outside the lock; two threads racing on one new file just both scan it
+        table = scan_frames(f)
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self.max_entries:
+                self._tables.popitem(last=False)
+        return table
@@ -0,0 +1,303 @@
+import json
+import math
+
+import numpy as np
+
+# Cap on the im2col matrix built per convolution chunk, so large batches don't balloon memory.
+IM2COL_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'relu6': lambda x: np.clip(x, 0, 6),
+    'sigmoid': lambda x: 1.0 / (1.0 + np.exp(-x)),
+    'tanh': np.tanh,
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'swish': lambda x: x / (1.0 + np.exp(-x)),
+    'silu': lambda x: x / (1.0 + np.exp(-x)),
+    'softmax': _softmax,
+}
+
+
+def _activation(name):
+    if isinstance(name, dict):
+        name = name.get('config', {}).get('name') or name.get('class_name')
+    name = (name or 'linear').lower()
+    if name not in ACTIVATIONS:
+        raise ValueError('Unsupported activation: {}'.format(name))
+    return ACTIVATIONS[name]
+
+
+def _pair(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(int(v) for v in value)
+    return (int(value), int(value))
+
+
+def _same_padding(size, kernel, stride):
+    out = math.ceil(size / stride)
+    total = max((out - 1) * stride + kernel - size, 0)
+    return total // 2, total - total // 2
+
+
+def _pad(x, kernel, strides, padding, value=0.0):
+    if padding == 'valid':
+        return x
+    if padding != 'same':
+        raise ValueError('Unsupported padding: {}'.format(padding))
+    top, bottom = _same_padding(x.shape[1], kernel[0], strides[0])
+    left, right = _same_padding(x.shape[2], kernel[1], strides[1])
+    if not (top or bottom or left or right):
+        return x
+    return np.pad(x, ((0, 0), (top, bottom), (left, right), (0, 0)), constant_values=value)
+
+
+def _windows(x, kernel, strides):
+    # (N, H, W, C) -> strided view (N, Ho, Wo, C, kh, kw) without copying
+    view = np.lib.stride_tricks.sliding_window_view(x, kernel, axis=(1, 2))
+    return view[:, ::strides[0], ::strides[1]]
+
+
+class Conv2D:
+    def __init__(self, config, weights):
+        if tuple(_pair(config.get('dilation_rate', 1))) != (1, 1):
+            raise ValueError('Dilated convolutions are not supported')
+        kernel = weights[0].astype(np.float32)
+        self.kernel_size = kernel.shape[:2]
+        self.filters = kernel.shape[3]
+        # (kh, kw, C, F) -> (C*kh*kw, F) to match the window layout produced by _windows
+        self.kernel = np.ascontiguousarray(kernel.transpose(2, 0, 1, 3).reshape(-1, self.filters))
+        self.bias = weights[1].astype(np.float32) if config.get('use_bias', True) and len(weights) > 1 else None
+        self.strides = _pair(config.get('strides', 1))
+        self.padding = config.get('padding', 'valid')
+        self.activation = _activation(config.get('activation'))
+
+    def __call__(self, x):
+        x = _pad(x, self.kernel_size, self.strides, self.padding)
+        windows = _windows(x, self.kernel_size, self.strides)
+        n, ho, wo = windows.shape[:3]
+        row_bytes = ho * wo * self.kernel.shape[0] * 4
+        chunk = max(1, IM2COL_CHUNK_BYTES // max(row_bytes, 1))
+        out = np.empty((n, ho, wo, self.filters), dtype=np.float32)
+        for start in range(0, n, chunk):
+            cols = windows[start:start + chunk].reshape(-1, self.kernel.shape[0])
+            np.matmul(cols, self.kernel, out=out[start:start + chunk].reshape(-1, self.filters))
+        if self.bias is not None:
+            out += self.bias
+        return self.activation(out)
+
+
+class Pooling2D:
+    def __init__(self, config, reduce):
+        self.pool_size = _pair(config.get('pool_size', 2))
+        self.strides = _pair(config.get('strides') or self.pool_size)
+        self.padding = config.get('padding', 'valid')
+        self.reduce = reduce
+
+    def __call__(self, x):
+        n, h, w, c = x.shape
+        ph, pw = self.pool_size
+        if self.padding == 'valid' and self.strides == self.pool_size and h % ph == 0 and w % pw == 0:
+            # Non-overlapping windows: a reshape is enough, no window view needed
+            blocks = x.reshape(n, h // ph, ph, w // pw, pw, c)
+            return self._reduce(blocks, axis=(2, 4))
+        if self.reduce == 'max':
+            padded = _pad(x, self.pool_size, self.strides, self.padding, value=-np.inf)
+            return _windows(padded, self.pool_size, self.strides).max(axis=(-2, -1))
+        padded = _pad(x, self.pool_size, self.strides, self.padding)
+        sums = _windows(padded, self.pool_size, self.strides).sum(axis=(-2, -1))
+        # TF excludes the zero padding from the average
+        ones = _pad(np.ones((1, h, w, 1), dtype=np.float32), self.pool_size, self.strides, self.padding)
+        counts = _windows(ones, self.pool_size, self.strides).sum(axis=(-2, -1))
+        return sums / counts
+
+    def _reduce(self, blocks, axis):
+        return blocks.max(axis=axis) if self.reduce == 'max' else blocks.mean(axis=axis)
+
+
+class BatchNormalization:
+    def __init__(self, config, weights):
+        weights = list(weights)
+        gamma = weights.pop(0) if config.get('scale', True) else 1.0
+        beta = weights.pop(0) if config.get('center', True) else 0.0
+        mean, var = weights
+        # Fold the four inference-time parameters into one multiply-add
+        self.scale = (gamma / np.sqrt(var + config.get('epsilon', 1e-3))).astype(np.float32)
+        self.shift = (beta - mean * self.scale).astype(np.float32)
+
+    def __call__(self, x):
+        return x * self.scale + self.shift
+
+
+class Dense:
+    def __init__(self, config, weights):
+        self.kernel = weights[0].astype(np.float32)
+        self.bias = weights[1].astype(np.float32) if config.get('use_bias', True) and len(weights) > 1 else None
+        self.activation = _activation(config.get('activation'))
+
+    def __call__(self, x):
+        out = x @ self.kernel
+        if self.bias is not None:
+            out += self.bias
+        return self.activation(out)
+
+
+class ZeroPadding2D:
+    def __init__(self, config):
+        padding = config.get('padding', 1)
+        if isinstance(padding, int):
+            padding = ((padding, padding), (padding, padding))
+        elif isinstance(padding[0], int):
+            padding = ((padding[0], padding[0]), (padding[1], padding[1]))
+        self.padding = ((0, 0), tuple(padding[0]), tuple(padding[1]), (0, 0))
+
+    def __call__(self, x):
+        return np.pad(x, self.padding)
+
+
+def _identity(x):
+    return x
+
+
+def _flatten(x):
+    return x.reshape(len(x), -1)
+
+
+def _leaky_relu(config):
+    alpha = config.get('alpha', config.get('negative_slope', 0.3))
+    return lambda x: np.where(x > 0, x, alpha * x)
+
+
+def _build_layer(class_name, config, weights):
+    if config.get('data_format', 'channels_last') != 'channels_last':
+        raise ValueError('Only channels_last models are supported')
+    if class_name == 'Conv2D':
+        return Conv2D(config, weights)
+    if class_name == 'Dense':
+        return Dense(config, weights)
+    if class_name == 'BatchNormalization':
+        return BatchNormalization(config, weights)
+    if class_name == 'MaxPooling2D':
+        return Pooling2D(config, 'max')
+    if class_name == 'AveragePooling2D':
+        return Pooling2D(config, 'avg')
+    if class_name == 'GlobalAveragePooling2D':
+        return lambda x: x.mean(axis=(1, 2))
+    if class_name == 'GlobalMaxPooling2D':
+        return lambda x: x.max(axis=(1, 2))
+    if class_name == 'ZeroPadding2D':
+        return ZeroPadding2D(config)
+    if class_name == 'Flatten':
+        return _flatten
+    if class_name == 'Activation':
+        return _activation(config.get('activation'))
+    if class_name == 'ReLU':
+        return ACTIVATIONS['relu']
+    if class_name == 'LeakyReLU':
+        return _leaky_relu(config)
+    if class_name == 'Softmax':
+        return _softmax
+    if class_name in ('InputLayer', 'Dropout', 'SpatialDropout2D', 'GaussianNoise', 'GaussianDropout'):
+        return _identity
+    raise ValueError('Unsupported layer type for the numpy backend: {}'.format(class_name))
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _layer_configs(model_config):
+    config = model_config['config']
+    layers = config['layers'] if isinstance(config, dict) else config
+    if model_config['class_name'] not in ('Sequential', 'Model', 'Functional'):
+        raise ValueError('Unsupported model class: {}'.format(model_config['class_name']))
+    for layer in layers:
+        inbound = layer.get('inbound_nodes') or []
+        if len(inbound) > 1 or (inbound and isinstance(inbound[0], list) and len(inbound[0]) > 1):
+            raise ValueError('Only single-branch models are supported by the numpy backend')
+    return layers
+
+
+def _input_shape(layers):
+    for layer in layers:
+        config = layer['config']
+        shape = config.get('batch_input_shape') or config.get('batch_shape')
+        if shape:
+            return (None,) + tuple(shape[1:])
+    raise ValueError('Could not determine model input shape from the HDF5 config')
+
+
+class NumpyModel:
+    """Forward pass of a Keras HDF5 CNN in plain NumPy, for serving without TensorFlow.
+
+    Exposes the same ``input_shape``/``predict`` surface recommend.py uses on a Keras model.
+    """
+
+    def __init__(self, layers, input_shape):
+        self.layers = layers
+        self.input_shape = input_shape
+
+    @classmethod
+    def from_hdf5(cls, path):
+        import h5py
+
+        with h5py.File(path, 'r') as f:
+            model_config = json.loads(_decode(f.attrs['model_config']))
+            weights_group = f['model_weights'] if 'model_weights' in f else f
+            layer_configs = _layer_configs(model_config)
+            layers = []
+            for layer in layer_configs:
+                config = layer['config']
+                weights = []
+                if config['name'] in weights_group:
+                    group = weights_group[config['name']]
+                    names = [_decode(n) for n in group.attrs.get('weight_names', [])]
+                    weights = [np.asarray(group[n]) for n in names]
+                layers.append(_build_layer(layer['class_name'], config, weights))
+        return cls(layers, _input_shape(layer_configs))
+
+    def predict(self, x, verbose=0, batch_size=None):
+        x = np.asarray(x, dtype=np.float32)
+        if len(self.input_shape) == 3 and x.ndim == 4:
+            x = x[..., 0]
+        if x.ndim == 3:
+            x = x[..., np.newaxis]
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def check_parity(model_path, samples=64, seed=0):
+    """Compare the numpy backend against Keras on random inputs; needs TensorFlow installed."""
+    from tensorflow.keras.models import load_model
+
+    keras_model = load_model(model_path)
+    numpy_model = NumpyModel.from_hdf5(model_path)
+    rng = np.random.default_rng(seed)
+    x = rng.random((samples,) + tuple(keras_model.input_shape[1:]), dtype=np.float32)
+    expected = keras_model.predict(x, verbose=0)
+    actual = numpy_model.predict(x)
+    return {
+        'samples': samples,
+        'max_abs_diff': float(np.abs(expected - actual).max()),
+        'top1_agreement': float((expected.argmax(-1) == actual.argmax(-1)).mean()),
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check the numpy backend against Keras.')
+    parser.add_argument('model_path')
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+    report = check_parity(args.model_path, args.samples)
+    print(json.dumps(report, indent=2))
+    raise SystemExit(0 if report['max_abs_diff'] <= args.tolerance else 1)
@@ -0,0 +1,252 @@
+"""Opt-in profiling of slow or sampled prediction requests, kept in a bounded ring of files on disk.
+
+Two captures, both per request:
+
+- cProfile, on a random ``sample_rate`` fraction of requests (one at a time per process): full call
+  counts and times, saved as a .pstats file for ``python -m pstats`` or snakeviz.
+- Stack sampling, on every tracked request: a background thread records the request thread's stack every
+  ``interval`` seconds, which costs the request little. Requests that took at least ``slow_seconds`` are
+  saved as collapsed stacks (.folded, one ``frame;frame;frame count`` line per stack) for flamegraph.pl
+  or speedscope; faster ones are dropped.
+
+Each saved profile also has a .json file with the endpoint, status, duration, stage timings and tags
+such as the image size and predicted emotion.
+"""
+import cProfile
+import glob
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from PIL import Image
+
+KINDS = {'json': 'application/json', 'pstats': 'application/octet-stream', 'folded': 'text/plain'}
+_PROFILE_ID = re.compile(r'^[\w.-]+$')
+
+
+def collapse(frame):
+    """``file:function`` frames of ``frame``'s stack, outermost first, joined by ';'."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def describe_image(data):
+    """Size tags of an uploaded image; only the header is parsed."""
+    tags = {'image_bytes': len(data)}
+    try:
+        img = Image.open(io.BytesIO(data))
+        tags.update(image_format=img.format, image_width=img.width, image_height=img.height)
+    except Exception:
+        # e.g. /predict/raw pixels, or an upload that failed to decode anyway
+        pass
+    return tags
+
+
+class ProfileStore:
+    """The newest ``keep`` profiles in ``directory``, shared by every worker.
+
+    A profile is ``<id>.json`` plus ``<id>.folded`` and maybe ``<id>.pstats``. Ids start with the UTC
+    time, so they sort oldest first. The .json is written last: a listed profile is complete.
+    """
+
+    def __init__(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        self._ids = itertools.count()
+
+    def save(self, meta, stacks, cprofile=None):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        profile_id = '{}.{:06d}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                                              int(now % 1 * 1e6), os.getpid(), next(self._ids))
+        if cprofile is not None:
+            self._write(profile_id, 'pstats', lambda path: pstats.Stats(cprofile).dump_stats(path))
+        folded = ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+        self._write(profile_id, 'folded', lambda path: _write_text(path, folded))
+        meta = dict(meta, id=profile_id, files=['json', 'folded'] + (['pstats'] if cprofile is not None else []))
+        self._write(profile_id, 'json', lambda path: _write_text(path, json.dumps(meta)))
+        self.prune()
+        return profile_id
+
+    def _write(self, profile_id, kind, write):
+        path = os.path.join(self.directory, '{}.{}'.format(profile_id, kind))
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        write(tmp)
+        os.replace(tmp, path)
+
+    def _ids_on_disk(self):
+        return sorted(os.path.basename(path)[:-len('.json')]
+                      for path in glob.glob(os.path.join(self.directory, '*.json')))
+
+    def prune(self):
+        ids = self._ids_on_disk()
+        for profile_id in ids[:max(0, len(ids) - self.keep)]:
+            # json first, so a half-deleted profile is no longer listed
+            for kind in KINDS:
+                try:
+                    os.remove(os.path.join(self.directory, '{}.{}'.format(profile_id, kind)))
+                except FileNotFoundError:
+                    pass
+
+    def list(self):
+        """Metadata of every stored profile, newest first."""
+        profiles = []
+        for profile_id in reversed(self._ids_on_disk()):
+            try:
+                with open(os.path.join(self.directory, profile_id + '.json')) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                # Pruned by another worker meanwhile
+                continue
+        return profiles
+
+    def path(self, profile_id, kind):
+        """Path of one file of a stored profile, or None."""
+        if kind not in KINDS or not _PROFILE_ID.match(profile_id):
+            return None
+        path = os.path.join(self.directory, '{}.{}'.format(profile_id, kind))
+        return path if os.path.isfile(path) else None
+
+
+def _write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+class RequestProfile:
+    """Captures of one request in progress."""
+
+    def __init__(self, endpoint, thread_id, cprofile):
+        self.endpoint = endpoint
+        self.thread_id = thread_id
+        self.cprofile = cprofile
+        self.stopped = False
+        self.started = time.perf_counter()
+        self.stacks = Counter()
+        self.tags = {}
+        # Upload bytes, described only if the profile is saved
+        self.image = None
+
+
+class StackSampler:
+    """One thread sampling the stacks of the tracked request threads.
+
+    Like metrics.Metrics, state from before a fork is dropped and the thread is started lazily in each worker.
+    """
+
+    _fork_lock = threading.Lock()
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._tracked = {}
+        self._active = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def track(self, profile):
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        with self._lock:
+            self._tracked[profile.thread_id] = profile
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def untrack(self, profile):
+        with self._lock:
+            if self._tracked.get(profile.thread_id) is profile:
+                del self._tracked[profile.thread_id]
+            if not self._tracked:
+                self._active.clear()
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._tracked:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, profile in self._tracked.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.stacks[collapse(frame)] += 1
+
+
+class Profiler:
+    """Starts the captures of a request and saves the ones worth keeping to ``store``."""
+
+    def __init__(self, store, sample_rate=0.0, slow_seconds=0.0, interval=0.005):
+        self.store = store
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.sampler = StackSampler(interval)
+        # cProfile can only profile one request at a time in a process (3.12+ raises otherwise)
+        self._cprofile_lock = threading.Lock()
+
+    def start(self, endpoint):
+        """RequestProfile for the current thread's request, or None if it isn't captured."""
+        cprofile = None
+        if self.sample_rate > 0 and random.random() < self.sample_rate and self._cprofile_lock.acquire(False):
+            cprofile = cProfile.Profile()
+            cprofile.enable()
+        if cprofile is None and self.slow_seconds <= 0:
+            return None
+        profile = RequestProfile(endpoint, threading.get_ident(), cprofile)
+        self.sampler.track(profile)
+        return profile
+
+    def stop(self, profile):
+        """End the captures; safe to call more than once."""
+        if profile.stopped:
+            return
+        profile.stopped = True
+        self.sampler.untrack(profile)
+        if profile.cprofile is not None:
+            profile.cprofile.disable()
+            self._cprofile_lock.release()
+
+    def finish(self, profile, status, stages):
+        """Stop ``profile`` and save it if it was sampled or slow: (profile id, reason), or None."""
+        self.stop(profile)
+        duration = time.perf_counter() - profile.started
+        if profile.cprofile is not None:
+            reason = 'sampled'
+        elif self.slow_seconds > 0 and duration >= self.slow_seconds:
+            reason = 'slow'
+        else:
+            return None
+        tags = dict(profile.tags)
+        if profile.image is not None:
+            tags.update(describe_image(profile.image))
+        meta = {
+            'endpoint': profile.endpoint,
+            'status': status,
+            'reason': reason,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'pid': os.getpid(),
+            'duration_ms': round(duration * 1000, 3),
+            'stages_ms': [[name, round(seconds * 1000, 3)] for name, seconds in stages],
+            'samples': sum(profile.stacks.values()),
+            'tags': tags,
+        }
+        return self.store.save(meta, profile.stacks, profile.cprofile), reason
@@ -2,8 +2,12 @@ import numpy as np
 from PIL import Image
 import io
 import os
-import random
-from tensorflow.keras.models import load_model
+import threading
+import warnings
+
+import config
+from catalog import SongCatalog
+from scoring import SongScorer
 
 # Default label order (common FER2013 ordering). Adjust if your model uses a different ordering.
 EMOTION_LABELS = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
@@ -11,6 +15,8 @@ EMOTION_LABELS = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutr
 # Local songs folder path
 LOCAL_SONGS_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'songs')
 
+AUDIO_EXTENSIONS = {'.mp3', '.wav', '.ogg', '.m4a', '.flac', '.aac'}
+
 # Mapping of emotions to song tags/folders
 # You can organize songs in subfolders by emotion, or tag them in filenames
 EMOTION_SONG_TAGS = {
@@ -24,8 +30,45 @@ EMOTION_SONG_TAGS = {
 }
 
 
-def load_model_info(model_path):
-    model = load_model(model_path)
+class ImageTooLarge(ValueError):
+    """The image header declares more pixels than config.MAX_IMAGE_PIXELS (or PIL's own limit) allows."""
+
+
+# PIL only warns about images past its own pixel limit (and refuses those past twice that) while parsing the
+# header; make the warning an error too, so both become ImageTooLarge. Set once here: catch_warnings isn't thread-safe.
+warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+
+def load_model_info(model_path, backend='keras', threads=0):
+    # threads: intra-op threads per forward pass, 0 for the backend's default (every core). The numpy
+    # backend's BLAS reads its thread count from OMP_NUM_THREADS & co. when numpy is imported instead.
+    # 'numpy' runs the same HDF5 weights without importing TensorFlow (faster cold start, less RSS)
+    if backend == 'numpy':
+        from numpy_model import NumpyModel
+        model = NumpyModel.from_hdf5(model_path)
+    elif backend == 'tflite':
+        # model_path points at a .tflite file produced by convert_model.py
+        from tflite_model import TFLiteModel
+        model = TFLiteModel(model_path, num_threads=threads or None)
+    elif backend == 'keras':
+        import tensorflow as tf
+        if threads:
+            # Only possible before TensorFlow runs anything. The model is one chain of layers, so a single
+            # inter-op thread loses nothing; extra ones would just compete with other workers for cores.
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        model = tf.keras.models.load_model(model_path)
+    elif backend == 'stub':
+        # No weights (model_path is ignored): for load tests and benchmarks of everything around the model
+        from stub_model import StubModel
+        model = StubModel()
+    else:
+        raise ValueError('Unknown model backend: {}'.format(backend))
+    input_shape, channels = model_input_info(model)
+    return model, input_shape, channels
+
+
+def model_input_info(model):
     # model.input_shape often is (None, H, W, C) or (None, H, W)
     shape = model.input_shape
     if len(shape) == 4:
@@ -38,39 +81,70 @@ def load_model_info(model_path):
         channels = 1
     else:
         raise ValueError('Unexpected model input shape: {}'.format(shape))
-    return model, input_shape, channels
+    return input_shape, channels
 
 
-def preprocess_image(file_obj, input_shape, channels):
+def preprocess_image(file_obj, input_shape, channels, out=None, draft=True):
     # file_obj: FileStorage or file-like
+    # out: optional preallocated float32 array of shape (H, W, C) to normalize into, e.g. a row of a batch
     data = file_obj.read()
-    img = Image.open(io.BytesIO(data))
-    if channels == 1:
-        img = img.convert('L')
-    else:
-        img = img.convert('RGB')
+    try:
+        img = Image.open(io.BytesIO(data))
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise ImageTooLarge(str(e)) from e
+    # Image.open only parsed the header, so decompression bombs are rejected before any pixel is decoded
+    if img.width * img.height > config.MAX_IMAGE_PIXELS:
+        raise ImageTooLarge('Image is {}x{} pixels, the limit is {} pixels'.format(
+            img.width, img.height, config.MAX_IMAGE_PIXELS))
+    mode = 'L' if channels == 1 else 'RGB'
+    if draft and img.format == 'JPEG':
+        # libjpeg can decode at 1/2, 1/4 or 1/8 scale (DCT scaling) and emit only the luma plane,
+        # so decode cost follows the model input size rather than the photo size.
+        img.draft(mode, (input_shape[1], input_shape[0]))
+    img = img.convert(mode)
 
     img = img.resize((input_shape[1], input_shape[0]))
-    arr = np.array(img).astype('float32') / 255.0
-    if channels == 1:
-        if arr.ndim == 2:
-            arr = np.expand_dims(arr, -1)
-    return arr
+    if out is None:
+        out = np.empty((input_shape[0], input_shape[1], channels), dtype='float32')
+    np.divide(np.asarray(img).reshape(out.shape), np.float32(255.0), out=out)
+    return out
+
+
+def preprocess_pixels(data, input_shape, channels, out=None):
+    # data: raw uint8 pixels already resized to the model input, row-major (H, W, C), e.g. from a canvas
+    expected = input_shape[0] * input_shape[1] * channels
+    if len(data) != expected:
+        raise ValueError('Expected {} bytes ({}x{}x{} uint8 pixels), got {}'.format(
+            expected, input_shape[0], input_shape[1], channels, len(data)))
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(input_shape[0], input_shape[1], channels)
+    if out is None:
+        out = np.empty(pixels.shape, dtype='float32')
+    np.divide(pixels, np.float32(255.0), out=out)
+    return out
 
 
 def predict_emotion(model, img_arr):
-    x = np.expand_dims(img_arr, 0)
-    preds = model.predict(x)
-    if preds.ndim == 2:
-        probs = preds[0].tolist()
-        idx = int(np.argmax(preds[0]))
-    else:
-        probs = preds.flatten().tolist()
-        idx = int(np.argmax(preds))
-    label = EMOTION_LABELS[idx] if idx < len(EMOTION_LABELS) else str(idx)
-    # return label and a mapping of label->prob
-    prob_map = {EMOTION_LABELS[i] if i < len(EMOTION_LABELS) else str(i): float(probs[i]) for i in range(len(probs))}
-    return label, prob_map
+    return predict_emotions(model, np.expand_dims(img_arr, 0))[0]
+
+
+def warm_up_model(model, input_shape, channels, batch_sizes=(1,)):
+    """Run synthetic inferences so the first real request doesn't pay graph tracing/allocation."""
+    for batch_size in batch_sizes:
+        predict_emotions(model, np.zeros((batch_size, input_shape[0], input_shape[1], channels), dtype='float32'))
+
+
+def predict_emotions(model, batch):
+    """Run one forward pass over a stacked batch and return a (label, prob_map) per image."""
+    preds = np.asarray(model.predict(batch, verbose=0))
+    preds = preds.reshape(len(batch), -1)
+    labels = [EMOTION_LABELS[i] if i < len(EMOTION_LABELS) else str(i) for i in range(preds.shape[1])]
+    results = []
+    for row in preds:
+        idx = int(np.argmax(row))
+        # return label and a mapping of label->prob
+        prob_map = {labels[i]: float(p) for i, p in enumerate(row)}
+        results.append((labels[idx], prob_map))
+    return results
 
 
 def get_recommendations(emotion):
@@ -103,58 +177,54 @@ def get_recommendations(emotion):
     return mapping.get(emotion, mapping['Neutral'])
 
 
-def get_local_songs(emotion):
-    """Get local songs that match the emotion."""
-    songs = []
-    audio_extensions = {'.mp3', '.wav', '.ogg', '.m4a', '.flac', '.aac'}
-    
-    if not os.path.exists(LOCAL_SONGS_FOLDER):
-        return songs
-    
-    tags = EMOTION_SONG_TAGS.get(emotion, EMOTION_SONG_TAGS['Neutral'])
-    
-    # Check for emotion-specific subfolder
-    emotion_folder = os.path.join(LOCAL_SONGS_FOLDER, emotion.lower())
-    
-    # Collect songs from emotion subfolder if exists
-    if os.path.exists(emotion_folder):
-        for file in os.listdir(emotion_folder):
-            ext = os.path.splitext(file)[1].lower()
-            if ext in audio_extensions:
-                songs.append({
-                    'title': os.path.splitext(file)[0],
-                    'url': f'/static/songs/{emotion.lower()}/{file}',
-                    'type': 'local'
-                })
-    
-    # Also check main songs folder for tagged files
-    for file in os.listdir(LOCAL_SONGS_FOLDER):
-        filepath = os.path.join(LOCAL_SONGS_FOLDER, file)
-        if os.path.isfile(filepath):
-            ext = os.path.splitext(file)[1].lower()
-            if ext in audio_extensions:
-                filename_lower = file.lower()
-                # Check if filename contains any emotion tag
-                if any(tag in filename_lower for tag in tags):
-                    songs.append({
-                        'title': os.path.splitext(file)[0],
-                        'url': f'/static/songs/{file}',
-                        'type': 'local'
-                    })
-    
-    # If no tagged songs found, return random songs from the folder
-    if not songs:
-        for file in os.listdir(LOCAL_SONGS_FOLDER):
-            filepath = os.path.join(LOCAL_SONGS_FOLDER, file)
-            if os.path.isfile(filepath):
-                ext = os.path.splitext(file)[1].lower()
-                if ext in audio_extensions:
-                    songs.append({
-                        'title': os.path.splitext(file)[0],
-                        'url': f'/static/songs/{file}',
-                        'type': 'local'
-                    })
-    
-    # Shuffle and limit
-    random.shuffle(songs)
-    return songs[:5]
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """The process-wide local song catalog, built on first use."""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                index = None
+                if config.SONG_INDEX_PATH:
+                    from song_index import SongIndex
+                    index = SongIndex(config.SONG_INDEX_PATH)
+                catalog = SongCatalog(LOCAL_SONGS_FOLDER, EMOTION_SONG_TAGS, AUDIO_EXTENSIONS,
+                                      config.CATALOG_REFRESH_SECONDS, index)
+                catalog.refresh(force=True)
+                _catalog = catalog
+    return _catalog
+
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+
+def get_scorer():
+    """The process-wide song scorer over ``get_catalog()``."""
+    global _scorer
+    if _scorer is None:
+        # Outside _scorer_lock: get_catalog takes its own lock
+        catalog = get_catalog()
+        with _scorer_lock:
+            if _scorer is None:
+                auto_tags = None
+                if config.AUDIO_TAGS_PATH:
+                    from audio_tagger import AudioTagStore
+                    auto_tags = AudioTagStore(config.AUDIO_TAGS_PATH)
+                _scorer = SongScorer(catalog, EMOTION_LABELS, auto_tags)
+    return _scorer
+
+
+def get_local_songs(emotion, probs=None):
+    """Get local songs that match the emotion.
+
+    With ``probs`` (the full label -> probability map) songs are scored against every emotion, so a
+    face that is 60% Happy and 40% Sad gets a mix of both. Otherwise only ``emotion`` counts.
+    """
+    if probs is None:
+        probs = {emotion if emotion in EMOTION_SONG_TAGS else 'Neutral': 1.0}
+    # When nothing matches, the picks are random songs from the root of the songs folder
+    return get_scorer().top(probs, 5)
@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from catalog import FOLDER_WEIGHT, TAG_WEIGHT
+
+# Weight of estimated audio tags (audio_tagger.py) relative to folders and file-name tags. Only songs
+# with neither get them.
+AUTO_TAG_WEIGHT = 0.25
+
+
+class SongScorer:
+    """Ranks the whole local catalog against an emotion probability vector.
+
+    Each song has a row in a (songs x emotions) float32 affinity matrix built from folder placement
+    and file-name tags (weights ``catalog.FOLDER_WEIGHT`` and ``TAG_WEIGHT``), so a song's score is one matrix-vector
+    product ``A @ p``. Mixed emotions blend: with 60% Happy and 40% Sad, about 60% of the picks are
+    happy songs. The matrix is rebuilt only when the catalog version changes.
+
+    With ``auto_tags`` (an ``audio_tagger.AudioTagStore``), songs that have no folder or tag get the
+    emotion probabilities estimated from their audio instead, scaled by AUTO_TAG_WEIGHT. The store is
+    polled for changes at most every ``catalog.refresh_interval`` seconds.
+    """
+
+    def __init__(self, catalog, labels, auto_tags=None, seed=None):
+        self.catalog = catalog
+        self.labels = list(labels)
+        self.auto_tags = auto_tags
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng(seed)
+        self._tags_generation = 0
+        self._tags_checked = 0.0
+        # ((catalog version, tags generation), songs, affinity matrix, root-folder mask), swapped as one tuple
+        self._state = (None, [], np.zeros((0, len(self.labels)), dtype=np.float32), np.zeros(0, dtype=bool))
+
+    def _build(self, entries):
+        columns = {label: i for i, label in enumerate(self.labels)}
+        emotion_tags = self.catalog.emotion_tags
+        folders = {emotion.lower(): columns[emotion] for emotion in emotion_tags if emotion in columns}
+        # One compiled alternation of each emotion's tags, matched against root-folder file names
+        matchers = [(columns[emotion], re.compile('|'.join(map(re.escape, tags))))
+                    for emotion, tags in emotion_tags.items() if emotion in columns and tags]
+        rows, cols, weights = [], [], []
+        for row, (relpath, _) in enumerate(entries):
+            folder, _, name = relpath.replace(os.sep, '/').rpartition('/')
+            if folder:
+                if folder in folders:
+                    rows.append(row)
+                    cols.append(folders[folder])
+                    weights.append(FOLDER_WEIGHT)
+                continue
+            name = name.lower()
+            for column, matcher in matchers:
+                if matcher.search(name):
+                    rows.append(row)
+                    cols.append(column)
+                    weights.append(TAG_WEIGHT)
+        affinity = np.zeros((len(entries), len(self.labels)), dtype=np.float32)
+        affinity[rows, cols] = weights
+        if self.auto_tags is not None:
+            tags = self.auto_tags.load()
+            for row in np.flatnonzero(~affinity.any(axis=1)):
+                probs = tags.get(entries[row][0].replace(os.sep, '/'))
+                if probs is not None:
+                    affinity[row] = AUTO_TAG_WEIGHT * self._vector(probs)
+        # Normalise each emotion's column to sum 1, so an emotion's share of the picks follows its
+        # probability rather than how many songs it has. Order within one emotion is unchanged.
+        totals = affinity.sum(axis=0)
+        np.divide(affinity, totals, out=affinity, where=totals > 0)
+        return affinity
+
+    def _tags_version(self):
+        if self.auto_tags is None:
+            return 0
+        now = time.monotonic()
+        if now - self._tags_checked >= self.catalog.refresh_interval:
+            self._tags_checked = now
+            self._tags_generation = self.auto_tags.generation()
+        return self._tags_generation
+
+    def _matrix(self):
+        entries = self.catalog.entries()
+        version = (self.catalog.version, self._tags_version())
+        state = self._state
+        if state[0] != version:
+            with self._lock:
+                state = self._state
+                if state[0] != version:
+                    root = np.array([os.sep not in relpath and '/' not in relpath for relpath, _ in entries], dtype=bool)
+                    state = self._state = (version, [song for _, song in entries], self._build(entries), root)
+        return state[1:]
+
+    def _vector(self, probs):
+        if isinstance(probs, dict):
+            return np.array([probs.get(label, 0.0) for label in self.labels], dtype=np.float32)
+        return np.asarray(probs, dtype=np.float32)
+
+    def scores(self, probs):
+        """Score of every catalog song for ``probs`` (label -> probability, or a vector in label order)."""
+        songs, affinity, _ = self._matrix()
+        return songs, affinity @ self._vector(probs)
+
+    def top(self, probs, k=5, sample=True):
+        """The ``k`` best songs for ``probs``, best first.
+
+        With ``sample`` the k songs are drawn without replacement with probability proportional to
+        their score (exponential-race sampling), so repeated calls vary; without it the k highest
+        scores win. Only songs scoring above 0 are picked; when there are none, the picks are random
+        songs from the root of the songs folder, as untagged songs there may suit any mood.
+        """
+        songs, affinity, root = self._matrix()
+        scores = affinity @ self._vector(probs)
+        candidates = np.flatnonzero(scores > 0)
+        fallback = not len(candidates)
+        if fallback:
+            candidates = np.flatnonzero(root)
+            scores = np.ones(len(candidates), dtype=np.float32)
+        else:
+            scores = scores[candidates]
+        n = len(candidates)
+        k = min(k, n)
+        if k == 0:
+            return []
+        noise = self._rng.standard_exponential(n, dtype=np.float32)
+        np.maximum(noise, np.finfo(np.float32).tiny, out=noise)
+        keys = scores / noise if sample or fallback else scores
+        # O(n) selection of the top k, then sort only those
+        best = np.argpartition(keys, n - k)[n - k:]
+        best = best[np.argsort(keys[best])[::-1]]
+        return [songs[candidates[i]] for i in best]
@@ -0,0 +1,129 @@
+"""Model loading and the prediction flow shared by the Flask (app.py) and ASGI (asgi_app.py) entry points."""
+import time
+from contextlib import nullcontext
+
+from recommend import (ImageTooLarge, load_model_info, model_input_info, get_recommendations, get_local_songs,
+                       warm_up_model)
+from cache import content_digest, perceptual_hash
+from inference_server import InferenceClient
+import config
+
+
+def _untimed(name):
+    return nullcontext()
+
+
+def load_model(warmup_batch_sizes=(1,)):
+    """(model, input_shape, channels, status) of this process, warmed up on ``warmup_batch_sizes``.
+
+    With INFERENCE_SOCKET the model is a client of the inference sidecar, and ``input_shape`` and
+    ``channels`` are None until it can be reached (see ``model_ready``). ``model`` is None when it
+    could not be loaded; ``status`` is what /healthz and /readyz report.
+    """
+    status = {
+        'backend': 'sidecar' if config.INFERENCE_SOCKET else config.MODEL_BACKEND,
+        'load_seconds': None,
+        'warmup_seconds': None,
+        'warmed_up': False,
+        'error': None,
+    }
+    started = time.perf_counter()
+    try:
+        if config.INFERENCE_SOCKET:
+            # The sidecar owns the model; this process only needs its input shape.
+            model = InferenceClient(config.INFERENCE_SOCKET, config.INFERENCE_TIMEOUT)
+        else:
+            model, _, _ = load_model_info(config.MODEL_PATH, config.MODEL_BACKEND, config.MODEL_THREADS)
+        status['load_seconds'] = round(time.perf_counter() - started, 3)
+    except Exception as e:
+        status['error'] = str(e)
+        print('Warning: could not load model:', e)
+        return None, None, None, status
+    input_shape, channels = model_ready(model, status, warmup_batch_sizes)
+    return model, input_shape, channels, status
+
+
+def model_ready(model, status, warmup_batch_sizes=(1,)):
+    """(input_shape, channels) of ``model``, warmed up the first time; (None, None) while the inference
+    sidecar can't be reached yet. Call again to retry: the client backs off between attempts."""
+    if isinstance(model, InferenceClient) and not model.connect():
+        status['error'] = 'inference server not reachable yet'
+        return None, None
+    input_shape, channels = model_input_info(model)
+    status['error'] = None
+    started = time.perf_counter()
+    try:
+        if config.MODEL_WARMUP:
+            warm_up_model(model, input_shape, channels, warmup_batch_sizes)
+        status['warmup_seconds'] = round(time.perf_counter() - started, 3)
+        status['warmed_up'] = True
+    except Exception as e:
+        status['error'] = 'warm-up failed: {}'.format(e)
+        print('Warning: model warm-up failed:', e)
+    return input_shape, channels
+
+
+class PredictionFailed(Exception):
+    """An upload that could not be classified: the HTTP ``status``, JSON ``payload`` and error ``kind``
+    (too_many_pixels, bad_image, model_unavailable or model_error)."""
+
+    def __init__(self, status, kind, error, detail):
+        super().__init__(detail)
+        self.status = status
+        self.kind = kind
+        self.payload = {'error': error, 'detail': detail}
+
+
+def predict_upload(data, decode, infer, cache=None, stage=_untimed):
+    """Cache lookup, decode and inference of one upload: (emotion, probs, cache status).
+
+    ``decode(data)`` turns the bytes into the model input and ``infer(img_arr)`` returns (emotion, probs).
+    ``stage(name)`` is a context manager timing the 'decode' and 'infer' stages, e.g. RequestTimer.stage.
+    Raises PredictionFailed.
+    """
+    # Retried uploads hit on the exact bytes and skip decoding as well as inference.
+    digest = content_digest(data)
+    cached = cache.get_exact(digest) if cache is not None else None
+    cache_status = 'hit-exact'
+    if cached is None:
+        try:
+            with stage('decode'):
+                img_arr = decode(data)
+        except ImageTooLarge as e:
+            raise PredictionFailed(413, 'too_many_pixels', 'Image too large', str(e))
+        except Exception as e:
+            raise PredictionFailed(400, 'bad_image', 'Failed to preprocess image', str(e))
+
+        if cache is not None:
+            # Near-identical camera frames hit on the perceptual hash and skip inference.
+            phash = perceptual_hash(img_arr)
+            cached = cache.get_near(phash)
+            cache_status = 'hit-near'
+
+    if cached is not None:
+        emotion, probs = cached
+        return emotion, probs, cache_status
+    try:
+        with stage('infer'):
+            emotion, probs = infer(img_arr)
+    except (TimeoutError, ConnectionError) as e:
+        # Only the batching queue and the inference sidecar raise these; the client may retry.
+        raise PredictionFailed(503, 'model_unavailable', 'Model prediction unavailable', str(e))
+    except Exception as e:
+        raise PredictionFailed(500, 'model_error', 'Model prediction failed', str(e))
+    if cache is not None:
+        cache.put(digest, phash, (emotion, probs))
+    return emotion, probs, 'miss'
+
+
+def prediction_payload(emotion, probs, stage=_untimed):
+    """The /predict response body: the emotion, its probabilities and songs for it."""
+    recs = get_recommendations(emotion)
+    with stage('songs'):
+        local_songs = get_local_songs(emotion, probs)
+    return {
+        'emotion': emotion,
+        'probabilities': probs,
+        'recommendations': recs,
+        'local_songs': local_songs
+    }
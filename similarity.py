@@ -0,0 +1,296 @@
+""""More like this" search over per-song audio descriptors.
+
+Descriptors come from the audio_tagger features: tempo, loudness, brightness, onset rate, mode,
+chroma and spectral shape. They are standardised, L2-normalised and stored as one float32 matrix.
+Every worker memory-maps the same file, so the vectors are in the page cache once. Libraries of up to
+``exact_max`` songs are searched exactly with blocked dot products. Larger ones use an inverted-file
+(IVF) index of spherical k-means clusters, and only the lists closest to the query are scanned.
+
+New songs are appended to the matrix in place. Readers only see the rows listed in ``index.json``,
+which is replaced atomically after the rows are written. Rebuilds write new files under a new
+generation.
+
+    python similarity.py                  # tag new songs and add them to the index
+    python similarity.py --watch 300      # keep doing that every 5 minutes
+    python similarity.py --rebuild        # recompute normalisation and clusters from scratch
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+SCALAR_FEATURES = ['tempo_bpm', 'rms_db', 'centroid_hz', 'onset_rate', 'mode']
+# Share of the squared distance each feature group gets after standardisation.
+GROUP_SHARES = {'scalars': 0.4, 'chroma': 0.2, 'bands_db': 0.4}
+# Rows scored per matrix product in exact search, so a large memmap isn't paged in all at once.
+SEARCH_BLOCK = 65536
+
+
+def raw_descriptor(features):
+    return np.concatenate([[features[name] for name in SCALAR_FEATURES],
+                           features['chroma'], features['bands_db']]).astype(np.float32)
+
+
+def _group_weights(dim):
+    n_chroma, n_bands = 12, dim - len(SCALAR_FEATURES) - 12
+    return np.concatenate([
+        np.full(len(SCALAR_FEATURES), np.sqrt(GROUP_SHARES['scalars'] / len(SCALAR_FEATURES))),
+        np.full(n_chroma, np.sqrt(GROUP_SHARES['chroma'] / n_chroma)),
+        np.full(n_bands, np.sqrt(GROUP_SHARES['bands_db'] / n_bands)),
+    ]).astype(np.float32)
+
+
+def _normalise(raw, mean, scale):
+    x = (raw - mean) * scale
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def spherical_kmeans(x, n_clusters, iterations=10, seed=0, block=8192):
+    """Cluster unit vectors by cosine similarity; return (centroids, assignment of each row)."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    assign = np.zeros(len(x), dtype=np.int32)
+    for _ in range(iterations):
+        for start in range(0, len(x), block):
+            assign[start:start + block] = np.argmax(x[start:start + block] @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # Empty clusters restart from random rows
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32), assign
+
+
+class SimilarityIndex:
+    """Memory-mapped descriptor matrix plus an optional IVF index, stored in ``directory``.
+
+    ``update`` (run by one builder process) adds new songs and drops removed ones. ``similar``
+    (run by the workers) reloads the files at most every ``refresh_interval`` seconds.
+    """
+
+    def __init__(self, directory, exact_max=20000, nprobe=8, refresh_interval=5.0):
+        self.directory = directory
+        self.exact_max = exact_max
+        self.nprobe = nprobe
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._checked = 0.0
+        self._state = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_meta(self):
+        try:
+            with open(self._path('index.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        tmp = self._path('index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path('index.json'))
+
+    # Builder side
+
+    def update(self, features_by_path, rebuild=False):
+        """Sync the index with {song path: audio_tagger features}; return counts of added and removed songs."""
+        os.makedirs(self.directory, exist_ok=True)
+        features_by_path = {path: f for path, f in features_by_path.items() if 'chroma' in f}
+        meta = None if rebuild else self.read_meta()
+        if meta is not None and meta['paths']:
+            deleted = set(meta['deleted'])
+            live = {path: row for row, path in enumerate(meta['paths']) if row not in deleted}
+            changed = self._changed(meta, live, features_by_path)
+            added = sorted(path for path in features_by_path if path not in live or path in changed)
+            removed = [path for path in live if path not in features_by_path]
+            # A changed song is re-added as a new row; its old row becomes a tombstone
+            deleted.update(live[path] for path in removed + sorted(changed))
+            total = len(meta['paths']) + len(added)
+            too_stale = len(deleted) > 0.2 * max(total, 1)
+            needs_ivf = total > self.exact_max and total >= 2 * meta['ivf_trained_at']
+            if not too_stale and not needs_ivf:
+                if added or removed:
+                    self._append(meta, added, features_by_path, deleted)
+                return {'added': len(added), 'removed': len(removed), 'songs': total - len(deleted)}
+        return self._build(features_by_path, (meta or {}).get('generation', 0) + 1)
+
+    def _changed(self, meta, live, features_by_path):
+        """Indexed songs whose descriptor no longer matches their stored row (the file was re-encoded)."""
+        common = [path for path in live if path in features_by_path]
+        if not common:
+            return set()
+        stored = np.memmap(self._path(meta['vectors']), dtype=np.float32, mode='r',
+                           shape=(len(meta['paths']), meta['dim']))[[live[path] for path in common]]
+        fresh = _normalise(np.stack([raw_descriptor(features_by_path[path]) for path in common]),
+                           np.array(meta['mean'], np.float32), np.array(meta['scale'], np.float32))
+        differs = ~np.isclose(stored, fresh, atol=1e-5).all(axis=1)
+        return {path for path, d in zip(common, differs) if d}
+
+    def _build(self, features_by_path, generation):
+        paths = sorted(features_by_path)
+        raw = np.stack([raw_descriptor(features_by_path[p]) for p in paths]) if paths else np.zeros((0, 1), np.float32)
+        dim = raw.shape[1]
+        mean = raw.mean(axis=0) if paths else np.zeros(dim, np.float32)
+        std = raw.std(axis=0) if paths else np.ones(dim, np.float32)
+        scale = _group_weights(dim) / np.maximum(std, 1e-6) if paths else np.ones(dim, np.float32)
+        vectors = _normalise(raw, mean, scale).astype(np.float32)
+        meta = {
+            'generation': generation,
+            'dim': int(dim),
+            'paths': paths,
+            'deleted': [],
+            'mean': mean.tolist(),
+            'scale': scale.tolist(),
+            'vectors': 'vectors-{}.f32'.format(generation),
+            'lists': None,
+            'centroids': None,
+            'ivf_trained_at': 0,
+        }
+        vectors.tofile(self._path(meta['vectors']))
+        if len(paths) > self.exact_max:
+            n_lists = int(4 * np.sqrt(len(paths)))
+            centroids, assign = spherical_kmeans(vectors, n_lists)
+            meta['lists'] = 'lists-{}.i32'.format(generation)
+            meta['centroids'] = 'centroids-{}.npy'.format(generation)
+            meta['ivf_trained_at'] = len(paths)
+            assign.tofile(self._path(meta['lists']))
+            np.save(self._path(meta['centroids']), centroids)
+        self._write_meta(meta)
+        self._remove_old_files(meta)
+        return {'added': len(paths), 'removed': 0, 'songs': len(paths)}
+
+    def _append(self, meta, added, features_by_path, deleted):
+        # ``deleted`` holds row numbers: a path can have an old, deleted row and a newer live one
+        if added:
+            raw = np.stack([raw_descriptor(features_by_path[p]) for p in added])
+            vectors = _normalise(raw, np.array(meta['mean'], np.float32),
+                                 np.array(meta['scale'], np.float32)).astype(np.float32)
+            # Readers never look past the row count in index.json, so appending in place is safe
+            with open(self._path(meta['vectors']), 'r+b') as f:
+                f.seek(len(meta['paths']) * meta['dim'] * 4)
+                f.write(vectors.tobytes())
+            if meta['lists']:
+                centroids = np.load(self._path(meta['centroids']))
+                with open(self._path(meta['lists']), 'r+b') as f:
+                    f.seek(len(meta['paths']) * 4)
+                    f.write(np.argmax(vectors @ centroids.T, axis=1).astype(np.int32).tobytes())
+            meta['paths'] = meta['paths'] + added
+        meta['deleted'] = sorted(deleted)
+        self._write_meta(meta)
+
+    def _remove_old_files(self, meta):
+        keep = {meta['vectors'], meta['lists'], meta['centroids'], 'index.json'}
+        for name in os.listdir(self.directory):
+            if name not in keep and name.split('-')[0] in ('vectors', 'lists', 'centroids'):
+                # Workers that still map an old file keep it alive until they reload
+                os.unlink(self._path(name))
+
+    # Reader side
+
+    def _load(self):
+        now = time.monotonic()
+        if self._state is not None and now - self._checked < self.refresh_interval:
+            return self._state
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(self._path('index.json')).st_mtime_ns
+            except FileNotFoundError:
+                self._state = None
+                return None
+            if self._state is not None and self._state['mtime'] == mtime:
+                return self._state
+            meta = self.read_meta()
+            count = len(meta['paths'])
+            vectors = (np.memmap(self._path(meta['vectors']), dtype=np.float32, mode='r', shape=(count, meta['dim']))
+                       if count else np.zeros((0, meta['dim']), np.float32))
+            deleted = set(meta['deleted'])
+            state = {
+                'mtime': mtime,
+                'paths': meta['paths'],
+                'rows': {path: row for row, path in enumerate(meta['paths']) if row not in deleted},
+                'deleted': np.array(sorted(deleted), dtype=np.int64),
+                'vectors': vectors,
+                'ivf': None,
+            }
+            if meta['lists'] and count:
+                assign = np.fromfile(self._path(meta['lists']), dtype=np.int32, count=count)
+                centroids = np.load(self._path(meta['centroids']))
+                order = np.argsort(assign, kind='stable')
+                offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+                state['ivf'] = (centroids, order, offsets)
+            self._state = state
+            return state
+
+    def __len__(self):
+        state = self._load()
+        return 0 if state is None else len(state['paths']) - len(state['deleted'])
+
+    def similar(self, path, k=5):
+        """[(song path, cosine similarity), ...] for the ``k`` songs closest to ``path``, or None if the
+        song isn't indexed."""
+        state = self._load()
+        if state is None or path not in state['rows']:
+            return None
+        row = state['rows'][path]
+        vectors = state['vectors']
+        query = np.array(vectors[row])
+        if state['ivf'] is None:
+            candidates = None
+            scores = np.empty(len(vectors), dtype=np.float32)
+            for start in range(0, len(vectors), SEARCH_BLOCK):
+                scores[start:start + SEARCH_BLOCK] = vectors[start:start + SEARCH_BLOCK] @ query
+        else:
+            centroids, order, offsets = state['ivf']
+            nprobe = min(self.nprobe, len(centroids))
+            probe = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            # Sorted rows keep the memmap reads sequential
+            candidates = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe]))
+            scores = vectors[candidates] @ query
+        excluded = np.append(state['deleted'], row)
+        if candidates is None:
+            scores[excluded] = -np.inf
+        else:
+            scores[np.isin(candidates, excluded)] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        rows = best if candidates is None else candidates[best]
+        return [(state['paths'][r], float(scores[b])) for r, b in zip(rows, best)]
+
+
+if __name__ == '__main__':
+    import config
+    from audio_tagger import AudioTagStore
+    from recommend import AUDIO_EXTENSIONS, LOCAL_SONGS_FOLDER
+
+    parser = argparse.ArgumentParser(description='Build or update the similar-songs index.')
+    parser.add_argument('--dir', default=config.SIMILARITY_INDEX_DIR or config.DEFAULT_SIMILARITY_INDEX_DIR)
+    parser.add_argument('--tags', default=config.AUDIO_TAGS_PATH or config.DEFAULT_AUDIO_TAGS_PATH)
+    parser.add_argument('--root', default=LOCAL_SONGS_FOLDER)
+    parser.add_argument('--rebuild', action='store_true', help='recompute normalisation and clusters')
+    parser.add_argument('--watch', type=float, default=0, metavar='SECONDS', help='update at this interval')
+    args = parser.parse_args()
+    store = AudioTagStore(args.tags)
+    index = SimilarityIndex(args.dir, config.SIMILARITY_EXACT_MAX)
+    rebuild = args.rebuild
+    while True:
+        store.update(args.root, AUDIO_EXTENSIONS)
+        counts = index.update(store.load('features'), rebuild=rebuild)
+        rebuild = False
+        if counts['added'] or counts['removed'] or not args.watch:
+            print('{songs} songs, {added} added, {removed} removed -> {dir}'.format(dir=args.dir, **counts), flush=True)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
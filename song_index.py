@@ -0,0 +1,206 @@
+"""On-disk SQLite index of the local songs folder, with tags, duration and bitrate per file.
+
+A scan walks the folder, re-reads metadata only for files whose (size, mtime) changed, and parses
+them in a process pool. Workers read the index through indexed queries instead of the filesystem.
+
+    python song_index.py                  # scan once
+    python song_index.py --watch 60       # rescan every 60 seconds
+"""
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from catalog import file_version, song_url
+
+try:
+    import mutagen
+except ImportError:  # optional: without it only file names and sizes are indexed
+    mutagen = None
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT,
+    album TEXT,
+    genre TEXT,
+    duration REAL,
+    bitrate INTEGER
+);
+CREATE INDEX IF NOT EXISTS songs_folder ON songs (folder);
+-- Indexes built by older versions kept per-emotion matches here; scoring.SongScorer computes them now
+DROP TABLE IF EXISTS song_emotions;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+'''
+
+# Below this many changed files the pool's startup costs more than it saves.
+MIN_PARALLEL_FILES = 16
+
+_SONG_COLUMNS = 's.path, s.size, s.mtime_ns, s.title, s.artist, s.album, s.duration'
+
+
+def read_metadata(path):
+    """Tags, duration (seconds) and bitrate (bits/s) of one audio file; missing values are None."""
+    meta = {'title': None, 'artist': None, 'album': None, 'genre': None, 'duration': None, 'bitrate': None}
+    if mutagen is None:
+        return meta
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception:
+        # Corrupt or unsupported file: index it by name only.
+        return meta
+    if audio is None:
+        return meta
+    tags = audio.tags or {}
+    for key in ('title', 'artist', 'album', 'genre'):
+        try:
+            values = tags.get(key)
+        except Exception:
+            values = None
+        if values:
+            meta[key] = str(values[0]).strip() or None
+    info = getattr(audio, 'info', None)
+    if info is not None:
+        meta['duration'] = getattr(info, 'length', None) or None
+        meta['bitrate'] = getattr(info, 'bitrate', None) or None
+    return meta
+
+
+def walk_songs(root, extensions):
+    """{path relative to root, with '/' separators: (size, mtime_ns)} for every audio file under root."""
+    found = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found[os.path.relpath(path, root).replace(os.sep, '/')] = (st.st_size, st.st_mtime_ns)
+    return found
+
+
+class SongIndex:
+    """The SQLite song index. Each call opens its own connection, so one instance is safe to share
+    between threads; WAL mode lets workers read while a scanner writes."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self):
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def generation(self):
+        """Bumped by every scan that changed something; 0 if the index was never built."""
+        if not os.path.exists(self.db_path):
+            return 0
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def scan(self, root, extensions, workers=None):
+        """Bring the index in line with ``root``; return counts of files seen, updated and removed."""
+        self.create()
+        found = walk_songs(root, extensions)
+
+        conn = self._connect()
+        try:
+            known = {row['path']: (row['size'], row['mtime_ns'])
+                     for row in conn.execute('SELECT path, size, mtime_ns FROM songs')}
+            changed = sorted(path for path, stat in found.items() if known.get(path) != stat)
+            removed = sorted(known.keys() - found.keys())
+            paths = [os.path.join(root, relpath) for relpath in changed]
+            if len(paths) >= MIN_PARALLEL_FILES and workers != 1:
+                with ProcessPoolExecutor(workers) as pool:
+                    metas = list(pool.map(read_metadata, paths, chunksize=8))
+            else:
+                metas = [read_metadata(path) for path in paths]
+
+            with conn:
+                for relpath in removed:
+                    conn.execute('DELETE FROM songs WHERE path = ?', (relpath,))
+                for relpath, meta in zip(changed, metas):
+                    size, mtime_ns = found[relpath]
+                    folder, name = os.path.split(relpath)
+                    conn.execute(
+                        'INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (relpath, folder, size, mtime_ns, meta['title'] or os.path.splitext(name)[0],
+                         meta['artist'], meta['album'], meta['genre'], meta['duration'], meta['bitrate']))
+                if changed or removed:
+                    conn.execute("INSERT INTO meta VALUES ('generation', 1) "
+                                 "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+        finally:
+            conn.close()
+        return {'files': len(found), 'updated': len(changed), 'removed': len(removed)}
+
+    @staticmethod
+    def _song(row):
+        return {
+            'title': row['title'],
+            'url': song_url(row['path'], file_version(row['size'], row['mtime_ns'])),
+            'type': 'local',
+            'artist': row['artist'],
+            'album': row['album'],
+            'duration': row['duration'],
+        }
+
+    def load(self, emotions):
+        """Return (generation, [(path, song), ...] for the root and emotion folders) from one read transaction."""
+        conn = self._connect()
+        try:
+            # One explicit transaction, so a concurrent scan can't land between the queries.
+            conn.execute('BEGIN')
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+            folders = [''] + [emotion.lower() for emotion in emotions]
+            entries = [(row['path'], self._song(row)) for row in conn.execute(
+                'SELECT ' + _SONG_COLUMNS + ' FROM songs s WHERE s.folder IN ({}) ORDER BY s.path'.format(
+                    ', '.join('?' * len(folders))), folders)]
+        finally:
+            conn.close()
+        return (row[0] if row else 0), entries
+
+
+if __name__ == '__main__':
+    import config
+    from recommend import AUDIO_EXTENSIONS, LOCAL_SONGS_FOLDER
+
+    parser = argparse.ArgumentParser(description='Build or update the SQLite index of the local songs folder.')
+    parser.add_argument('--db', default=config.SONG_INDEX_PATH or config.DEFAULT_SONG_INDEX_PATH)
+    parser.add_argument('--root', default=LOCAL_SONGS_FOLDER)
+    parser.add_argument('--workers', type=int, default=None, help='metadata parser processes (default: CPU count)')
+    parser.add_argument('--watch', type=float, default=0, metavar='SECONDS', help='rescan at this interval')
+    args = parser.parse_args()
+    if mutagen is None:
+        print('mutagen is not installed: indexing file names only')
+    index = SongIndex(args.db)
+    while True:
+        started = time.perf_counter()
+        counts = index.scan(args.root, AUDIO_EXTENSIONS, args.workers)
+        if counts['updated'] or counts['removed'] or not args.watch:
+            print('{files} files, {updated} updated, {removed} removed in {elapsed:.2f}s -> {db}'.format(
+                elapsed=time.perf_counter() - started, db=args.db, **counts), flush=True)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,65 @@
+import threading
+
+import numpy as np
+
+
+def _load_interpreter_class():
+    # Prefer the standalone runtimes; fall back to the copy bundled with TensorFlow.
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tensorflow.lite import Interpreter
+        return Interpreter
+    except ImportError:
+        raise ImportError('The tflite backend needs ai-edge-litert, tflite-runtime or tensorflow installed')
+
+
+class TFLiteModel:
+    """Runs a converted (optionally quantized) .tflite model behind the Keras ``predict`` surface."""
+
+    def __init__(self, model_path, num_threads=None):
+        interpreter_class = _load_interpreter_class()
+        self.interpreter = interpreter_class(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(int(d) for d in self._input['shape'][1:])
+        self._batch_size = int(self._input['shape'][0])
+        # An interpreter holds its tensors in place, so calls must not overlap.
+        self._lock = threading.Lock()
+
+    def _quantize(self, x):
+        scale, zero_point = self._input['quantization']
+        dtype = self._input['dtype']
+        if scale and np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            return np.clip(np.round(x / scale + zero_point), info.min, info.max).astype(dtype)
+        return x.astype(dtype, copy=False)
+
+    def _dequantize(self, y):
+        scale, zero_point = self._output['quantization']
+        if scale and np.issubdtype(y.dtype, np.integer):
+            return (y.astype(np.float32) - zero_point) * scale
+        return y
+
+    def predict(self, x, verbose=0, batch_size=None):
+        x = np.asarray(x, dtype=np.float32).reshape((len(x),) + self.input_shape[1:])
+        with self._lock:
+            if len(x) != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input['index'], x.shape)
+                self.interpreter.allocate_tensors()
+                self._input = self.interpreter.get_input_details()[0]
+                self._output = self.interpreter.get_output_details()[0]
+                self._batch_size = len(x)
+            self.interpreter.set_tensor(self._input['index'], self._quantize(x))
+            self.interpreter.invoke()
+            y = self.interpreter.get_tensor(self._output['index'])
+        return self._dequantize(y)